@@ -1,5 +1,5 @@
 from fastapi import FastAPI, UploadFile, File, Query, Body
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import time
@@ -9,29 +9,34 @@ from pydantic import BaseModel
 from typing import Optional
 
 from fastapi.responses import StreamingResponse, JSONResponse
-from fastapi import BackgroundTasks
 from services.pdf_service import (
-    save_upload,
-    dir_original_pages,
-    dir_parsed_pages,
-    pdf_to_markdown,
-    render_original_pages,
-    unstructured_segments,
-    render_parsed_pages_with_boxes,
-    
+    stream_upload,
+    save_streamed_upload,
+    UploadTooLarge,
+    PAGE_FORMATS,
 )
+from services.page_cache import get_page_image
+from services.segment_store import load_page as load_page_segments
+from services.revision_service import plan_revision
+from services.job_service import scheduler, PARSE_STATUS_OF_JOB
+from services.layout_worker import layout_pool
+from services.render_worker import render_pool
+from services.embedding_client import embedding_metrics
+from services.query_embedding_cache import query_cache
+from services.reranker_service import RERANKER_PRELOAD, preload_reranker, reranker_status
 from services.index_service import build_chroma_index, search_chroma
 from services.rag_service import answer_stream, clear_history
-from services.ultis import rid,err
+from services.ultis import rid,err,has_parse_artifacts
 from services.log_service import get_logger, info, warning, error, log_exception
+from services.create_database import migrate_db
 # 导入数据库相关功能
 from services.database_service import (
     get_db, 
     add_file_info, 
-    update_file_parse_status, 
     get_all_file_names, 
     get_file_by_name,
     get_file_by_random_name,
+    get_file_by_content_hash,
     update_file_index_status
     )
 
@@ -57,19 +62,44 @@ app.add_middleware(
 API_PREFIX = "/api/v1"
 
 # ---------------- 内存态存储- ---------------
-current_pdf: Dict[str, Any] = {
-    "fileId": None,
-    "name": None,
-    "pages": 0,
-    "status": "idle",      # idle | parsing | ready | error
-    "progress": 0
-}
 citations: Dict[str, Dict[str, Any]] = {}   # citationId -> { fileId, page, snippet, bbox, previewUrl }
 
+# ---------------- 数据库迁移 ----------------
+@app.on_event("startup")
+async def migrate_database():
+    # 补齐新版本增加的表和列（不删除数据）；多个 worker 同时启动时其余 worker 的重复 DDL 会失败，忽略即可
+    try:
+        await migrate_db()
+    except Exception as e:
+        logger.warning(f"数据库迁移未完成: {e}")
+
+# ---------------- 解析任务调度器 ----------------
+@app.on_event("startup")
+async def start_scheduler():
+    await scheduler.start()
+
+# ---------------- 重排序模型预加载 ----------------
+@app.on_event("startup")
+async def warm_reranker():
+    # 后台线程加载，不阻塞服务启动；加载完成前的检索会等待同一次加载
+    if RERANKER_PRELOAD:
+        asyncio.create_task(asyncio.to_thread(preload_reranker))
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+    layout_pool.shutdown()
+    render_pool.shutdown()
+
 # ---------------- Health ----------------
 @app.get(f"{API_PREFIX}/health", tags=["Health"])
 async def health():
-    return {"ok": True, "version": "1.0.0"}
+    return {"ok": True, "version": "1.0.0", "reranker": reranker_status()}
+
+@app.get(f"{API_PREFIX}/health/embeddings", tags=["Health"])
+async def health_embeddings():
+    """嵌入客户端的健康检查缓存、熔断状态与请求指标，以及查询向量缓存的命中统计"""
+    return {"clients": embedding_metrics(), "queryCache": query_cache.snapshot()}
 
 # ---------------- Chat（SSE，POST 返回 event-stream） ----------------
 class ChatRequest(BaseModel):
@@ -99,8 +129,8 @@ async def chat_stream(req: ChatRequest):
             # 从数据表中根据文件名获取文件ID
             if file_id:
                 try:
-                    # 获取检索到的内容 - 修正参数顺序并改为同步调用
-                    citations, context_text = search_chroma(file_id, question)
+                    # 获取检索到的内容：在线程中检索，事件循环不被阻塞，并发请求的重排序可以合并成批
+                    citations, context_text = await asyncio.to_thread(search_chroma, file_id, question)
                     branch = "with_context" if context_text else "no_context"
                 except FileNotFoundError:
                     branch = "no_context"
@@ -154,36 +184,72 @@ async def chat_clear(req: ClearChatRequest):
 
 
 # ---------------- PDF: 上传（仅单文件，直接替换） ----------------
-# current_pdf = {"fileId": None, "name": None, "pages": 0, "status": "idle", "progress": 0}
 
 @app.post(f"{API_PREFIX}/pdf/upload", tags=["PDF"])
-async def pdf_upload(file: UploadFile = File(...), replace: Optional[bool] = True):
-    """上传文档"""
-    logger.info(f"开始上传文件，文件名: {file.filename}, 替换策略: {replace}")
+async def pdf_upload(file: UploadFile = File(...), replace: Optional[bool] = True, reviseOf: Optional[str] = Query(None)):
+    """上传文档；指定 reviseOf 时作为该文件的新版本上传，解析与索引时复用未变化页面的结果"""
+    logger.info(f"开始上传文件，文件名: {file.filename}, 替换策略: {replace}, 基础版本: {reviseOf}")
+    tmp_path = None
     try:
         if not file:
             logger.error("缺少文件")
             return JSONResponse(err("NO_FILE", "缺少文件"), status_code=400)
+        if reviseOf and not has_parse_artifacts(reviseOf):
+            logger.error(f"基础版本不存在，文件ID: {reviseOf}")
+            return JSONResponse(err("BASE_FILE_NOT_FOUND", "基础版本文件不存在"), status_code=404)
+        # 分块流式写入暂存文件并计算哈希（在线程中执行，不阻塞事件循环）
+        tmp_path, digest, size = await asyncio.to_thread(stream_upload, file.file)
+        # 按内容哈希查找已有的解析产物，相同内容直接复用
+        async for db in get_db():
+            existing = await get_file_by_content_hash(db, digest)
+        if existing and has_parse_artifacts(existing.random_name):
+            tmp_path.unlink(missing_ok=True)
+            logger.info(f"内容重复，复用已有文件 {existing.random_name}，content_hash: {digest}")
+            ready = bool(existing.is_parsed)
+            citations.clear()
+            return {
+                "fileId": existing.random_name,
+                "name": existing.file_name,
+                "pages": existing.pages,
+                "contentHash": digest,
+                "deduplicated": True,
+                "parsed": ready,
+                "indexed": bool(existing.is_builded_index),
+            }
         # 生成新的 fileId（替换策略：上传即替换）
         fid = rid("f")
         # 保存文件在data+file_id路径
-        saved = save_upload(fid, await file.read(), file.filename)
+        saved = await asyncio.to_thread(save_streamed_upload, fid, tmp_path, file.filename, digest)
+        revision = None
+        if reviseOf:
+            # 按页内容指纹对比基础版本，记录可复用的页面
+            revision = await asyncio.to_thread(plan_revision, fid, reviseOf)
+    except UploadTooLarge as e:
+        logger.error(f"上传文件过大，文件名: {file.filename}, 错误: {e}")
+        return JSONResponse(err("FILE_TOO_LARGE", "上传文件超过大小限制"), status_code=413)
     except Exception as e:
         logger.error(f"上传文件出错，文件名: {file.filename}, 错误: {e}")
+        if tmp_path:
+            tmp_path.unlink(missing_ok=True)
         return JSONResponse(err("UPLOAD_FAILED", "上传文件失败"), status_code=500)
-    # 将新的文件信息替换当前文件
-    current_pdf.update({**saved, "status": "idle", "progress": 0})
     citations.clear()
     
     # 将文件信息保存到数据库（异步版本）
     async for db in get_db():
-        await add_file_info(db, file.filename, fid, current_pdf["pages"])
-
-    return saved
+        await add_file_info(db, file.filename, fid, saved["pages"], saved["contentHash"])
+
+    resp = {**saved, "deduplicated": False}
+    if revision:
+        resp.update({
+            "revisionOf": reviseOf,
+            "reusedPages": len(revision["pageMap"]),
+            "changedPages": revision["changedPages"],
+        })
+    return resp
 
 # ---------------- PDF: 触发解析 ----------------
 @app.post(f"{API_PREFIX}/pdf/parse", tags=["PDF"])
-async def pdf_parse(payload: Dict[str, Any] = Body(...), bg: BackgroundTasks = None):
+async def pdf_parse(payload: Dict[str, Any] = Body(...)):
     """文档解析"""
     # 获取当前需要解析的文件的file_id
     logger.info(f"解析请求参数: {payload}") 
@@ -207,104 +273,113 @@ async def pdf_parse(payload: Dict[str, Any] = Body(...), bg: BackgroundTasks = N
         logger.error(f"查询文件信息出错，文件ID: {file_id}, 错误: {e}")
         return JSONResponse(err("DB_ERROR", "查询文件信息失败"), status_code=500)
 
-    # 更新当前文档的处理状态为“解析”
-    current_pdf["status"] = "parsing"
-    current_pdf["progress"] = 5 # 进度加载5
-
-    # 定义同步的PDF处理函数
-    def process_pdf():
-        try:
-            time_start = time.time()
-            # 20 → 60 → 100 三阶段进度示意
-            current_pdf["progress"] = 20
-            # 将原始页面转化为PNG格式，用于前端展示原文档
-            render_original_pages(file_id)
-            current_pdf["progress"] = 40
-            # 使用paddleocr对文档布局进行解析
-            docs = unstructured_segments(file_id)
-            current_pdf["progress"] = 60
-            # 添加框线图，并保存为PNG格式，用于前端展示解析后的文档
-            render_parsed_pages_with_boxes(file_id, docs)
-            current_pdf["progress"] = 80
-            # PDF转MD
-            pdf_to_markdown(file_id)
-            # run_full_parse_pipeline(file_id)   # 真解析
-            current_pdf["progress"] = 100
-            current_pdf["status"] = "ready"
-            # PDF处理完成后，通过回调函数通知主事件循环更新数据库
-            logger.info(f"PDF解析完成，耗时: {time.time() - time_start} 秒")
-            return True
-        except Exception as e:
-            current_pdf["status"] = "error"
-            current_pdf["progress"] = 0
-            logger.error(f"解析失败: {str(e)}", exc_info=True)
-            return False
-    
-    # 定义异步的数据库更新函数
-    async def update_database_after_processing():
-        success = await asyncio.to_thread(process_pdf)
-        if success:
-            try:
-                async for db in get_db():
-                    await update_file_parse_status(db, file_id)
-            except Exception as e:
-                logger.error(f"数据库更新失败: {str(e)}", exc_info=True)
-    
-    # 在后台任务中执行PDF处理和数据库更新
-    if bg is not None:
-        # 直接添加异步任务到BackgroundTasks
-        bg.add_task(update_database_after_processing)
-    else:
-        # 如果没有BackgroundTasks，直接在当前事件循环中执行
-        await update_database_after_processing()
-
-    return {"jobId": rid("j")}
+    # 提交到解析任务调度器，按优先级排队，返回可查询的任务ID
+    try:
+        job = await scheduler.submit(file_id, priority=int(payload.get("priority") or 0))
+    except Exception as e:
+        logger.error(f"提交解析任务出错，文件ID: {file_id}, 错误: {e}")
+        return JSONResponse(err("DB_ERROR", "提交解析任务失败"), status_code=500)
+    return {"jobId": job["jobId"], "status": job["status"]}
 
 # ---------------- PDF: 状态 ----------------
 @app.get(f"{API_PREFIX}/pdf/status", tags=["PDF"])
-async def pdf_status(fileId: str = Query(...)):
-    """返回文档解析进度"""
-    # 判断当前file_id是否存在
-    # if not current_pdf["fileId"] or current_pdf["fileId"] != fileId:
-    #     return {"status": "idle", "progress": 0}
+async def pdf_status(fileId: str = Query(...), jobId: Optional[str] = Query(None)):
+    """返回文档解析进度（指定 jobId 时返回该任务，否则返回该文件最近的任务）"""
     if not fileId:
         return JSONResponse(err("FILE_ID_REQUIRED", "缺少文件ID"), status_code=400)
-    resp = {"status": current_pdf["status"], "progress": current_pdf["progress"]}
-    if current_pdf["status"] == "error":
+    try:
+        job = await scheduler.get(jobId) if jobId else await scheduler.latest_for_file(fileId)
+        if jobId and job and job["fileId"] != fileId:
+            logger.error(f"任务不属于该文件，文件ID: {fileId}, 任务ID: {jobId}")
+            return JSONResponse(err("JOB_FILE_MISMATCH", "任务不属于该文件"), status_code=400)
+        if not job:
+            # 没有解析任务记录（例如旧数据），以文件表的解析状态为准
+            async for db in get_db():
+                file_info = await get_file_by_random_name(db, fileId)
+            parsed = bool(file_info and file_info.is_parsed)
+            return {"status": "ready" if parsed else "idle", "progress": 100 if parsed else 0}
+    except Exception as e:
+        logger.error(f"查询解析状态出错，文件ID: {fileId}, 错误: {e}")
+        return JSONResponse(err("DB_ERROR", "查询解析状态失败"), status_code=500)
+    resp = {
+        "status": PARSE_STATUS_OF_JOB[job["status"]],
+        "progress": job["progress"],
+        "stage": job["stage"],
+        "jobId": job["jobId"],
+        "jobStatus": job["status"],
+    }
+    if job["status"] == "error":
         resp["errorMsg"] = "解析失败"
     return resp
 
+# ---------------- 解析任务 ----------------
+@app.get(f"{API_PREFIX}/jobs/{{job_id}}", tags=["Jobs"])
+async def job_get(job_id: str):
+    """查询解析任务"""
+    job = await scheduler.get(job_id)
+    if not job:
+        return JSONResponse(err("JOB_NOT_FOUND", "任务不存在"), status_code=404)
+    return job
+
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/cancel", tags=["Jobs"])
+async def job_cancel(job_id: str):
+    """取消解析任务（运行中的任务在当前阶段结束后停止，可能由其他进程执行）"""
+    job, accepted = await scheduler.cancel(job_id)
+    if not job:
+        return JSONResponse(err("JOB_NOT_FOUND", "任务不存在"), status_code=404)
+    if not accepted:
+        return JSONResponse(err("JOB_NOT_CANCELLABLE", f"任务已结束（{job['status']}），无法取消"), status_code=409)
+    return job
+
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/retry", tags=["Jobs"])
+async def job_retry(job_id: str):
+    """重新提交失败或已取消的解析任务"""
+    job = await scheduler.retry(job_id)
+    if not job:
+        return JSONResponse(err("JOB_NOT_FOUND", "任务不存在"), status_code=404)
+    return job
+
 # ---------------- PDF: 页面图 ----------------
 @app.get(f"{API_PREFIX}/pdf/page", tags=["PDF"])
 async def pdf_page(
     fileId: str = Query(...),
     page: int = Query(..., ge=1),
-    type: str = Query(..., regex="^(original|parsed)$")
+    type: str = Query(..., regex="^(original|parsed)$"),
+    size: str = Query("screen", regex="^(thumb|screen|zoom)$"),
+    format: str = Query("png", regex="^(png|webp|jpeg)$")
 ):
-    """返回原文档图片和解析后的图片"""
+    """返回原文档图片和解析后的图片，可选尺寸（缩略图/屏幕/放大）与编码格式"""
     try:
-        if not current_pdf["fileId"] or current_pdf["fileId"] != fileId:
-            return JSONResponse(status_code=404, content=None)
-    except Exception as e:
-        logger.error(f"查询文件ID出错，文件ID: {fileId}, 错误: {e}")
-        return JSONResponse(err("DB_ERROR", "查询文件ID失败"), status_code=500)
-    try:
-        if current_pdf["status"] != "ready" and type == "parsed":
+        if type == "parsed" and await scheduler.active_job_for_file(fileId):
             # 未解析就请求 parsed 页，按你的契约可以给 400/403；这里保持 204 更温和
             return JSONResponse(status_code=204, content=None)
     except Exception as e:
         logger.error(f"检查文件状态出错，文件ID: {fileId}, 错误: {e}")
         return JSONResponse(err("DB_ERROR", "检查文件状态失败"), status_code=500)
     try:
-        # 获取原文档PNG图片或解析后的PNG图片路径
-        base = dir_original_pages(fileId) if type == "original" else dir_parsed_pages(fileId)
-        img = base / f"page-{page:04d}.png"
-        if not img.exists():
+        # 从页面缓存获取原文档图片或解析后的图片，原图未渲染时按需渲染
+        data = await asyncio.to_thread(get_page_image, fileId, page, type, size, format)
+        if data is None and type == "parsed":
+            return JSONResponse(status_code=204, content=None)
+        if data is None:
             return JSONResponse(err("PAGE_NOT_FOUND", "页面不存在或未渲染"), status_code=404)
     except Exception as e:
-        logger.error(f"获取页面图片路径出错，文件ID: {fileId}, 页面: {page}, 类型: {type}, 错误: {e}")
-        return JSONResponse(err("DB_ERROR", "获取页面图片路径失败"), status_code=500)
-    return FileResponse(str(img), media_type="image/png")
+        logger.error(f"获取页面图片出错，文件ID: {fileId}, 页面: {page}, 类型: {type}, 错误: {e}")
+        return JSONResponse(err("DB_ERROR", "获取页面图片失败"), status_code=500)
+    return Response(content=data, media_type=PAGE_FORMATS[format])
+
+# ---------------- PDF: 单页布局段 ----------------
+@app.get(f"{API_PREFIX}/pdf/segments", tags=["PDF"])
+async def pdf_segments(fileId: str = Query(...), page: int = Query(..., ge=1)):
+    """返回单页的布局段（类别、文本、多边形坐标、坐标系宽高），直接读取内存映射的段存储"""
+    try:
+        segments = await asyncio.to_thread(load_page_segments, fileId, page)
+    except Exception as e:
+        logger.error(f"读取布局段出错，文件ID: {fileId}, 页面: {page}, 错误: {e}")
+        return JSONResponse(err("DB_ERROR", "读取布局段失败"), status_code=500)
+    if segments is None:
+        return JSONResponse(err("SEGMENTS_NOT_FOUND", "该页尚未解析"), status_code=404)
+    return {"fileId": fileId, "page": page, "segments": segments}
 
 # ---------------- PDF: 获取所有文件名 ----------------
 @app.get(f"{API_PREFIX}/pdf/file_names", tags=["PDF"])
@@ -325,32 +400,28 @@ async def get_pdf_files():
 async def pdf_file_by_name(
     file_id: str = Body(..., embed=True),
     page: int = Query(..., ge=1),
-    type: str = Query(..., regex="^(original|parsed)$")
+    type: str = Query(..., regex="^(original|parsed)$"),
+    size: str = Query("screen", regex="^(thumb|screen|zoom)$"),
+    format: str = Query("png", regex="^(png|webp|jpeg)$")
 ):
 
     """根据文件id获取对应的文件页面"""
     try:
-        # 检查文件是否在current_pdf中
         if not file_id:
             return JSONResponse(status_code=404, content=None)
     except Exception as e:
         logger.error(f"检查文件ID出错，文件ID: {file_id}, 错误: {e}")
         return JSONResponse(err("DB_ERROR", "检查文件ID失败"), status_code=500)
-    
-    current_pdf["fileId"] = file_id
-    current_pdf["status"] = "idle"
-    current_pdf["progress"] = 0
     try:
-        # 获取原文档PNG图片或解析后的PNG图片路径
-        base = dir_original_pages(file_id) if type == "original" else dir_parsed_pages(file_id)
-        img = base / f"page-{page:04d}.png"
-        if not img.exists():
+        # 从页面缓存获取原文档图片或解析后的图片，原图未渲染时按需渲染
+        data = await asyncio.to_thread(get_page_image, file_id, page, type, size, format)
+        if data is None:
             return JSONResponse(err("PAGE_NOT_FOUND", "页面不存在或未渲染"), status_code=404)
     except Exception as e:
-        logger.error(f"获取页面图片路径出错，文件ID: {file_id}, 页面: {page}, 类型: {type}, 错误: {e}")
-        return JSONResponse(err("DB_ERROR", "获取页面图片路径失败"), status_code=500)
+        logger.error(f"获取页面图片出错，文件ID: {file_id}, 页面: {page}, 类型: {type}, 错误: {e}")
+        return JSONResponse(err("DB_ERROR", "获取页面图片失败"), status_code=500)
     try:
-        return FileResponse(str(img), media_type="image/png")
+        return Response(content=data, media_type=PAGE_FORMATS[format])
     except Exception as e:
         logger.error(f"返回页面图片出错，文件ID: {file_id}, 页面: {page}, 类型: {type}, 错误: {e}")
         return JSONResponse(err("DB_ERROR", "返回页面图片失败"), status_code=500)
@@ -405,11 +476,6 @@ class SearchRequest(BaseModel):
 @app.post(f"{API_PREFIX}/index/build", tags=["Index"])
 async def index_build(req: BuildIndexRequest):
     """构建索引"""
-    # 可校验：current_pdf["status"] 应为 ready
-    # if not current_pdf["fileId"] or current_pdf["fileId"] != req.fileId:
-    #     raise HTTPException(status_code=400, detail="FILE_NOT_FOUND_OR_NOT_CURRENT")
-    # if current_pdf["status"] != "ready":
-    #     raise HTTPException(status_code=409, detail="NEED_PARSE_FIRST")
     # 根据file_id检查文件是否存在并且是否已经解析
     try:
         if not req.fileId:
@@ -463,12 +529,11 @@ async def index_search(req: SearchRequest):
         logger.error(f"检查查询参数出错，文件ID: {req.fileId}, 查询: {req.query}, 错误: {e}")
         return JSONResponse(err("DB_ERROR", "检查查询参数失败"), status_code=500)
     try:
-        citations, context_text = search_chroma(req.fileId, req.query, req.k or 5)
+        citations, context_text = await asyncio.to_thread(search_chroma, req.fileId, req.query, req.k or 5)
     except Exception as e:
         logger.error(f"查询索引出错，文件ID: {req.fileId}, 查询: {req.query}, 错误: {e}")
         return JSONResponse(err("INDEX_SEARCH_ERROR", "索引查询失败"), status_code=500)
 
-    citations, context_text = search_chroma(req.fileId, req.query, req.k or 5)
     if not citations:
         return JSONResponse(err("INDEX_NOT_FOUND", "请先构建索引"), status_code=400)
     return {"citations": citations, "context_text": context_text}
\ No newline at end of file
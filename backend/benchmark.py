@@ -0,0 +1,307 @@
+"""
+性能基准脚本
+
+用法：
+    python benchmark.py render <pdf路径> [--workers 8] [--dpi 144]
+    python benchmark.py overlay <pdf路径> [--workers 8] [--dpi 144]   # 对照组需安装 matplotlib
+    python benchmark.py rerank [--md output.md] [--concurrency 8] [--requests 64] [--pairs 10]
+    python benchmark.py rerank-backends [--md output.md] [--backends torch,int8,onnx] [--top-k 5]
+"""
+import argparse
+import shutil
+import time
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from services.ultis import rid, workdir, original_pdf_path, dir_original_pages, dir_parsed_pages
+
+
+def _prepare_file(pdf: str) -> str:
+    """把待测 PDF 复制到临时工作目录，返回 file_id"""
+    file_id = rid("bench")
+    shutil.copyfile(pdf, original_pdf_path(file_id))
+    return file_id
+
+
+def _timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _isolated(fn, *args, **kwargs):
+    """在独立的 spawn 子进程中运行，返回 (耗时秒, 峰值RSS MB)"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(_measure, fn, *args, **kwargs).result()
+
+
+def _measure(fn, *args, **kwargs):
+    elapsed = _timed(fn, *args, **kwargs)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, max(own, children) / 1024
+
+
+def _text_block_segments(pdf: str) -> list:
+    """用 fitz 文本块构造与布局解析结果同结构的 segments，无需跑 OCR"""
+    import fitz
+
+    segments = []
+    with fitz.open(pdf) as doc:
+        for pno, page in enumerate(doc, start=1):
+            w, h = page.rect.width, page.rect.height
+            for i, (x0, y0, x1, y1, *_rest) in enumerate(page.get_text("blocks")):
+                segments.append({"metadata": {
+                    "page_number": pno,
+                    "category": ("Title", "Text", "Table", "Image")[i % 4],
+                    "coordinates": {
+                        "points": [(x0, y0), (x0, y1), (x1, y1), (x1, y0)],
+                        "layout_width": w,
+                        "layout_height": h,
+                    },
+                }})
+    return segments
+
+
+def _legacy_matplotlib_overlay(file_id: str, docs_local: list, dpi: int = 144):
+    """旧版叠框实现（每页重新光栅化 + matplotlib 绘图），仅作对照"""
+    import fitz
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+    from PIL import Image
+    from services.pdf_service import CATEGORY_TO_COLOR, DEFAULT_BOX_COLOR, _page_pixmap
+
+    out_dir = dir_parsed_pages(file_id)
+    segments_by_page = {}
+    for d in docs_local:
+        segments_by_page.setdefault(d["metadata"]["page_number"], []).append(d["metadata"])
+    with fitz.open(original_pdf_path(file_id)) as doc:
+        for page_number in range(1, doc.page_count + 1):
+            pix = _page_pixmap(doc.load_page(page_number - 1), dpi)
+            pil = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+            fig, ax = plt.subplots(1, figsize=(10, 10))
+            ax.imshow(pil)
+            ax.axis("off")
+            categories = set()
+            for seg in segments_by_page.get(page_number, []):
+                c = seg["coordinates"]
+                scaled = [(x * pix.width / c["layout_width"], y * pix.height / c["layout_height"]) for x, y in c["points"]]
+                color = CATEGORY_TO_COLOR.get(seg["category"], DEFAULT_BOX_COLOR)
+                categories.add(seg["category"])
+                ax.add_patch(patches.Polygon(scaled, linewidth=1, edgecolor=color, facecolor="none"))
+                ax.text(scaled[0][0], scaled[0][1], seg["category"], fontsize=8, color=color, transform=ax.transData)
+            handles = [patches.Patch(color=CATEGORY_TO_COLOR.get(c, DEFAULT_BOX_COLOR), label=c) for c in sorted(categories)]
+            if handles:
+                ax.legend(handles=handles, loc="upper right", fontsize=8)
+            fig.tight_layout()
+            fig.savefig(out_dir / f"page-{page_number:04d}.png", bbox_inches="tight", pad_inches=0)
+            plt.close(fig)
+
+
+def bench_overlay(args):
+    """对比旧版 matplotlib 叠框与直接位图绘制（串行 / 并行）"""
+    # 渲染进程池按 RENDER_WORKERS 创建，spawn 出的子进程同样读取该环境变量
+    os.environ["RENDER_WORKERS"] = str(args.workers)
+    from services.pdf_service import render_original_pages, render_parsed_pages_with_boxes
+
+    file_id = _prepare_file(args.pdf)
+    try:
+        segments = _text_block_segments(args.pdf)
+        render_original_pages(file_id, dpi=args.dpi)
+        rows = []
+        try:
+            rows.append(("matplotlib", *_isolated(_legacy_matplotlib_overlay, file_id, segments, dpi=args.dpi)))
+        except ImportError:
+            print("未安装 matplotlib，跳过旧版对照组")
+        rows.append(("位图绘制 串行", *_isolated(render_parsed_pages_with_boxes, file_id, segments, dpi=args.dpi, workers=1)))
+        rows.append((f"位图绘制 并行x{args.workers}", *_isolated(
+            render_parsed_pages_with_boxes, file_id, segments, dpi=args.dpi, workers=args.workers)))
+
+        print(f"页数: {len(list(dir_parsed_pages(file_id).glob('page-*.png')))}，segments: {len(segments)}")
+        for name, elapsed, rss in rows:
+            print(f"{name:<16} 耗时 {elapsed:.2f}s  峰值RSS {rss:.0f}MB")
+    finally:
+        shutil.rmtree(workdir(file_id), ignore_errors=True)
+
+
+def bench_render(args):
+    """对比串行与进程池并行渲染原始页面"""
+    os.environ["RENDER_WORKERS"] = str(args.workers)
+    from services.pdf_service import render_original_pages
+    from services.render_worker import render_pool
+
+    file_id = _prepare_file(args.pdf)
+    try:
+        # 服务中渲染进程池常驻，先拉起 worker，计时不含进程启动
+        render_pool.run_all(abs, [(0,)] * args.workers)
+        out_dir = dir_original_pages(file_id)
+        serial = _timed(render_original_pages, file_id, dpi=args.dpi, workers=1)
+        serial_pngs = {p.name: p.read_bytes() for p in out_dir.glob("page-*.png")}
+        shutil.rmtree(out_dir)
+
+        out_dir = dir_original_pages(file_id)
+        parallel = _timed(render_original_pages, file_id, dpi=args.dpi, workers=args.workers)
+        parallel_pngs = {p.name: p.read_bytes() for p in out_dir.glob("page-*.png")}
+
+        print(f"页数: {len(serial_pngs)}，DPI: {args.dpi}")
+        print(f"串行渲染:   {serial:.2f}s")
+        print(f"并行渲染:   {parallel:.2f}s（workers={args.workers}）")
+        print(f"加速比:     {serial / parallel:.2f}x")
+        print(f"输出一致:   {serial_pngs == parallel_pngs}")
+    finally:
+        shutil.rmtree(workdir(file_id), ignore_errors=True)
+
+
+def _rerank_requests(args) -> list:
+    """构造重排序请求：每个请求为 (query, 文档) 对列表；给定 Markdown 时用其分块，否则用随机长度的合成文本"""
+    import random
+
+    rng = random.Random(0)
+    if args.md:
+        from services.index_service import split_markdown
+        with open(args.md, encoding="utf-8") as f:
+            texts = [d.page_content for d in split_markdown(f.read())]
+    else:
+        words = "电梯 振动 舒适度 评估 标准 加速度 频率 测试 方法 结果 分析 建筑 结构 安全 规范".split()
+        texts = ["".join(rng.choices(words, k=rng.randint(10, 200))) for _ in range(200)]
+    queries = [rng.choice(texts)[:30] for _ in range(args.requests)]
+    return [[[q, rng.choice(texts)] for _ in range(args.pairs)] for q in queries]
+
+
+def bench_rerank(args):
+    """并发请求下的重排序吞吐：逐请求独立推理 vs 微批调度"""
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+    from services.reranker_service import get_reranker, RerankBatcher
+
+    reranker = get_reranker()
+    if not reranker.load_model():
+        print(f"重排序模型加载失败: {reranker.error}")
+        return
+    requests = _rerank_requests(args)
+    batcher = RerankBatcher(reranker, max_wait_ms=args.wait_ms, max_batch=args.max_batch)
+    modes = {
+        "逐请求推理": reranker.score_pairs,
+        f"微批调度(等待{args.wait_ms}ms, 批{args.max_batch})": lambda pairs: batcher.submit(pairs).result(),
+    }
+    results = {}
+    for name, score in modes.items():
+        score(requests[0])  # 预热
+        latencies = []
+
+        def one(pairs):
+            start = time.perf_counter()
+            out = score(pairs)
+            latencies.append(time.perf_counter() - start)
+            return out
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results[name] = list(pool.map(one, requests))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print(f"{name:<28} 吞吐 {len(requests) / elapsed:6.1f} 请求/s  {len(requests) * args.pairs / elapsed:7.1f} pair/s  "
+              f"P50 {statistics.median(latencies) * 1000:6.0f}ms  P95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:6.0f}ms")
+    a, b = results.values()
+    diff = max(abs(x - y) for ra, rb in zip(a, b) for x, y in zip(ra, rb))
+    print(f"并发: {args.concurrency}，请求数: {len(requests)}，每请求 pair 数: {args.pairs}，两种方式分数最大差异: {diff:.2e}")
+    print(f"批处理统计: {batcher.snapshot()}")
+
+
+def _score_agreement(reference: list, scores: list, top_k: int) -> dict:
+    """逐请求比较候选后端与 fp32 的打分：分数绝对误差、Spearman 秩相关、top-k 重合率、top-1 一致率"""
+    import numpy as np
+
+    abs_diff, spearman, overlap, top1 = [], [], [], []
+    for ref, cand in zip(reference, scores):
+        ref, cand = np.asarray(ref), np.asarray(cand)
+        abs_diff.append(np.abs(ref - cand))
+        ref_rank, cand_rank = ref.argsort().argsort(), cand.argsort().argsort()
+        spearman.append(np.corrcoef(ref_rank, cand_rank)[0, 1] if len(ref) > 1 else 1.0)
+        ref_top, cand_top = set(np.argsort(-ref)[:top_k]), set(np.argsort(-cand)[:top_k])
+        overlap.append(len(ref_top & cand_top) / len(ref_top))
+        top1.append(int(np.argmax(ref) == np.argmax(cand)))
+    diffs = np.concatenate(abs_diff)
+    return {"maxAbsDiff": float(diffs.max()), "meanAbsDiff": float(diffs.mean()),
+            "spearman": float(np.mean(spearman)), f"top{top_k}Overlap": float(np.mean(overlap)),
+            "top1Agreement": float(np.mean(top1))}
+
+
+def bench_rerank_backends(args):
+    """重排序推理后端对比：逐请求延迟与吞吐，以及与 fp32 的打分一致性"""
+    import statistics
+    from services.reranker_service import BGEReranker
+
+    requests = _rerank_requests(args)
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    if "torch" not in backends:
+        backends.insert(0, "torch")  # fp32 作为一致性对照
+    outputs = {}
+    for backend in backends:
+        reranker = BGEReranker(device="cpu", backend=backend)
+        if not reranker.load_model():
+            print(f"{backend:<6} 加载失败: {reranker.error}")
+            continue
+        reranker.score_pairs(requests[0])  # 预热
+        latencies, scores = [], []
+        for pairs in requests:
+            start = time.perf_counter()
+            scores.append(reranker.score_pairs(pairs))
+            latencies.append(time.perf_counter() - start)
+        outputs[backend] = scores
+        latencies.sort()
+        total = sum(latencies)
+        print(f"{backend:<6} 加载 {reranker.load_seconds:6.1f}s  吞吐 {len(requests) * args.pairs / total:7.1f} pair/s  "
+              f"P50 {statistics.median(latencies) * 1000:6.0f}ms  P95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:6.0f}ms")
+        del reranker
+    reference = outputs.get("torch")
+    if reference is None:
+        return
+    for backend, scores in outputs.items():
+        if backend != "torch":
+            print(f"{backend:<6} 与 fp32 一致性: {_score_agreement(reference, scores, args.top_k)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR RAG 后端性能基准")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("render", help="原始页面渲染：串行 vs 并行")
+    p.add_argument("pdf")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--dpi", type=int, default=144)
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("overlay", help="叠框渲染：matplotlib vs 直接位图绘制")
+    p.add_argument("pdf")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--dpi", type=int, default=144)
+    p.set_defaults(func=bench_overlay)
+
+    p = sub.add_parser("rerank", help="重排序吞吐：逐请求推理 vs 微批调度")
+    p.add_argument("--md", help="用该 Markdown 文件的分块作为文档，默认使用合成文本")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--pairs", type=int, default=10)
+    p.add_argument("--wait-ms", type=float, default=5)
+    p.add_argument("--max-batch", type=int, default=32)
+    p.set_defaults(func=bench_rerank)
+
+    p = sub.add_parser("rerank-backends", help="重排序推理后端：fp32 vs int8 动态量化 vs ONNX Runtime")
+    p.add_argument("--md", help="用该 Markdown 文件的分块作为文档，默认使用合成文本")
+    p.add_argument("--backends", default="torch,int8,onnx")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--pairs", type=int, default=10)
+    p.add_argument("--top-k", type=int, default=5)
+    p.set_defaults(func=bench_rerank_backends)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,33 @@ class FileInfo(Base):
     parse_time = Column(DateTime, nullable=True)
     build_index_time = Column(DateTime, nullable=True)
     pages = Column(Integer, nullable=True)
+    # 文件内容的 SHA-256，相同内容的上传复用同一份解析产物
+    content_hash = Column(String(64), index=True, nullable=True)
+
+# 定义解析任务模型
+class ParseJob(Base):
+    __tablename__ = "parse_job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(32), unique=True, index=True)
+    file_id = Column(String(100), index=True)
+    status = Column(String(20), default="queued")  # queued | running | done | error | cancelled
+    stage = Column(String(50), nullable=True)
+    progress = Column(Integer, default=0)
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=1)
+    error = Column(String(1000), nullable=True)
+    created_time = Column(DateTime)
+    started_time = Column(DateTime, nullable=True)
+    finished_time = Column(DateTime, nullable=True)
+    # 领取任务的进程（主机名:pid）与其最近一次心跳，心跳超时的运行中任务会被重新排队
+    worker = Column(String(64), nullable=True)
+    heartbeat_time = Column(DateTime, nullable=True)
+    # 排队/运行中时等于 file_id，结束后置空；唯一索引保证同一文件同时只有一个进行中的任务
+    active_file_id = Column(String(100), unique=True, index=True, nullable=True)
+    # 运行中的任务被请求取消（可能由其他进程发起），执行它的进程在下一个阶段边界中止
+    cancel_requested = Column(Boolean, default=False, nullable=True)
 
 # 初始化数据库
 async def init_db():
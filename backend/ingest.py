@@ -0,0 +1,320 @@
+"""
+批量导入脚本：扫描目录下的 PDF，流水线式执行 保存 → 解析 → 构建索引
+
+用法：
+    python ingest.py <目录> [--parse-workers 4] [--index-workers 2] [--save-workers 4]
+                           [--manifest data/_ingest/manifest.jsonl] [--batch-size 200] [--no-index]
+
+每个文件完成一个阶段后追加一行到 manifest（JSONL），中断后重新运行同一命令即从上次进度继续；
+FileInfo 的插入与状态更新按批写库，manifest 只在对应批次写库成功后才记录该阶段完成。
+保存前先记录 saving（含预先分配的 fileId），中断在保存与入库之间时，下次运行先删除该目录再重新保存
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from services.ultis import rid, has_parse_artifacts
+from services.log_service import get_logger
+
+logger = get_logger('ingest')
+
+# manifest 中各阶段的先后顺序
+STAGES = ("saved", "parsed", "indexed")
+
+
+def _init_worker():
+    """
+    解析/索引进程初始化：每个进程本身就是常驻的解析 worker，
+    关闭进程内再开布局进程池与渲染进程池，避免进程数成倍膨胀
+    """
+    from services import pdf_service
+    from services.layout_worker import layout_pool
+    layout_pool.workers = 0
+    pdf_service.RENDER_WORKERS = 1
+
+
+def _parse(file_id: str) -> Dict[str, Any]:
+    from services.pdf_service import run_full_parse_pipeline
+    return run_full_parse_pipeline(file_id)
+
+
+def _index(file_id: str) -> Dict[str, Any]:
+    from services.index_service import build_chroma_index
+    out = build_chroma_index(file_id)
+    if not out.get("ok"):
+        raise RuntimeError(out.get("error", "INDEX_BUILD_ERROR"))
+    return out
+
+
+def _save(path: Path, file_id: str) -> Dict[str, Any]:
+    """流式写入并计算内容哈希（复用上传接口的保存逻辑）"""
+    from services.pdf_service import stream_upload, save_streamed_upload
+    with path.open("rb") as f:
+        tmp_path, digest, _size = stream_upload(f)
+    return save_streamed_upload(file_id, tmp_path, path.name, digest)
+
+
+class Manifest:
+    """追加写的 JSONL 进度文件：每个路径以最后一条记录为准"""
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.records: Dict[str, Dict[str, Any]] = {}
+        # 内容哈希 -> 已保存的记录，用于跨运行去重
+        self.hashes: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._remember(json.loads(line))
+        self._fh = self.path.open("a", encoding="utf-8")
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        return self.records.get(path)
+
+    def by_hash(self, digest: str, exclude_path: str) -> Optional[Dict[str, Any]]:
+        """已保存的相同内容记录；不包括 exclude_path 自己之前的记录（其目录可能正是要重新保存的）"""
+        rec = self.hashes.get(digest)
+        if rec is None or rec["path"] == exclude_path:
+            return None
+        return rec
+
+    def _remember(self, rec: Dict[str, Any]):
+        self.records[rec["path"]] = rec
+        if rec.get("stage") in STAGES:
+            self.hashes[rec["contentHash"]] = rec
+
+    def write(self, rec: Dict[str, Any]):
+        self._remember(rec)
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+class DbBatcher:
+    """FileInfo 插入与解析/索引状态更新的批量写库；写库成功后才把对应记录写入 manifest"""
+    def __init__(self, manifest: Manifest, batch_size: int, interval: float):
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.interval = interval
+        self.inserts: List[Dict[str, Any]] = []
+        self.parsed: List[Dict[str, Any]] = []
+        self.indexed: List[Dict[str, Any]] = []
+        self._lock = asyncio.Lock()
+
+    def pending(self) -> int:
+        return len(self.inserts) + len(self.parsed) + len(self.indexed)
+
+    async def add(self, kind: str, rec: Dict[str, Any]):
+        getattr(self, kind).append(rec)
+        if self.pending() >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        from services.database_service import get_db, add_file_infos, mark_files_parsed, mark_files_indexed
+        async with self._lock:
+            inserts, parsed, indexed = self.inserts, self.parsed, self.indexed
+            self.inserts, self.parsed, self.indexed = [], [], []
+            if not (inserts or parsed or indexed):
+                return
+            try:
+                async for db in get_db():
+                    # 先插入再更新状态，同一批里刚插入的行也能被更新
+                    if inserts:
+                        await add_file_infos(db, [{
+                            "file_name": r["name"],
+                            "random_name": r["fileId"],
+                            "pages": r["pages"],
+                            "content_hash": r["contentHash"],
+                        } for r in inserts])
+                        # 插入已提交，即使后面的状态更新失败，重试时也不会重复插入
+                        for rec in inserts:
+                            self.manifest.write(rec)
+                        inserts = []
+                    if parsed:
+                        await mark_files_parsed(db, [r["fileId"] for r in parsed])
+                    if indexed:
+                        await mark_files_indexed(db, [r["fileId"] for r in indexed])
+            except Exception:
+                # 未写入的记录放回队列，下次写库时重试
+                self.inserts[:0], self.parsed[:0], self.indexed[:0] = inserts, parsed, indexed
+                raise
+            for rec in parsed + indexed:
+                self.manifest.write(rec)
+
+    async def run_periodic(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"批量写库失败，稍后重试: {e}", exc_info=True)
+
+
+class Progress:
+    def __init__(self, total: int, skipped: int, final: str):
+        self.total = total
+        self.skipped = skipped
+        self.final = final
+        self.counts = {"saved": 0, "parsed": 0, "indexed": 0, "duplicate": 0, "failed": 0}
+        self.start = time.time()
+
+    def line(self) -> str:
+        elapsed = time.time() - self.start
+        done = self.counts[self.final] + self.counts["duplicate"] + self.counts["failed"]
+        rate = done / elapsed if elapsed else 0
+        eta = (self.total - done) / rate if rate else float("inf")
+        stages = " ".join(f"{k}={v}" for k, v in self.counts.items())
+        return (f"[{elapsed:7.0f}s] {done}/{self.total} 完成（跳过已完成 {self.skipped}） {stages} "
+                f"速率 {rate * 60:.1f} 个/分钟 预计剩余 {eta / 60:.0f} 分钟")
+
+
+async def ingest(args):
+    from services.create_database import migrate_db
+    from services.database_service import get_db, get_file_by_content_hash
+
+    root = Path(args.root)
+    files = sorted(p for p in root.rglob(args.pattern) if p.is_file())
+    manifest = Manifest(Path(args.manifest))
+    final = "parsed" if args.no_index else "indexed"
+    todo = []
+    for p in files:
+        rec = manifest.get(str(p.resolve()))
+        if rec and (rec["stage"] == "duplicate" or
+                    (rec["stage"] in STAGES and STAGES.index(rec["stage"]) >= STAGES.index(final))):
+            continue
+        todo.append(p)
+    progress = Progress(len(todo), len(files) - len(todo), final)
+    print(f"共 {len(files)} 个文件，待处理 {len(todo)} 个")
+    if not todo:
+        manifest.close()
+        return
+
+    await migrate_db()
+    ctx = get_context("spawn")
+    pool_kwargs = {"mp_context": ctx, "initializer": _init_worker}
+    if sys.version_info >= (3, 11) and args.max_tasks_per_child > 0:
+        pool_kwargs["max_tasks_per_child"] = args.max_tasks_per_child
+    parse_pool = ProcessPoolExecutor(max_workers=args.parse_workers, **pool_kwargs)
+    index_pool = ProcessPoolExecutor(max_workers=args.index_workers, **pool_kwargs) if not args.no_index else None
+    save_sem = asyncio.Semaphore(args.save_workers)
+    # 同时在流水线中的文件数：保证各阶段都有活干，又不会一次性为两万个文件建任务
+    inflight = asyncio.Semaphore((args.save_workers + args.parse_workers + args.index_workers) * 2)
+    batcher = DbBatcher(manifest, args.batch_size, args.flush_interval)
+    loop = asyncio.get_running_loop()
+    # 本次运行内已保存的内容哈希，相同内容的文件只处理一次
+    seen_hashes: Dict[str, str] = {}
+
+    async def process(path: Path):
+        key = str(path.resolve())
+        rec = dict(manifest.get(key) or {"path": key})
+        try:
+            if rec.get("stage") not in STAGES or not has_parse_artifacts(rec["fileId"]):
+                if rec.get("stage") == "saving":
+                    # 上次运行中断在保存与入库之间，留下的目录没有任何记录引用
+                    await asyncio.to_thread(_discard, rec["fileId"])
+                file_id = rid("f")
+                # 先记录待保存的 fileId 再写盘，中断后可据此清理
+                manifest.write({"path": key, "stage": "saving", "fileId": file_id})
+                async with save_sem:
+                    saved = await asyncio.to_thread(_save, path, file_id)
+                digest = saved["contentHash"]
+                dup = manifest.by_hash(digest, key)
+                dup_id = seen_hashes.get(digest) or (dup and dup["fileId"])
+                # 只认解析产物仍在的文件为重复，否则继续保存本文件
+                if dup_id and not has_parse_artifacts(dup_id):
+                    dup_id = None
+                if not dup_id:
+                    # 先占位再查库，并发保存的相同内容只保留第一个
+                    seen_hashes[digest] = saved["fileId"]
+                    async for db in get_db():
+                        existing = await get_file_by_content_hash(db, digest)
+                    if existing and has_parse_artifacts(existing.random_name):
+                        dup_id = seen_hashes[digest] = existing.random_name
+                if dup_id:
+                    await asyncio.to_thread(_discard, saved["fileId"])
+                    manifest.write({"path": key, "stage": "duplicate", "fileId": dup_id, "contentHash": digest})
+                    progress.counts["duplicate"] += 1
+                    return
+                rec.update({"stage": "saved", "fileId": saved["fileId"], "name": saved["name"],
+                            "pages": saved["pages"], "contentHash": digest})
+                await batcher.add("inserts", dict(rec))
+                progress.counts["saved"] += 1
+            if rec["stage"] == "saved":
+                await loop.run_in_executor(parse_pool, _parse, rec["fileId"])
+                rec["stage"] = "parsed"
+                await batcher.add("parsed", dict(rec))
+                progress.counts["parsed"] += 1
+            if rec["stage"] == "parsed" and index_pool:
+                await loop.run_in_executor(index_pool, _index, rec["fileId"])
+                rec["stage"] = "indexed"
+                await batcher.add("indexed", dict(rec))
+                progress.counts["indexed"] += 1
+        except Exception as e:
+            logger.error(f"导入失败，文件: {path}, 阶段: {rec.get('stage')}, 错误: {e}", exc_info=True)
+            # 失败不覆盖已完成的阶段，下次运行从该阶段重试
+            progress.counts["failed"] += 1
+        finally:
+            inflight.release()
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(progress.line(), flush=True)
+
+    flusher = asyncio.create_task(batcher.run_periodic())
+    reporter = asyncio.create_task(report())
+    tasks = []
+    try:
+        for path in todo:
+            await inflight.acquire()
+            tasks.append(asyncio.create_task(process(path)))
+        await asyncio.gather(*tasks)
+    finally:
+        for t in (flusher, reporter):
+            t.cancel()
+        await batcher.flush()
+        parse_pool.shutdown()
+        if index_pool:
+            index_pool.shutdown()
+        manifest.close()
+        print(progress.line())
+
+
+def _discard(file_id: str):
+    """删除重复内容的文件目录"""
+    import shutil
+    from services.ultis import DATA_ROOT
+    shutil.rmtree(DATA_ROOT / file_id, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导入 PDF：保存 → 解析 → 构建索引")
+    parser.add_argument("root", help="待导入的目录（递归扫描）")
+    parser.add_argument("--pattern", default="*.pdf", help="文件匹配模式")
+    parser.add_argument("--save-workers", type=int, default=4, help="并发保存（读盘+哈希）的线程数")
+    parser.add_argument("--parse-workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="解析进程数（每个进程常驻并加载一份布局/OCR 模型）")
+    parser.add_argument("--index-workers", type=int, default=2, help="构建索引的进程数")
+    parser.add_argument("--max-tasks-per-child", type=int, default=50,
+                        help="每个进程处理多少个文件后重启，防止内存持续增长（需 Python 3.11+）")
+    parser.add_argument("--manifest", default="data/_ingest/manifest.jsonl", help="进度文件路径")
+    parser.add_argument("--batch-size", type=int, default=200, help="累计多少条记录写一次数据库")
+    parser.add_argument("--flush-interval", type=float, default=5, help="最长多少秒写一次数据库")
+    parser.add_argument("--report-interval", type=float, default=10, help="进度输出间隔秒数")
+    parser.add_argument("--no-index", action="store_true", help="只保存与解析，不构建索引")
+    args = parser.parse_args()
+    asyncio.run(ingest(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# services/bm25_index.py
+from __future__ import annotations
+import os
+import json
+import math
+import shutil
+import threading
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from .log_service import get_logger
+from .ultis import workdir
+from .vector_cache import index_version
+
+logger = get_logger('bm25_index')
+
+# BM25 倒排索引，与 index_chroma 并列存放在 <fileId>/index_bm25/：
+#     term_offsets.npy int64   [V + 1]   词 i 的倒排表位于 [term_offsets[i], term_offsets[i+1])
+#     postings.npy     int32   [nnz]     文档编号
+#     tfs.npy          float32 [nnz]     词频
+#     idf.npy          float32 [V]       逆文档频率（Okapi，负值按 epsilon * 平均 IDF 处理）
+#     doc_lens.npy     int32   [N]       文档长度（词数）
+#     vocab.json                         词 -> 编号
+#     docs.json                          [{text, metadata}]，检索结果直接由此构造 Document
+#     meta.json                          N / avgdl / k1 / b / epsilon
+# 打分与分词和 BM25Retriever.from_documents（rank_bm25.BM25Okapi + 空白分词）一致，
+# 查询只遍历查询词的倒排表，耗时不再随文档总数增长
+
+# 保持加载的索引数上限
+BM25_OPEN_INDEXES = int(os.getenv("BM25_OPEN_INDEXES", 32))
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+ARRAYS = ("term_offsets", "postings", "tfs", "idf", "doc_lens")
+
+def bm25_dir(file_id: str) -> Path:
+    return workdir(file_id) / "index_bm25"
+
+def tokenize(text: str) -> List[str]:
+    """与 BM25Retriever 默认的 preprocess_func 相同：按空白切分"""
+    return text.split()
+
+def build_bm25_index(file_id: str, docs: List[Document]) -> Path:
+    """为分块构建 BM25 倒排索引并写盘（先写临时目录再整体替换）"""
+    vocab: Dict[str, int] = {}
+    term_docs: List[List[int]] = []
+    term_tfs: List[List[int]] = []
+    doc_lens = np.zeros(len(docs), dtype=np.int32)
+    for doc_id, doc in enumerate(docs):
+        tokens = tokenize(doc.page_content)
+        doc_lens[doc_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            term_id = vocab.setdefault(term, len(vocab))
+            if term_id == len(term_docs):
+                term_docs.append([])
+                term_tfs.append([])
+            term_docs[term_id].append(doc_id)
+            term_tfs[term_id].append(tf)
+
+    n = len(docs)
+    term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in term_docs], out=term_offsets[1:])
+    idf = np.array([math.log(n - len(d) + 0.5) - math.log(len(d) + 0.5) for d in term_docs], dtype=np.float64)
+    if len(idf):
+        idf[idf < 0] = BM25_EPSILON * idf.mean()
+    arrays = {
+        "term_offsets": term_offsets,
+        "postings": np.fromiter((i for d in term_docs for i in d), dtype=np.int32, count=int(term_offsets[-1])),
+        "tfs": np.fromiter((t for ts in term_tfs for t in ts), dtype=np.float32, count=int(term_offsets[-1])),
+        "idf": idf.astype(np.float32),
+        "doc_lens": doc_lens,
+    }
+    meta = {"N": n, "avgdl": float(doc_lens.mean()) if n else 0.0, "k1": BM25_K1, "b": BM25_B, "epsilon": BM25_EPSILON}
+
+    out_dir = bm25_dir(file_id)
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, arr in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", arr)
+    (tmp_dir / "vocab.json").write_text(json.dumps(vocab, ensure_ascii=False), encoding="utf-8")
+    (tmp_dir / "docs.json").write_text(
+        json.dumps([{"text": d.page_content, "metadata": d.metadata or {}} for d in docs], ensure_ascii=False),
+        encoding="utf-8")
+    (tmp_dir / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+    # 旧索引先改名挪开再换入新索引，最后才删除：并发查询不会看到索引缺失而触发重复补建
+    old_dir = out_dir.with_name(f"{out_dir.name}.{os.getpid()}.old")
+    shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.replace(out_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+    os.replace(tmp_dir, out_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    with _open_lock:
+        for key in [k for k in _open_indexes if k[0] == file_id]:
+            _open_indexes.pop(key, None)
+    logger.info(f"BM25索引构建完成，文件ID: {file_id}，文档数: {n}，词表大小: {len(vocab)}")
+    return out_dir
+
+class BM25Index:
+    """加载后的 BM25 倒排索引（数组按内存映射读取）"""
+    def __init__(self, path: Path):
+        self.meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        self.vocab: Dict[str, int] = json.loads((path / "vocab.json").read_text(encoding="utf-8"))
+        self.docs = json.loads((path / "docs.json").read_text(encoding="utf-8"))
+        self.arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        k1, b, avgdl = self.meta["k1"], self.meta["b"], self.meta["avgdl"] or 1.0
+        # 文档长度归一化项 k1 * (1 - b + b * dl / avgdl) 与查询无关，加载时算好
+        self._norm = k1 * (1 - b + b * np.asarray(self.arrays["doc_lens"], dtype=np.float64) / avgdl)
+
+    def scores(self, query: str) -> np.ndarray:
+        a = self.arrays
+        k1 = self.meta["k1"]
+        scores = np.zeros(self.meta["N"], dtype=np.float64)
+        # 与 BM25Okapi.get_scores 一致，重复的查询词重复计分
+        for term in tokenize(query):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            s, e = int(a["term_offsets"][term_id]), int(a["term_offsets"][term_id + 1])
+            docs = a["postings"][s:e]
+            tf = a["tfs"][s:e].astype(np.float64)
+            scores[docs] += float(a["idf"][term_id]) * tf * (k1 + 1) / (tf + self._norm[docs])
+        return scores
+
+    def search(self, query: str, k: int) -> List[Tuple[Document, float]]:
+        """返回得分最高的 k 个分块及其 BM25 得分"""
+        n = self.meta["N"]
+        if not n or k <= 0:
+            return []
+        scores = self.scores(query)
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(Document(page_content=self.docs[i]["text"], metadata=self.docs[i]["metadata"]), float(scores[i]))
+                for i in top]
+
+# (fileId, 索引版本) -> BM25Index 的 LRU
+_open_indexes: "OrderedDict[tuple, BM25Index]" = OrderedDict()
+_open_lock = threading.Lock()
+
+def load_bm25(file_id: str) -> BM25Index | None:
+    """读取 BM25 索引（进程内缓存）；尚未构建时返回 None"""
+    key = (file_id, index_version(file_id))
+    with _open_lock:
+        index = _open_indexes.get(key)
+        if index is not None:
+            _open_indexes.move_to_end(key)
+            return index
+    path = bm25_dir(file_id)
+    if not (path / "meta.json").exists():
+        return None
+    index = BM25Index(path)
+    with _open_lock:
+        for old in [k for k in _open_indexes if k[0] == file_id and k != key]:
+            _open_indexes.pop(old, None)
+        _open_indexes[key] = index
+        while len(_open_indexes) > BM25_OPEN_INDEXES:
+            _open_indexes.popitem(last=False)
+    return index
@@ -0,0 +1,128 @@
+# services/chunk_embedding_cache.py
+from __future__ import annotations
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from .log_service import get_logger
+
+logger = get_logger('chunk_embedding_cache')
+
+# 分块向量缓存（SQLite）路径，所有文件共用：相同内容的分块在任何文件、任何版本中只向量化一次
+CHUNK_EMBED_CACHE_DB = os.getenv("CHUNK_EMBED_CACHE_DB", "data/_cache/chunk_embeddings.db")
+# 最多保留的分块向量数，超出时删除最久未使用的（换模型后旧模型的向量不再被使用，最先被删除），0 为不限
+CHUNK_EMBED_CACHE_MAX_ROWS = int(os.getenv("CHUNK_EMBED_CACHE_MAX_ROWS", 200000))
+# SQLite 单条语句的参数个数有上限，批量查询时分段
+_QUERY_BATCH = 500
+# 每写入多少条检查一次条目数上限
+_PURGE_EVERY = 5000
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ChunkEmbeddingCache:
+    """
+    按 (嵌入模型, 分块内容哈希) 持久化分块向量；多个解析/导入进程可同时读写（WAL）。
+    每条记录带最近使用时间，条目数超过 max_rows 时按最近最少使用删除
+    """
+    def __init__(self, db_path: str, max_rows: int = 0):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._puts_since_purge = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # 调用方已持有锁；首次使用时才建库，导入本模块不产生文件
+        if self._db is None:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+                             "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                             "used REAL NOT NULL DEFAULT 0, PRIMARY KEY (model, hash))")
+            self._add_used_column(self._db)
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_chunk_embeddings_used ON chunk_embeddings (used)")
+            self._db.commit()
+            self._purge(self._db)
+        return self._db
+
+    @staticmethod
+    def _add_used_column(db: sqlite3.Connection) -> None:
+        """旧版本建的库没有 used 列，原地补上（已有向量保留，视为最久未使用）"""
+        columns = [row[1] for row in db.execute("PRAGMA table_info(chunk_embeddings)")]
+        if "used" in columns:
+            return
+        try:
+            db.execute("ALTER TABLE chunk_embeddings ADD COLUMN used REAL NOT NULL DEFAULT 0")
+            logger.info("分块向量缓存补齐 used 列")
+        except sqlite3.OperationalError as e:
+            # 另一个进程刚刚补上
+            if "duplicate column" not in str(e):
+                raise
+
+    def _purge(self, db: sqlite3.Connection) -> None:
+        """条目数超过 max_rows 时删除最久未使用的条目（调用方已持有锁）"""
+        self._puts_since_purge = 0
+        if self.max_rows <= 0:
+            return
+        excess = db.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0] - self.max_rows
+        if excess <= 0:
+            return
+        db.execute("DELETE FROM chunk_embeddings WHERE rowid IN ("
+                   "SELECT rowid FROM chunk_embeddings ORDER BY used LIMIT ?)", (excess,))
+        db.commit()
+        logger.info(f"清理分块向量缓存，删除最久未使用的 {excess} 条")
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """返回已缓存的 {内容哈希: 向量}"""
+        out: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            db = self._conn()
+            for i in range(0, len(unique), _QUERY_BATCH):
+                part = unique[i:i + _QUERY_BATCH]
+                rows = db.execute(
+                    f"SELECT hash, vector FROM chunk_embeddings WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                    (model, *part)).fetchall()
+                for h, blob in rows:
+                    out[h] = np.frombuffer(blob, dtype=np.float64).tolist()
+            if out:
+                self._touch(db, model, list(out))
+        return out
+
+    def _touch(self, db: sqlite3.Connection, model: str, hashes: List[str]) -> None:
+        # 调用方已持有锁；更新命中条目的最近使用时间，写入失败不影响读取结果
+        now = time.time()
+        try:
+            for i in range(0, len(hashes), _QUERY_BATCH):
+                part = hashes[i:i + _QUERY_BATCH]
+                db.execute(f"UPDATE chunk_embeddings SET used = ? WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                           (now, model, *part))
+            db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"更新分块向量缓存使用时间失败: {e}")
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        if not vectors:
+            return
+        now = time.time()
+        rows = [(model, h, np.asarray(v, dtype=np.float64).tobytes(), now) for h, v in vectors.items()]
+        try:
+            with self._lock:
+                db = self._conn()
+                db.executemany("INSERT OR REPLACE INTO chunk_embeddings (model, hash, vector, used) VALUES (?, ?, ?, ?)", rows)
+                db.commit()
+                self._puts_since_purge += len(rows)
+                if self._puts_since_purge >= _PURGE_EVERY:
+                    self._purge(db)
+        except sqlite3.Error as e:
+            logger.warning(f"写入分块向量缓存失败: {e}")
+
+chunk_cache = ChunkEmbeddingCache(CHUNK_EMBED_CACHE_DB, CHUNK_EMBED_CACHE_MAX_ROWS)
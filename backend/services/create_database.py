@@ -1,9 +1,12 @@
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, select
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, select, inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 import asyncio
+import hashlib
+import argparse
+from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -42,6 +45,33 @@ class FileInfo(Base):
     parse_time = Column(DateTime, nullable=True)
     build_index_time = Column(DateTime, nullable=True)
     pages = Column(Integer, nullable=True)
+    # 文件内容的 SHA-256，相同内容的上传复用同一份解析产物
+    content_hash = Column(String(64), index=True, nullable=True)
+
+# 定义解析任务模型
+class ParseJob(Base):
+    __tablename__ = "parse_job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(32), unique=True, index=True)
+    file_id = Column(String(100), index=True)
+    status = Column(String(20), default="queued")  # queued | running | done | error | cancelled
+    stage = Column(String(50), nullable=True)
+    progress = Column(Integer, default=0)
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=1)
+    error = Column(String(1000), nullable=True)
+    created_time = Column(DateTime)
+    started_time = Column(DateTime, nullable=True)
+    finished_time = Column(DateTime, nullable=True)
+    # 领取任务的进程（主机名:pid）与其最近一次心跳，心跳超时的运行中任务会被重新排队
+    worker = Column(String(64), nullable=True)
+    heartbeat_time = Column(DateTime, nullable=True)
+    # 排队/运行中时等于 file_id，结束后置空；唯一索引保证同一文件同时只有一个进行中的任务
+    active_file_id = Column(String(100), unique=True, index=True, nullable=True)
+    # 运行中的任务被请求取消（可能由其他进程发起），执行它的进程在下一个阶段边界中止
+    cancel_requested = Column(Boolean, default=False, nullable=True)
 
 # 初始化数据库
 async def init_db():
@@ -50,6 +80,57 @@ async def init_db():
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
 
+def _add_missing_columns(sync_conn):
+    """按模型定义补齐已有表中缺失的列与索引（新增列均为可空列，已有行保持不变）"""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        added = [c for c in table.columns if c.name not in existing]
+        for column in added:
+            col_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type} NULL"))
+            print(f"新增列 {table.name}.{column.name}")
+        names = {c.name for c in added}
+        for index in table.indexes:
+            if names & {c.name for c in index.columns}:
+                index.create(sync_conn)
+
+# 补齐缺失的表与列，不删除已有数据（服务启动与批量导入时调用）
+async def migrate_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# 为迁移前上传的文件按已保存的原始PDF回填内容哈希
+async def backfill_content_hashes(data_root: Path = Path("data")):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(FileInfo).filter(FileInfo.content_hash.is_(None)))
+        filled = 0
+        for file_info in result.scalars().all():
+            pdf_path = data_root / file_info.random_name / "original.pdf"
+            if not pdf_path.exists():
+                continue
+            file_info.content_hash = await asyncio.to_thread(_file_sha256, pdf_path)
+            filled += 1
+        await db.commit()
+    return filled
+
 if __name__ == "__main__":
-    asyncio.run(init_db())
-    print("数据库初始化完成")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="数据库初始化与迁移（默认只补齐缺失的表和列，保留已有数据）")
+    parser.add_argument("--reset", action="store_true", help="删除全部表后重新创建（会清空已有数据）")
+    args = parser.parse_args()
+    if args.reset:
+        asyncio.run(init_db())
+        print("数据库初始化完成")
+    else:
+        async def _migrate():
+            await migrate_db()
+            return await backfill_content_hashes()
+        print(f"数据库迁移完成，回填内容哈希 {asyncio.run(_migrate())} 个文件")
@@ -1,7 +1,7 @@
 import os
 from datetime import datetime
-from services.create_database import AsyncSessionLocal, FileInfo
-from sqlalchemy import select
+from services.create_database import AsyncSessionLocal, FileInfo, ParseJob
+from sqlalchemy import select, update
 from services.log_service import get_logger
 
 logger = get_logger('database_service')
@@ -12,14 +12,15 @@ async def get_db():
         yield session
 
 # 数据库操作函数 - 异步版本
-async def add_file_info(db, file_name, random_name, pages):
+async def add_file_info(db, file_name, random_name, pages, content_hash=None):
     """添加文件信息到数据库"""
     try:
-        logger.info(f"添加文件信息到数据库，file_name: {file_name}, random_name: {random_name}, pages: {pages}")
+        logger.info(f"添加文件信息到数据库，file_name: {file_name}, random_name: {random_name}, pages: {pages}, content_hash: {content_hash}")
         file_info = FileInfo(
             file_name=file_name,
             random_name=random_name,
             pages=pages,
+            content_hash=content_hash,
             upload_time=datetime.now()
         )
         db.add(file_info)
@@ -30,6 +31,45 @@ async def add_file_info(db, file_name, random_name, pages):
         logger.error(f"添加文件信息到数据库失败，file_name: {file_name}, random_name: {random_name}, pages: {pages}", e)
         raise
 
+async def add_file_infos(db, rows):
+    """批量添加文件信息（rows: [{file_name, random_name, pages, content_hash}]），一次提交"""
+    try:
+        logger.info(f"批量添加文件信息到数据库，数量: {len(rows)}")
+        now = datetime.now()
+        db.add_all([FileInfo(upload_time=now, **row) for row in rows])
+        await db.commit()
+    except Exception as e:
+        logger.error(f"批量添加文件信息到数据库失败，数量: {len(rows)}", e)
+        raise
+
+async def mark_files_parsed(db, random_names):
+    """批量更新文件解析状态"""
+    try:
+        logger.info(f"批量更新文件解析状态，数量: {len(random_names)}")
+        await db.execute(
+            update(FileInfo)
+            .where(FileInfo.random_name.in_(random_names))
+            .values(is_parsed=True, parse_time=datetime.now())
+        )
+        await db.commit()
+    except Exception as e:
+        logger.error(f"批量更新文件解析状态失败，数量: {len(random_names)}", e)
+        raise
+
+async def mark_files_indexed(db, random_names):
+    """批量更新文件索引状态"""
+    try:
+        logger.info(f"批量更新文件索引状态，数量: {len(random_names)}")
+        await db.execute(
+            update(FileInfo)
+            .where(FileInfo.random_name.in_(random_names))
+            .values(is_builded_index=True, build_index_time=datetime.now())
+        )
+        await db.commit()
+    except Exception as e:
+        logger.error(f"批量更新文件索引状态失败，数量: {len(random_names)}", e)
+        raise
+
 async def update_file_parse_status(db, random_name):
     """更新文件解析状态"""
     try:
@@ -78,6 +118,20 @@ async def get_file_by_random_name(db, random_name):
         logger.error(f"根据随机名称获取文件信息失败，random_name: {random_name}", e)
         raise
 
+async def get_file_by_content_hash(db, content_hash):
+    """根据内容哈希获取已有文件信息（优先返回已解析的文件）"""
+    try:
+        logger.info(f"根据内容哈希获取文件信息，content_hash: {content_hash}")
+        result = await db.execute(
+            select(FileInfo)
+            .filter(FileInfo.content_hash == content_hash)
+            .order_by(FileInfo.is_parsed.desc(), FileInfo.id.asc())
+        )
+        return result.scalars().first()
+    except Exception as e:
+        logger.error(f"根据内容哈希获取文件信息失败，content_hash: {content_hash}", e)
+        raise
+
 async def get_file_by_name(db, random_name):
     """根据文件名获取文件信息"""
     try:
@@ -99,3 +153,189 @@ async def get_all_file_names(db):
     except Exception as e:
         logger.error("获取所有文件名和对应的随机名失败", e)
         raise
+
+
+async def add_parse_job(db, job_id, file_id, priority=0, max_attempts=1):
+    """添加解析任务"""
+    try:
+        logger.info(f"添加解析任务，job_id: {job_id}, file_id: {file_id}, priority: {priority}")
+        job = ParseJob(
+            job_id=job_id,
+            file_id=file_id,
+            status="queued",
+            progress=0,
+            priority=priority,
+            attempts=0,
+            max_attempts=max_attempts,
+            active_file_id=file_id,
+            created_time=datetime.now()
+        )
+        db.add(job)
+        await db.commit()
+        await db.refresh(job)
+        return job
+    except Exception as e:
+        logger.error(f"添加解析任务失败，job_id: {job_id}, file_id: {file_id}", e)
+        await db.rollback()
+        raise
+
+async def update_parse_job(db, job_id, **fields):
+    """更新解析任务的状态字段"""
+    try:
+        result = await db.execute(
+            select(ParseJob).filter(ParseJob.job_id == job_id)
+        )
+        job = result.scalars().first()
+        if job:
+            for key, value in fields.items():
+                setattr(job, key, value)
+            await db.commit()
+        return job
+    except Exception as e:
+        logger.error(f"更新解析任务失败，job_id: {job_id}, fields: {fields}", e)
+        raise
+
+async def get_parse_job(db, job_id):
+    """根据任务ID获取解析任务"""
+    try:
+        result = await db.execute(
+            select(ParseJob).filter(ParseJob.job_id == job_id)
+        )
+        return result.scalars().first()
+    except Exception as e:
+        logger.error(f"获取解析任务失败，job_id: {job_id}", e)
+        raise
+
+async def get_latest_parse_job(db, file_id):
+    """获取文件最近一次的解析任务"""
+    try:
+        result = await db.execute(
+            select(ParseJob).filter(ParseJob.file_id == file_id).order_by(ParseJob.id.desc())
+        )
+        return result.scalars().first()
+    except Exception as e:
+        logger.error(f"获取文件最近的解析任务失败，file_id: {file_id}", e)
+        raise
+
+async def get_active_parse_job(db, file_id):
+    """获取文件排队中/运行中的解析任务（任意进程提交的）"""
+    try:
+        result = await db.execute(
+            select(ParseJob)
+            .filter(ParseJob.file_id == file_id, ParseJob.status.in_(["queued", "running"]))
+            .order_by(ParseJob.id.desc())
+        )
+        return result.scalars().first()
+    except Exception as e:
+        logger.error(f"获取文件进行中的解析任务失败，file_id: {file_id}", e)
+        raise
+
+async def get_queued_parse_jobs(db):
+    """获取排队中的解析任务，按优先级与提交顺序排列"""
+    try:
+        result = await db.execute(
+            select(ParseJob)
+            .filter(ParseJob.status == "queued")
+            .order_by(ParseJob.priority.desc(), ParseJob.id.asc())
+        )
+        return result.scalars().all()
+    except Exception as e:
+        logger.error("获取排队中的解析任务失败", e)
+        raise
+
+async def claim_parse_job(db, job_id, worker):
+    """原子地领取排队中的任务（status 仍为 queued 才更新），返回领取后的任务；已被其他进程领取或已取消时返回 None"""
+    try:
+        now = datetime.now()
+        result = await db.execute(
+            update(ParseJob)
+            .where(ParseJob.job_id == job_id, ParseJob.status == "queued")
+            .values(status="running", worker=worker, attempts=ParseJob.attempts + 1, error=None,
+                    stage=None, progress=5, started_time=now, heartbeat_time=now)
+        )
+        await db.commit()
+        if result.rowcount != 1:
+            return None
+        return await get_parse_job(db, job_id)
+    except Exception as e:
+        logger.error(f"领取解析任务失败，job_id: {job_id}, worker: {worker}", e)
+        raise
+
+async def cancel_queued_parse_job(db, job_id):
+    """原子地取消排队中的任务，返回是否取消成功"""
+    try:
+        result = await db.execute(
+            update(ParseJob)
+            .where(ParseJob.job_id == job_id, ParseJob.status == "queued")
+            .values(status="cancelled", active_file_id=None, finished_time=datetime.now())
+        )
+        await db.commit()
+        return result.rowcount == 1
+    except Exception as e:
+        logger.error(f"取消解析任务失败，job_id: {job_id}", e)
+        raise
+
+async def request_parse_job_cancel(db, job_id):
+    """为运行中的任务记录取消请求（执行它的进程可能不是本进程），返回是否记录成功"""
+    try:
+        result = await db.execute(
+            update(ParseJob)
+            .where(ParseJob.job_id == job_id, ParseJob.status == "running")
+            .values(cancel_requested=True)
+        )
+        await db.commit()
+        return result.rowcount == 1
+    except Exception as e:
+        logger.error(f"记录解析任务取消请求失败，job_id: {job_id}", e)
+        raise
+
+async def parse_job_cancel_requested(db, job_id):
+    """任务是否已被请求取消"""
+    try:
+        result = await db.execute(select(ParseJob.cancel_requested).filter(ParseJob.job_id == job_id))
+        return bool(result.scalar())
+    except Exception as e:
+        logger.error(f"查询解析任务取消请求失败，job_id: {job_id}", e)
+        raise
+
+async def touch_parse_job(db, job_id, worker):
+    """运行中任务的心跳"""
+    try:
+        await db.execute(
+            update(ParseJob)
+            .where(ParseJob.job_id == job_id, ParseJob.worker == worker, ParseJob.status == "running")
+            .values(heartbeat_time=datetime.now())
+        )
+        await db.commit()
+    except Exception as e:
+        logger.error(f"更新解析任务心跳失败，job_id: {job_id}", e)
+        raise
+
+async def requeue_stale_parse_jobs(db, stale_before):
+    """
+    心跳早于 stale_before 的运行中任务视为所在进程已退出：
+    已被请求取消的标记为取消，尝试次数已用完的标记为失败，其余重新排队。返回重新排队的数量
+    """
+    try:
+        stale = (ParseJob.status == "running") & (
+            ParseJob.heartbeat_time.is_(None) | (ParseJob.heartbeat_time < stale_before))
+        await db.execute(
+            update(ParseJob)
+            .where(stale, ParseJob.cancel_requested.is_(True))
+            .values(status="cancelled", active_file_id=None, finished_time=datetime.now())
+        )
+        await db.execute(
+            update(ParseJob)
+            .where(stale, ParseJob.attempts >= ParseJob.max_attempts)
+            .values(status="error", error="解析进程中断", active_file_id=None, finished_time=datetime.now())
+        )
+        result = await db.execute(
+            update(ParseJob)
+            .where(stale)
+            .values(status="queued", stage=None, progress=0, worker=None)
+        )
+        await db.commit()
+        return result.rowcount
+    except Exception as e:
+        logger.error("重新排队中断的解析任务失败", e)
+        raise
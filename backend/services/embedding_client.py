@@ -0,0 +1,220 @@
+# services/embedding_client.py
+from __future__ import annotations
+import os
+import time
+import threading
+from typing import Dict, Any, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_core.embeddings import Embeddings
+
+from .log_service import get_logger
+from .query_embedding_cache import query_cache
+
+logger = get_logger('embedding_client')
+
+# 健康检查结果的有效期（秒），期内不再请求 /api/tags
+EMBED_HEALTH_TTL = float(os.getenv("EMBED_HEALTH_TTL", 30))
+# 连续失败多少次后熔断
+EMBED_BREAKER_THRESHOLD = int(os.getenv("EMBED_BREAKER_THRESHOLD", 3))
+# 熔断后多少秒内直接失败，之后放行一次探测
+EMBED_BREAKER_COOLDOWN = float(os.getenv("EMBED_BREAKER_COOLDOWN", 30))
+# 每个 Ollama 地址保持的长连接数
+EMBED_POOL_SIZE = int(os.getenv("EMBED_POOL_SIZE", 8))
+# 单次嵌入请求超时（秒）
+EMBED_REQUEST_TIMEOUT = float(os.getenv("EMBED_REQUEST_TIMEOUT", 60))
+# embed_documents 每次请求 /api/embed 携带的文本数
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+class EmbeddingUnavailable(Exception):
+    """嵌入服务不可用（健康检查失败或处于熔断期）"""
+
+# base_url -> requests.Session，同一地址的所有模型共用连接池
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def _session(base_url: str) -> requests.Session:
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EMBED_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[base_url] = session
+        return session
+
+class PooledOllamaEmbeddings(Embeddings):
+    """
+    直接调用 Ollama /api/embed 的嵌入模型（不依赖 langchain OllamaEmbeddings 的内部实现）：
+    请求走按地址共享的 Session，成功/失败计入所属 EmbeddingClient 的熔断状态与指标
+    """
+    def __init__(self, client: EmbeddingClient):
+        self.client = client
+        self.model = client.model
+        self.base_url = client.base_url
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """按 EMBED_BATCH_SIZE 分批请求，一次请求嵌入一批文本"""
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            vectors.extend(self.client.embed(texts[start:start + EMBED_BATCH_SIZE]))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """重复（归一化后相同）的查询直接返回缓存的向量，不再请求 Ollama"""
+        cached = query_cache.get(self.model, text)
+        if cached is not None:
+            return cached
+        embedding = self.client.embed([text])[0]
+        query_cache.put(self.model, text, embedding)
+        return embedding
+
+class EmbeddingClient:
+    """一个 (模型, 地址) 对应的嵌入客户端：缓存健康检查结果，连续失败时熔断，并统计请求指标"""
+    def __init__(self, model: str, base_url: str):
+        self.model = model
+        self.base_url = base_url
+        self.embeddings = PooledOllamaEmbeddings(self)
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._healthy = False
+        self._failures = 0
+        self._open_until = 0.0
+        # 半开状态下已放行的探测请求尚未返回
+        self._probing = False
+        self.metrics: Dict[str, Any] = {
+            "requests": 0, "errors": 0, "latencySeconds": 0.0,
+            "healthChecks": 0, "healthCacheHits": 0, "breakerRejections": 0, "breakerTrips": 0,
+        }
+
+    def _trip_if_needed(self) -> None:
+        # 调用方已持有锁
+        if self._failures >= EMBED_BREAKER_THRESHOLD and self._open_until <= time.monotonic():
+            self._open_until = time.monotonic() + EMBED_BREAKER_COOLDOWN
+            self._healthy = False
+            self.metrics["breakerTrips"] += 1
+            logger.warning(f"嵌入服务连续失败 {self._failures} 次，熔断 {EMBED_BREAKER_COOLDOWN} 秒，"
+                           f"模型: {self.model}, 地址: {self.base_url}")
+
+    def record_success(self, seconds: float) -> None:
+        with self._lock:
+            self.metrics["requests"] += 1
+            self.metrics["latencySeconds"] += seconds
+            self._failures = 0
+            self._open_until = 0.0
+            self._probing = False
+
+    def record_failure(self, seconds: float) -> None:
+        with self._lock:
+            self.metrics["requests"] += 1
+            self.metrics["errors"] += 1
+            self.metrics["latencySeconds"] += seconds
+            self._failures += 1
+            self._probing = False
+            self._trip_if_needed()
+
+    def reject_if_open(self) -> None:
+        """熔断期内不再向 Ollama 发送请求；冷却结束后（半开）只放行一个探测请求，其结果决定恢复或再次熔断"""
+        with self._lock:
+            if self._failures < EMBED_BREAKER_THRESHOLD:
+                return
+            now = time.monotonic()
+            if self._open_until > now:
+                self.metrics["breakerRejections"] += 1
+                raise EmbeddingUnavailable(f"嵌入服务熔断中，{self._open_until - now:.0f} 秒后重试")
+            if self._probing:
+                self.metrics["breakerRejections"] += 1
+                raise EmbeddingUnavailable("嵌入服务熔断恢复探测中，请稍后重试")
+            self._probing = True
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """一次 /api/embed 请求嵌入一批文本，请求耗时与结果计入指标和熔断状态"""
+        self.reject_if_open()
+        start = time.perf_counter()
+        try:
+            res = _session(self.base_url).post(
+                f"{self.base_url}/api/embed",
+                json={"model": self.model, "input": texts},
+                timeout=EMBED_REQUEST_TIMEOUT,
+            )
+            if res.status_code != 200:
+                raise ValueError(f"Error raised by inference API HTTP code: {res.status_code}, {res.text}")
+            embeddings = res.json()["embeddings"]
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Ollama 返回 {len(embeddings)} 个向量，请求了 {len(texts)} 个")
+        except Exception as e:
+            self.record_failure(time.perf_counter() - start)
+            if isinstance(e, requests.exceptions.RequestException):
+                raise ValueError(f"Error raised by inference endpoint: {e}")
+            raise
+        self.record_success(time.perf_counter() - start)
+        return embeddings
+
+    def ensure_healthy(self) -> None:
+        """TTL 内复用上次的健康检查结果；熔断期内直接抛出 EmbeddingUnavailable"""
+        self.reject_if_open()
+        with self._lock:
+            now = time.monotonic()
+            if self._healthy and now - self._checked_at < EMBED_HEALTH_TTL:
+                self.metrics["healthCacheHits"] += 1
+                return
+            self.metrics["healthChecks"] += 1
+        try:
+            response = _session(self.base_url).get(self.base_url + "/api/tags", timeout=10)
+            if response.status_code != 200:
+                logger.error(f"Ollama服务返回状态码 {response.status_code}，响应内容: {response.text}")
+                raise EmbeddingUnavailable("Ollama服务不可用，请确保Ollama已启动")
+        except Exception as e:
+            with self._lock:
+                self._healthy = False
+                self._failures += 1
+                self._probing = False
+                self._trip_if_needed()
+            if isinstance(e, EmbeddingUnavailable):
+                raise
+            raise EmbeddingUnavailable(f"Ollama服务不可用: {e}")
+        with self._lock:
+            self._healthy = True
+            self._checked_at = time.monotonic()
+            self._failures = 0
+            self._open_until = 0.0
+            self._probing = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            m = dict(self.metrics)
+            ok = m["requests"] - m["errors"]
+            m["avgLatencyMs"] = round(m.pop("latencySeconds") / m["requests"] * 1000, 2) if m["requests"] else 0.0
+            m["successes"] = ok
+            return {
+                "model": self.model,
+                "baseUrl": self.base_url,
+                "healthy": self._healthy,
+                "lastHealthCheckAgeSeconds": round(time.monotonic() - self._checked_at, 1) if self._checked_at else None,
+                "breakerOpen": self._open_until > time.monotonic(),
+                "consecutiveFailures": self._failures,
+                **m,
+            }
+
+# (模型, 地址) -> EmbeddingClient，进程内共享
+_clients: Dict[Tuple[str, str], EmbeddingClient] = {}
+_clients_lock = threading.Lock()
+
+def get_embeddings(model_name: str, base_url: str) -> PooledOllamaEmbeddings:
+    """返回共享的嵌入模型实例；首次获取或健康检查过期时才请求 Ollama"""
+    key = (model_name, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = EmbeddingClient(model_name, base_url)
+            logger.info(f"创建嵌入客户端，模型: {model_name}, 地址: {base_url}")
+    client.ensure_healthy()
+    return client.embeddings
+
+def embedding_metrics() -> List[Dict[str, Any]]:
+    """各嵌入客户端的健康状态与请求指标"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [c.snapshot() for c in clients]
@@ -3,18 +3,20 @@ from __future__ import annotations
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 import os
+import json
 import requests
 import numpy as np
-import torch
 import time
 
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 from langchain.docstore.document import Document
-from langchain_community.retrievers import BM25Retriever
 from langchain_community.vectorstores import Chroma
 from services.ultis import load_local_embeddings,markdown_path,index_dir
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from .log_service import get_logger
+from .chunk_embedding_cache import chunk_cache, text_hash
+from .vector_cache import chroma_cache, bump_index_version
+from .bm25_index import BM25Index, build_bm25_index, load_bm25
+from .reranker_service import get_reranker
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
@@ -23,61 +25,8 @@ logger = get_logger('index_service')
 
 # 复用你已有的数据目录结构
 DATA_ROOT = Path("data")
-
-class BGEReranker:
-    """BGE重排序器实现，支持从本地路径加载模型"""
-    def __init__(self, model_path: str = None, device: str = "cpu"):
-        # 默认使用本地路径，如果未提供则使用Hugging Face模型名称
-        self.model_path = model_path or os.getenv("RERANKER_PATH", "BAAI/bge-reranker-v2-m3")
-        self.device = device
-        self.model = None
-        self.tokenizer = None
-        
-    def load_model(self):
-        """加载BGE重排序模型（支持本地路径或Hugging Face模型）"""
-        try:
-            logger.info(f"正在从路径加载重排序模型: {self.model_path}")
-            # 尝试从本地路径或Hugging Face加载模型
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
-            self.model.to(self.device)
-            self.model.eval()
-            logger.info("重排序模型加载成功")
-            return True
-        except Exception as e:
-            logger.error(f"加载BGE重排序模型失败: {e}", exc_info=True)
-            return False
-    
-    def rerank(self, query: str, docs: List[Dict[str, Any]], top_k: int = 5) -> List[Dict[str, Any]]:
-        """对检索结果进行重排序"""
-        if self.model is None or self.tokenizer is None:
-            if not self.load_model():
-                # 如果无法加载模型，返回原始排序结果
-                logger.warning("无法加载重排序模型，返回原始排序结果")
-                return docs[:top_k]
-        
-        try:
-            # 准备模型输入
-            pairs = [[query, doc["text"]] for doc in docs]
-            inputs = self.tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=512)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # 获取模型输出
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                scores = outputs.logits.squeeze().tolist()
-            
-            # 为文档添加重排序分数
-            for i, doc in enumerate(docs):
-                doc["rerank_score"] = scores[i] if isinstance(scores, list) else scores
-            
-            # 按重排序分数降序排序
-            reranked_docs = sorted(docs, key=lambda x: x.get("rerank_score", 0), reverse=True)
-            logger.info(f"重排序完成，返回前 {top_k} 个文档，总文档数: {len(docs)}")
-            return reranked_docs[:top_k]
-        except Exception as e:
-            logger.error(f"重排序失败: {e}", exc_info=True)
-            return docs[:top_k]
+# 单次写入 Chroma 的分块数（低于 Chroma 的单批上限）
+UPSERT_BATCH = 1000
 
 def split_markdown(md_text: str) -> List[Document]:
     # 拆分细节
@@ -107,6 +56,61 @@ def split_markdown(md_text: str) -> List[Document]:
         logger.error(f"MD文档拆分失败: {e}", exc_info=True)
         return []
 
+def chunk_id(doc: Document) -> str:
+    """分块在 Chroma 中的 id：内容 + metadata 的哈希，内容不变的分块在重建时 id 不变"""
+    return text_hash(doc.page_content + "\0" + json.dumps(doc.metadata or {}, sort_keys=True, ensure_ascii=False))
+
+def _chunk_vectors(embeddings, docs: List[Document]) -> Tuple[List[List[float]], int]:
+    """按 (模型, 内容哈希) 从分块向量缓存取向量，只对未缓存的分块调用嵌入模型；返回 (向量, 新向量化数)"""
+    hashes = [text_hash(d.page_content) for d in docs]
+    cached = chunk_cache.get_many(embeddings.model, hashes)
+    missing = list(dict.fromkeys(h for h in hashes if h not in cached))
+    if missing:
+        text_of = {h: d.page_content for h, d in zip(hashes, docs)}
+        fresh = embeddings.embed_documents([text_of[h] for h in missing])
+        new_vectors = dict(zip(missing, fresh))
+        chunk_cache.put_many(embeddings.model, new_vectors)
+        cached.update(new_vectors)
+    return [cached[h] for h in hashes], len(missing)
+
+def _add_with_embeddings(chroma_db: Chroma, ids: List[str], docs: List[Document], vectors: List[List[float]]) -> None:
+    """
+    通过租用的句柄写入已算好向量的分块（按 id upsert，不再调用嵌入模型）。
+    Chroma 不接受空 metadata，有无 metadata 的分块分开写入；按批写入避免超过单次上限
+    """
+    with_meta = [i for i, d in enumerate(docs) if d.metadata]
+    without_meta = [i for i, d in enumerate(docs) if not d.metadata]
+    for start in range(0, len(with_meta), UPSERT_BATCH):
+        part = with_meta[start:start + UPSERT_BATCH]
+        chroma_db._collection.upsert(
+            ids=[ids[i] for i in part],
+            embeddings=[vectors[i] for i in part],
+            documents=[docs[i].page_content for i in part],
+            metadatas=[docs[i].metadata for i in part],
+        )
+    for start in range(0, len(without_meta), UPSERT_BATCH):
+        part = without_meta[start:start + UPSERT_BATCH]
+        chroma_db._collection.upsert(
+            ids=[ids[i] for i in part],
+            embeddings=[vectors[i] for i in part],
+            documents=[docs[i].page_content for i in part],
+        )
+
+def _load_or_build_bm25(file_id: str, chroma_db: Chroma) -> BM25Index | None:
+    """读取 BM25 索引；在此功能之前构建的向量索引没有 BM25 索引，从 Chroma 读出分块补建一次"""
+    bm25 = load_bm25(file_id)
+    if bm25 is not None:
+        return bm25
+    got = chroma_db.get(include=["documents", "metadatas"])
+    if not got["documents"]:
+        return None
+    logger.info(f"BM25索引不存在，从向量索引补建，文件ID: {file_id}")
+    metadatas = got.get("metadatas") or []
+    docs = [Document(page_content=text, metadata=(metadatas[i] if i < len(metadatas) else None) or {})
+            for i, text in enumerate(got["documents"])]
+    build_bm25_index(file_id, docs)
+    return load_bm25(file_id)
+
 def build_chroma_index(file_id: str) -> Dict[str, Any]:
     """构建Chroma向量索引知识库"""
     logger = get_logger('index_service')
@@ -124,19 +128,40 @@ def build_chroma_index(file_id: str) -> Dict[str, Any]:
         if not docs:
             return {"ok": False, "error": "EMPTY_MD"}
         
+        # 相同的分块（内容与 metadata 都相同）只保留一个
+        unique: Dict[str, Document] = {}
+        for d in docs:
+            unique.setdefault(chunk_id(d), d)
+        ids, docs = list(unique), list(unique.values())
+
         # 导入embedding模型
         embeddings = load_local_embeddings()
-        
-        # 创建并保存Chroma向量数据库
-        chroma_db = Chroma.from_documents(
-            documents=docs,
-            embedding=embeddings,
-            persist_directory=str(index_dir(file_id))
-        )
-        chroma_db.persist()
+
+        # 增量构建：集合中已有的分块保持不动，只写入新增/变化的分块并删除已不存在的分块；
+        # 新分块的向量优先取自分块向量缓存（修订版本、重复导入的相同内容不再向量化）
+        # 写入与本进程的检索共用同一个句柄（chromadb 按路径共享 System），避免两份 HNSW 数据
+        with chroma_cache.lease(file_id, embeddings) as chroma_db:
+            existing = set(chroma_db.get(include=[])["ids"])
+            new_idx = [i for i, cid in enumerate(ids) if cid not in existing]
+            stale = list(existing - set(ids))
+            embedded = 0
+            if new_idx:
+                new_docs = [docs[i] for i in new_idx]
+                vectors, embedded = _chunk_vectors(embeddings, new_docs)
+                _add_with_embeddings(chroma_db, [ids[i] for i in new_idx], new_docs, vectors)
+            if stale:
+                chroma_db.delete(ids=stale)
+            logger.info(f"增量更新Chroma索引，文件ID: {file_id}，未变化: {len(docs) - len(new_idx)}，"
+                        f"新增: {len(new_idx)}（其中新向量化: {embedded}），删除: {len(stale)}")
+            chroma_db.persist()
+        if new_idx or stale or load_bm25(file_id) is None:
+            build_bm25_index(file_id, docs)
+            # 新版本号使各进程缓存的旧句柄失效；本进程的句柄直接释放，下次检索按新版本重新打开
+            bump_index_version(file_id)
+            chroma_cache.invalidate(file_id)
         time_end = time.time()
         logger.info(f"成功构建Chroma索引，文件ID: {file_id}，文档数: {len(docs)}，耗时: {time_end - time_start}秒")
-        return {"ok": True, "chunks": len(docs)}
+        return {"ok": True, "chunks": len(docs), "added": len(new_idx), "embedded": embedded, "deleted": len(stale)}
     except Exception as e:
         logger.error(f"构建Chroma索引失败，文件ID: {file_id}", e)
         return {"ok": False, "error": f"构建索引失败: {str(e)}"}
@@ -214,43 +239,19 @@ def search_chroma(file_id: str, query: str, k: int = 5) -> Tuple[List[Dict[str,
             logger.warning(f"索引目录不存在或为空: {idx}")
             return [], "(no hits)"
         
-        # 2. 加载Chroma向量库和嵌入模型
+        # 2. 加载Chroma向量库和嵌入模型（按 fileId + 索引版本缓存打开的句柄）
+        # 租用期间句柄不会因淘汰或重建而被停止
         embeddings = load_local_embeddings()
-        try:
-            chroma_db = Chroma(
-                persist_directory=str(idx),
-                embedding_function=embeddings
-            )
-            logger.info(f"成功加载Chroma索引，文件ID: {file_id}，文档数: {len(chroma_db.get()['documents'])}")
-        except Exception as e:
-            logger.error(f"加载Chroma索引失败，文件ID: {file_id}", e)
-            return [], "(no hits)"
-        
-        # 3. 获取向量检索结果
-        vector_results = chroma_db.similarity_search_with_score(query, k=k*3)
-        logger.info(f"向量检索完成，文件ID: {file_id}，返回 {len(vector_results)} 个文档")
-        
-        # 4. 混合检索：添加BM25关键词检索
-        # 获取所有文档用于构建BM25检索器
-        all_docs = chroma_db.get()
-        if not all_docs["documents"]:
+        with chroma_cache.lease(file_id, embeddings) as chroma_db:
+            # 3. 获取向量检索结果
+            vector_results = chroma_db.similarity_search_with_score(query, k=k*3)
+            logger.info(f"向量检索完成，文件ID: {file_id}，返回 {len(vector_results)} 个文档")
+
+            # 4. 混合检索：添加BM25关键词检索（查询构建索引时持久化的倒排索引）
+            bm25 = _load_or_build_bm25(file_id, chroma_db)
+        if bm25 is None:
             return [], "(no hits)"
-        
-        # 重建Document对象列表
-        docs_for_bm25 = []
-        for i, content in enumerate(all_docs["documents"]):
-            metadata = all_docs["metadatas"][i] if i < len(all_docs["metadatas"]) else {}
-            docs_for_bm25.append(Document(page_content=content, metadata=metadata))
-        
-        # 创建BM25检索器
-        bm25_retriever = BM25Retriever.from_documents(docs_for_bm25)
-        bm25_retriever.k = k * 3  # 获取更多结果用于融合
-        
-        # 执行BM25检索
-        # 使用invoke方法替代已弃用的get_relevant_documents
-        bm25_docs = bm25_retriever.invoke(query)
-        # 为BM25结果添加默认分数（BM25不直接提供分数）
-        bm25_results = [(doc, 1.0 - (i / len(bm25_docs))) for i, doc in enumerate(bm25_docs)]
+        bm25_results = bm25.search(query, k * 3)  # 获取更多结果用于融合
         
         # 5. 使用RRF融合向量和BM25结果
         hybrid_results = calculate_rrf_scores(vector_results, bm25_results)
@@ -269,11 +270,8 @@ def search_chroma(file_id: str, query: str, k: int = 5) -> Tuple[List[Dict[str,
         
         # 7. 应用BGE重排序
         try:
-            # 从环境变量获取设备类型，默认使用CPU
-            device = os.getenv("RERANKER_DEVICE", "cpu")
-            # 从环境变量获取模型路径（如果有）
-            model_path = os.getenv("RERANKER_PATH")
-            reranker = BGEReranker(model_path=model_path, device=device)
+            # 进程内共享的重排序器（RERANKER_PATH / RERANKER_DEVICE），模型只加载一次
+            reranker = get_reranker()
             results = reranker.rerank(query, results, top_k=k)
             logger.info(f"成功应用重排序，返回前{k}个结果")
         except Exception as e:
@@ -0,0 +1,328 @@
+# services/job_service.py
+from __future__ import annotations
+import os
+import socket
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from .log_service import get_logger
+from .ultis import rid
+from .pdf_service import run_full_parse_pipeline
+from .page_cache import page_cache
+from .database_service import (
+    get_db,
+    add_parse_job,
+    update_parse_job,
+    get_parse_job,
+    get_latest_parse_job,
+    get_active_parse_job,
+    get_queued_parse_jobs,
+    claim_parse_job,
+    cancel_queued_parse_job,
+    request_parse_job_cancel,
+    parse_job_cancel_requested,
+    touch_parse_job,
+    requeue_stale_parse_jobs,
+    update_file_parse_status,
+)
+
+logger = get_logger('job_service')
+
+# 同时运行的解析任务数（CPU 密集，按机器核数和内存调整）
+PARSE_MAX_CONCURRENCY = int(os.getenv("PARSE_MAX_CONCURRENCY", 2))
+# 每个任务的最大尝试次数（含首次），失败后自动重试
+PARSE_MAX_ATTEMPTS = int(os.getenv("PARSE_MAX_ATTEMPTS", 2))
+# 重试前的等待秒数
+PARSE_RETRY_DELAY = float(os.getenv("PARSE_RETRY_DELAY", 5))
+# 运行中任务写心跳的间隔（秒）
+PARSE_HEARTBEAT_INTERVAL = float(os.getenv("PARSE_HEARTBEAT_INTERVAL", 15))
+# 心跳超过多少秒未更新视为所在进程已退出，任务重新排队
+PARSE_STALE_SECONDS = float(os.getenv("PARSE_STALE_SECONDS", 120))
+# 多久扫描一次数据库中的排队任务与中断任务（多进程部署时其他进程提交或遗留的任务）
+PARSE_RECOVER_INTERVAL = float(os.getenv("PARSE_RECOVER_INTERVAL", 30))
+
+ACTIVE_STATUSES = ("queued", "running")
+TERMINAL_STATUSES = ("done", "error", "cancelled")
+# 任务状态到 /pdf/status 原有状态（idle | parsing | ready | error）的映射
+PARSE_STATUS_OF_JOB = {
+    "queued": "parsing",
+    "running": "parsing",
+    "done": "ready",
+    "error": "error",
+    "cancelled": "idle",
+}
+
+class JobCancelled(Exception):
+    """任务在运行中被取消"""
+
+def _job_to_dict(job) -> Dict[str, Any]:
+    """把 ParseJob 行转换为与内存态一致的字典"""
+    return {
+        "jobId": job.job_id,
+        "fileId": job.file_id,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": job.progress or 0,
+        "priority": job.priority or 0,
+        "attempts": job.attempts or 0,
+        "maxAttempts": job.max_attempts or 1,
+        "error": job.error,
+        "cancelRequested": bool(job.cancel_requested),
+    }
+
+class JobScheduler:
+    """
+    解析任务调度器：任务表持久化在数据库，是否有进行中的任务、任务由谁执行都以数据库为准。
+    多个进程（uvicorn 多 worker、滚动重启）共用同一张任务表：任务通过条件更新原子领取，
+    只有领取成功的进程执行；内存中只保留本进程排队/运行中任务的运行态，结束后移除。
+    按优先级排队，固定数量的 worker 限制并发，支持取消与失败重试
+    """
+    def __init__(self, concurrency: int = PARSE_MAX_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._cancelled: set[str] = set()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._persist_lock: Optional[asyncio.Lock] = None
+        self._workers: list[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 同优先级按提交顺序执行
+        self._seq = itertools.count()
+
+    async def start(self):
+        """启动 worker，并接管数据库中排队的任务和心跳超时（进程已退出）的任务"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._persist_lock = asyncio.Lock()
+        await self._recover()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._recover_loop()))
+        logger.info(f"解析任务调度器已启动，并发数: {self.concurrency}, worker: {self.worker_id}")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _recover(self):
+        """把心跳超时的运行中任务重新排队，并把数据库中本进程尚未排队的任务加入队列"""
+        stale_before = datetime.now() - timedelta(seconds=PARSE_STALE_SECONDS)
+        async for db in get_db():
+            requeued = await requeue_stale_parse_jobs(db, stale_before)
+            if requeued:
+                logger.info(f"重新排队心跳超时的解析任务 {requeued} 个")
+            for job in await get_queued_parse_jobs(db):
+                if job.job_id not in self._jobs:
+                    self._jobs[job.job_id] = _job_to_dict(job)
+                    self._enqueue(job.job_id)
+                    logger.info(f"接管排队中的解析任务，job_id: {job.job_id}, file_id: {job.file_id}")
+
+    async def _recover_loop(self):
+        while True:
+            await asyncio.sleep(PARSE_RECOVER_INTERVAL)
+            try:
+                await self._recover()
+            except Exception as e:
+                logger.error(f"扫描待执行的解析任务失败: {e}", exc_info=True)
+
+    def _enqueue(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job:
+            self._queue.put_nowait((-job["priority"], next(self._seq), job_id))
+
+    async def active_job_for_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """文件排队中/运行中的任务（任意进程提交的）；本进程有该任务时返回内存中的最新进度"""
+        async for db in get_db():
+            job = await get_active_parse_job(db, file_id)
+        if not job:
+            return None
+        return dict(self._jobs.get(job.job_id) or _job_to_dict(job))
+
+    async def submit(self, file_id: str, priority: int = 0, max_attempts: int = PARSE_MAX_ATTEMPTS) -> Dict[str, Any]:
+        """提交解析任务；同一文件已有排队/运行中的任务时直接返回该任务"""
+        active = await self.active_job_for_file(file_id)
+        if not active:
+            job_id = rid("j")
+            try:
+                async for db in get_db():
+                    job = await add_parse_job(db, job_id, file_id, priority, max_attempts)
+            except IntegrityError:
+                # 其他进程同时为该文件提交了任务（active_file_id 唯一）
+                active = await self.active_job_for_file(file_id)
+                if not active:
+                    raise
+            else:
+                self._jobs[job_id] = _job_to_dict(job)
+                self._enqueue(job_id)
+                logger.info(f"提交解析任务，job_id: {job_id}, file_id: {file_id}, priority: {priority}")
+                return dict(self._jobs[job_id])
+        logger.info(f"文件已有进行中的解析任务，file_id: {file_id}, job_id: {active['jobId']}")
+        return active
+
+    async def cancel(self, job_id: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        取消任务，返回 (任务, 取消是否生效)：排队中的任务直接标记取消（可能在其他进程的队列里，领取时会被跳过）；
+        运行中的任务在数据库中记录取消请求，执行它的进程（本进程或其他进程）在下一个阶段边界中止。
+        已结束的任务无法取消，原样返回（已取消的视为生效）
+        """
+        async for db in get_db():
+            if await cancel_queued_parse_job(db, job_id):
+                self._jobs.pop(job_id, None)
+                logger.info(f"取消解析任务，job_id: {job_id}, 当前状态: queued")
+            elif await request_parse_job_cancel(db, job_id):
+                if job_id in self._jobs:
+                    self._cancelled.add(job_id)
+                    self._jobs[job_id]["cancelRequested"] = True
+                logger.info(f"请求取消运行中的解析任务，job_id: {job_id}")
+        job = await self.get(job_id)
+        if job is None:
+            return None, False
+        accepted = job["status"] == "cancelled" or (job["status"] == "running" and job["cancelRequested"])
+        return job, accepted
+
+    async def retry(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """对失败或已取消的任务重新提交一个新任务"""
+        job = await self.get(job_id)
+        if not job:
+            return None
+        if job["status"] in ACTIVE_STATUSES:
+            return job
+        return await self.submit(job["fileId"], job["priority"], job["maxAttempts"])
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """本进程排队/运行中的任务读取内存态，其余从数据库读取"""
+        if job_id in self._jobs:
+            return dict(self._jobs[job_id])
+        async for db in get_db():
+            job = await get_parse_job(db, job_id)
+        return _job_to_dict(job) if job else None
+
+    async def latest_for_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        async for db in get_db():
+            job = await get_latest_parse_job(db, file_id)
+        if not job:
+            return None
+        return dict(self._jobs.get(job.job_id) or _job_to_dict(job))
+
+    async def _check_cancel(self, job_id: str, db) -> None:
+        # 其他进程发起的取消只记录在数据库中，读到后交给进度回调在阶段边界中止
+        if job_id not in self._cancelled and await parse_job_cancel_requested(db, job_id):
+            self._cancelled.add(job_id)
+            logger.info(f"收到解析任务的取消请求，job_id: {job_id}")
+
+    async def _persist(self, job_id: str, **extra):
+        # 串行写库，保证先产生的进度更新不会覆盖后面的最终状态
+        async with self._persist_lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job = dict(job)
+            if job["status"] in TERMINAL_STATUSES:
+                extra.setdefault("active_file_id", None)
+            elif job["status"] == "running":
+                extra.setdefault("heartbeat_time", datetime.now())
+            try:
+                async for db in get_db():
+                    await update_parse_job(
+                        db, job_id,
+                        status=job["status"], stage=job["stage"], progress=job["progress"],
+                        attempts=job["attempts"], error=job["error"], **extra
+                    )
+                    if job["status"] == "running":
+                        await self._check_cancel(job_id, db)
+            except Exception as e:
+                logger.error(f"持久化解析任务状态失败，job_id: {job_id}, 错误: {e}", exc_info=True)
+
+    async def _finish(self, job_id: str, status: str):
+        """写入最终状态后从内存移除，之后的查询读数据库"""
+        self._jobs[job_id]["status"] = status
+        await self._persist(job_id, finished_time=datetime.now())
+        self._jobs.pop(job_id, None)
+
+    def _reporter(self, job_id: str):
+        """返回给解析流程在工作线程中调用的进度回调；任务被取消时抛出 JobCancelled"""
+        def report(stage: str, progress: int):
+            if job_id in self._cancelled:
+                raise JobCancelled(job_id)
+            job = self._jobs[job_id]
+            job["stage"], job["progress"] = stage, progress
+            asyncio.run_coroutine_threadsafe(self._persist(job_id), self._loop)
+        return report
+
+    async def _heartbeat(self, job_id: str):
+        # 单个阶段（例如一个窗口的 hi_res 解析）可能持续数分钟，期间定时写心跳，避免被其他进程当作中断任务；
+        # 同时检查其他进程发起的取消请求
+        while True:
+            await asyncio.sleep(PARSE_HEARTBEAT_INTERVAL)
+            try:
+                async for db in get_db():
+                    await touch_parse_job(db, job_id, self.worker_id)
+                    await self._check_cancel(job_id, db)
+            except Exception as e:
+                logger.error(f"解析任务心跳失败，job_id: {job_id}, 错误: {e}")
+
+    async def _worker(self, index: int):
+        while True:
+            _, _, job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"解析任务调度异常，job_id: {job_id}, 错误: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] != "queued":
+            return
+        async for db in get_db():
+            claimed = await claim_parse_job(db, job_id, self.worker_id)
+        if claimed is None:
+            # 已被其他进程领取，或已被取消
+            self._jobs.pop(job_id, None)
+            logger.info(f"解析任务已由其他进程领取或已取消，跳过，job_id: {job_id}")
+            return
+        job.update(_job_to_dict(claimed))
+        logger.info(f"开始执行解析任务，job_id: {job_id}, file_id: {job['fileId']}, 第 {job['attempts']} 次尝试")
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await asyncio.to_thread(run_full_parse_pipeline, job["fileId"], self._reporter(job_id))
+        except JobCancelled:
+            await self._finish(job_id, "cancelled")
+            logger.info(f"解析任务已取消，job_id: {job_id}")
+            return
+        except Exception as e:
+            job["error"] = str(e)[:1000]
+            if job_id in self._cancelled:
+                # 已被请求取消的任务失败后不再重试
+                await self._finish(job_id, "cancelled")
+                logger.info(f"解析任务已取消，job_id: {job_id}, 错误: {e}")
+            elif job["attempts"] < job["maxAttempts"]:
+                job.update({"status": "queued", "stage": None, "progress": 0})
+                await self._persist(job_id, worker=None)
+                logger.warning(f"解析任务失败，{PARSE_RETRY_DELAY} 秒后重试，job_id: {job_id}, 错误: {e}")
+                self._loop.call_later(PARSE_RETRY_DELAY, self._enqueue, job_id)
+            else:
+                await self._finish(job_id, "error")
+                logger.error(f"解析任务失败，job_id: {job_id}, 错误: {e}")
+            return
+        finally:
+            heartbeat.cancel()
+            self._cancelled.discard(job_id)
+        job.update({"stage": "done", "progress": 100})
+        await self._finish(job_id, "done")
+        # 叠框图已重新生成，清理旧的页面缓存
+        page_cache.invalidate(job["fileId"])
+        try:
+            async for db in get_db():
+                await update_file_parse_status(db, job["fileId"])
+        except Exception as e:
+            logger.error(f"数据库更新失败: {str(e)}", exc_info=True)
+        logger.info(f"解析任务完成，job_id: {job_id}, file_id: {job['fileId']}")
+
+scheduler = JobScheduler()
@@ -0,0 +1,161 @@
+# services/layout_worker.py
+from __future__ import annotations
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, List
+
+from .log_service import get_logger
+
+logger = get_logger('layout_worker')
+
+# 常驻布局/OCR 进程数，0 表示在调用方进程内直接解析
+LAYOUT_WORKERS = int(os.getenv("LAYOUT_WORKERS", 1))
+# 每个进程处理多少批次后重启，防止模型推理的内存泄漏持续累积（Python 3.11 以下按 进程数 x 该值 整体重建进程池）
+LAYOUT_WORKER_MAX_JOBS = int(os.getenv("LAYOUT_WORKER_MAX_JOBS", 50))
+# 每批提交给 worker 的页数
+LAYOUT_BATCH_PAGES = int(os.getenv("LAYOUT_BATCH_PAGES", 16))
+# 启动 worker 时是否预加载模型
+LAYOUT_WORKER_WARMUP = os.getenv("LAYOUT_WORKER_WARMUP", "true").lower() in ("1", "true", "yes")
+# unstructured 使用的 OCR 引擎（OCRAgent 完整类路径）。unstructured 默认是 tesseract，
+# 写回环境变量使 spawn 出的 worker 与按 OCR_AGENT 选择引擎的 unstructured 版本一致
+OCR_AGENT = os.environ.setdefault("OCR_AGENT", "unstructured.partition.utils.ocr_models.paddle_ocr.OCRAgentPaddle")
+# OCR 语言（tesseract 格式），解析与预热使用同一个值。PaddleOCR 只接受单一语言，
+# "chi_sim+eng" 会被 unstructured 退回为英文模型；其中文模型 ch 本身可识别中英混排
+OCR_LANGUAGES = "chi_sim" if OCR_AGENT.endswith(".OCRAgentPaddle") else "chi_sim+eng"
+
+def _ocr_language() -> str:
+    """
+    unstructured 调用 OCRAgent.get_instance 时使用的语言参数（PaddleOCR 先转换为 paddle 语言代码）。
+    get_instance 按 (引擎, 语言) 缓存实例，预热时参数一致，解析时才会复用同一个实例
+    """
+    from unstructured.partition.utils.constants import OCR_AGENT_PADDLE
+    if OCR_AGENT != OCR_AGENT_PADDLE:
+        return OCR_LANGUAGES
+    try:
+        from unstructured.partition.common.lang import tesseract_to_paddle_language
+    except ImportError:
+        from unstructured.partition.lang import tesseract_to_paddle_language
+    return tesseract_to_paddle_language(OCR_LANGUAGES)
+
+def _warmup():
+    """
+    worker 进程初始化：预加载布局检测模型与 OCR 模型。
+    两者在 unstructured 内部按进程缓存（OCR 经 OCRAgent.get_instance），之后同一进程内的所有批次直接复用
+    """
+    if not LAYOUT_WORKER_WARMUP:
+        return
+    try:
+        from unstructured_inference.models.base import get_model
+        get_model()
+        logger.info(f"布局检测模型加载完成，pid: {os.getpid()}")
+    except Exception as e:
+        logger.warning(f"预加载布局检测模型失败，将在首个批次时加载: {e}")
+    try:
+        from unstructured.partition.utils.ocr_models.ocr_interface import OCRAgent
+        language = _ocr_language()
+        OCRAgent.get_instance(OCR_AGENT, language)
+        logger.info(f"OCR模型加载完成，引擎: {OCR_AGENT.rsplit('.', 1)[-1]}, 语言: {language}, pid: {os.getpid()}")
+    except Exception as e:
+        logger.warning(f"预加载OCR模型失败，将在首个批次时加载: {e}")
+
+def partition_batch(pdf_path: str, kwargs: Dict[str, Any]) -> List[Any]:
+    """在 worker 进程中执行 partition_pdf，返回元素列表"""
+    from unstructured.partition.pdf import partition_pdf
+    return partition_pdf(filename=pdf_path, **kwargs)
+
+def table_structure_batch(pdf_path: str, regions: List[Any]) -> List[str]:
+    """在 worker 进程中对表格区域运行表格结构模型，返回各区域的 HTML"""
+    from .table_structure import infer_table_html
+    return infer_table_html(pdf_path, regions)
+
+def _shutdown_now(pool: ProcessPoolExecutor) -> None:
+    """不等待进程池退出；cancel_futures 需 Python 3.9+，更早的版本只能让已排队的任务执行完"""
+    if sys.version_info >= (3, 9):
+        pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        pool.shutdown(wait=False)
+
+class LayoutWorkerPool:
+    """常驻的布局/OCR 进程池：模型每个进程只加载一次，按批次接收页面"""
+    def __init__(self, workers: int = LAYOUT_WORKERS, max_jobs: int = LAYOUT_WORKER_MAX_JOBS):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self._pool: ProcessPoolExecutor | None = None
+        # 当前进程池已接收的任务数（Python 3.11 以下按此整体重建进程池）
+        self._tasks = 0
+        self._recycle_warned = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _get_pool(self, tasks: int) -> ProcessPoolExecutor:
+        """返回当前进程池并计入即将提交的任务数"""
+        with self._lock:
+            native_recycle = sys.version_info >= (3, 11)
+            if (self._pool is not None and not native_recycle and self.max_jobs > 0
+                    and self._tasks >= self.max_jobs * self.workers):
+                # 旧进程池处理完已提交的任务后自行退出，新任务交给新进程池
+                logger.info(f"布局解析进程池已处理 {self._tasks} 个任务，重建进程池以释放内存")
+                self._pool.shutdown(wait=False)
+                self._pool = None
+            if self._pool is None:
+                # spawn：避免 fork 多线程的服务进程；worker 只导入解析所需的模块
+                kwargs = dict(max_workers=self.workers, mp_context=get_context("spawn"), initializer=_warmup)
+                if native_recycle and self.max_jobs > 0:
+                    kwargs["max_tasks_per_child"] = self.max_jobs
+                elif self.max_jobs > 0 and not self._recycle_warned:
+                    self._recycle_warned = True
+                    logger.warning(f"Python {sys.version_info.major}.{sys.version_info.minor} 不支持 max_tasks_per_child，"
+                                   f"改为每 {self.max_jobs * self.workers} 个任务整体重建进程池")
+                self._pool = ProcessPoolExecutor(**kwargs)
+                self._tasks = 0
+                logger.info(f"布局解析进程池已启动，进程数: {self.workers}, 单进程最大批次: {self.max_jobs}")
+            self._tasks += tasks
+            return self._pool
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        # 只丢弃出错的那个进程池，其他线程可能已经换上了新的
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        _shutdown_now(pool)
+
+    def run_all(self, fn: Callable, calls: List[tuple]) -> List[Any]:
+        """
+        把每组参数提交给 fn 并按顺序返回结果。
+        worker 异常退出（如 OOM）时进程池整体损坏，BrokenProcessPool 在等待结果时抛出：
+        重建进程池后重新提交一次（解析批次可重复执行）
+        """
+        for attempt in (1, 2):
+            pool = self._get_pool(len(calls))
+            try:
+                futures = [pool.submit(fn, *args) for args in calls]
+                return [f.result() for f in futures]
+            except BrokenProcessPool:
+                self._discard(pool)
+                if attempt == 2:
+                    raise
+                logger.warning("布局解析进程池已损坏，重新创建后重试")
+
+    def partition(self, pdf_paths: List[str], kwargs: Dict[str, Any]) -> List[List[Any]]:
+        """并行解析多个批次（已抽取为独立 PDF 的页面），按顺序返回各批次的元素列表"""
+        return self.run_all(partition_batch, [(path, kwargs) for path in pdf_paths])
+
+    def table_html(self, pdf_path: str, regions: List[Any]) -> List[str]:
+        """表格结构识别（原始 PDF 与表格区域列表），返回各区域的 HTML"""
+        return self.run_all(table_structure_batch, [(pdf_path, regions)])[0]
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            _shutdown_now(pool)
+            logger.info("布局解析进程池已关闭")
+
+layout_pool = LayoutWorkerPool()
@@ -0,0 +1,111 @@
+# services/page_cache.py
+from __future__ import annotations
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Tuple
+
+from .log_service import get_logger
+from .ultis import dir_original_pages, dir_parsed_pages, has_parse_artifacts
+from .pdf_service import render_original_page, derive_parsed_page, page_image_name
+
+logger = get_logger('page_cache')
+
+# 内存缓存的字节预算
+PAGE_CACHE_MB = int(os.getenv("PAGE_CACHE_MB", 256))
+
+class PageImageCache:
+    """按字节预算淘汰的页面图片 LRU 缓存（线程安全）"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[Tuple, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple, count: bool = True) -> bytes | None:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += count
+                return None
+            self._items.move_to_end(key)
+            self.hits += count
+            return data
+
+    def put(self, key: Tuple, data: bytes) -> None:
+        # 单张超过预算的图片不进内存缓存，只走磁盘
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def invalidate(self, file_id: str) -> None:
+        """删除某个文件的全部缓存页面（重新解析后调用）"""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == file_id]:
+                self._bytes -= len(self._items.pop(key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"items": len(self._items), "bytes": self._bytes, "maxBytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+page_cache = PageImageCache(PAGE_CACHE_MB * 1024 * 1024)
+
+# 同一页面的并发首次请求只渲染一次：key -> [锁, 持有或等待该锁的请求数]，最后一个请求离开时才删除
+_render_locks: Dict[Tuple, list] = {}
+_render_locks_guard = threading.Lock()
+
+@contextmanager
+def _render_lock(key: Tuple):
+    with _render_locks_guard:
+        entry = _render_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _render_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _render_locks[key]
+
+def get_page_image(file_id: str, page: int, kind: str = "original",
+                   size: str = "screen", fmt: str = "png") -> bytes | None:
+    """
+    获取页面图片：内存 LRU → 磁盘 pages/<kind>/ → 按需生成
+    （原图从 original.pdf 渲染，解析图由 screen 叠框图缩放转码）。
+    页面不存在或解析图尚未生成时返回 None
+    """
+    key = (file_id, kind, page, size, fmt)
+    data = page_cache.get(key)
+    if data is not None:
+        return data
+    if not has_parse_artifacts(file_id):
+        return None
+    with _render_lock(key):
+        # 等锁期间可能已被其他请求渲染完成
+        data = page_cache.get(key, count=False)
+        if data is not None:
+            return data
+        base = dir_original_pages(file_id) if kind == "original" else dir_parsed_pages(file_id)
+        img = base / page_image_name(page, size, fmt)
+        if img.exists():
+            data = img.read_bytes()
+        elif kind == "original":
+            data = render_original_page(file_id, page, size, fmt)
+        else:
+            data = derive_parsed_page(file_id, page, size, fmt)
+        if data is not None:
+            page_cache.put(key, data)
+        return data
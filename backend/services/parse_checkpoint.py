@@ -0,0 +1,75 @@
+# services/parse_checkpoint.py
+from __future__ import annotations
+import os
+import json
+import threading
+from typing import Dict, Any, Iterable
+
+from .log_service import get_logger
+from .ultis import checkpoint_path
+
+logger = get_logger('parse_checkpoint')
+
+# 解析流程中按页记录完成情况的阶段
+PARSE_STAGES = ("render_original", "layout", "overlay", "images", "markdown")
+
+class ParseCheckpoint:
+    """
+    解析检查点：记录每个阶段已完成的页码，保存在 <fileId>/checkpoint.json。
+    重启或重试的解析从最后完成的单元继续；页数或窗口大小变化、或上一次解析已完整结束时从头开始
+    """
+    def __init__(self, file_id: str, page_count: int, window_pages: int):
+        self.file_id = file_id
+        self.path = checkpoint_path(file_id)
+        self._lock = threading.Lock()
+        self.state: Dict[str, Any] = self._fresh(page_count, window_pages)
+        self.resumed = False
+        try:
+            saved = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"解析检查点损坏，从头开始，file_id: {file_id}, 错误: {e}")
+            return
+        if (not saved.get("done") and saved.get("pageCount") == page_count
+                and saved.get("windowPages") == window_pages):
+            self.state = saved
+            self.resumed = any(saved.get("stages", {}).values())
+
+    @staticmethod
+    def _fresh(page_count: int, window_pages: int) -> Dict[str, Any]:
+        return {
+            "pageCount": page_count,
+            "windowPages": window_pages,
+            "stages": {stage: [] for stage in PARSE_STAGES},
+            "done": False,
+        }
+
+    def completed(self, stage: str, pages: Iterable[int]) -> bool:
+        """这些页面在该阶段是否都已完成"""
+        done = set(self.state["stages"].get(stage, []))
+        return all(p in done for p in pages)
+
+    def mark(self, stage: str, pages: Iterable[int]) -> None:
+        """记录页面在该阶段完成，并立即落盘"""
+        with self._lock:
+            done = set(self.state["stages"].setdefault(stage, []))
+            done.update(pages)
+            self.state["stages"][stage] = sorted(done)
+            self._save()
+
+    def finish(self) -> None:
+        """整份文档解析完成；之后再次提交解析时从头开始"""
+        with self._lock:
+            self.state["done"] = True
+            self._save()
+
+    def summary(self) -> Dict[str, int]:
+        """各阶段已完成的页数"""
+        return {stage: len(pages) for stage, pages in self.state["stages"].items()}
+
+    def _save(self) -> None:
+        # 先写临时文件再替换，进程在写入中途退出也不会留下半截检查点
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(self.state, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
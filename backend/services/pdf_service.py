@@ -1,21 +1,29 @@
 # services/pdf_service.py
 from __future__ import annotations
-import os, io, math, json
+import os, io, gc, math, json, shutil, hashlib, tempfile
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, BinaryIO, Tuple, Callable
 import fitz
 import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-import matplotlib
-matplotlib.use("Agg")  # 服务器无头
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
-from langchain_unstructured import UnstructuredLoader
 from unstructured.partition.pdf import partition_pdf
+from unstructured.documents import elements as us_elements
+from unstructured.documents.elements import ElementMetadata
+from unstructured.documents.coordinates import PixelSpace
 from html2text import html2text
 from .log_service import get_logger, info, warning, error, log_exception
-from .ultis import workdir, dir_original_pages, original_pdf_path,markdown_path,dir_parsed_pages
+from .layout_worker import layout_pool, LAYOUT_BATCH_PAGES, OCR_AGENT, OCR_LANGUAGES
+from .render_worker import (
+    RENDER_WORKERS, render_pool, _page_pixmap, _render_page_range, _render_overlay_pages, _draw_boxes, _write_atomic,
+    CATEGORY_TO_COLOR, DEFAULT_BOX_COLOR,
+)
+from .table_structure import apply_table_structure, TABLE_STRUCTURE_MODE
+from .parse_checkpoint import ParseCheckpoint
+from . import segment_store
+from .revision_service import load_revision
+from .ultis import workdir, dir_original_pages, original_pdf_path,markdown_path,dir_parsed_pages,incoming_dir,markdown_parts_dir
 # 初始化logger
 logger = get_logger('pdf_service')
 
@@ -29,297 +37,685 @@ def images_dir(file_id: str) -> Path:
     logger.info(f"创建图片目录 {p}")
     return p
 
-def save_upload(file_id: str, upload_bytes: bytes, filename: str) -> Dict[str, Any]:
-    """保存上传的 PDF，并返回页数"""
+# 流式上传每次读取的块大小与单文件大小上限
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 1024)) * 1024 * 1024
+
+class UploadTooLarge(Exception):
+    """上传文件超过 MAX_UPLOAD_MB 限制"""
+
+def stream_upload(fileobj: BinaryIO, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[Path, str, int]:
+    """
+    按固定块大小把上传流写入暂存文件，同时计算 SHA-256。
+    内存占用与文件大小无关；超过大小限制时删除暂存文件并抛出 UploadTooLarge。
+    返回 (暂存文件路径, 内容哈希, 字节数)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(suffix=".part", dir=incoming_dir())
+    tmp_path = Path(tmp)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"文件超过大小限制 {max_bytes} 字节")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    logger.info(f"上传流写入完成，暂存文件: {tmp_path}, 大小: {size} 字节")
+    return tmp_path, digest.hexdigest(), size
+
+def save_streamed_upload(file_id: str, tmp_path: Path, filename: str, digest: str) -> Dict[str, Any]:
+    """把 stream_upload 写好的暂存文件移动到工作目录，再用 fitz 读取页数"""
     try:
-        logger.info(f"保存上传的PDF文件: {filename}, file_id: {file_id}")
-        # 根据文件的id保存
+        logger.info(f"保存流式上传的PDF文件: {filename}, file_id: {file_id}")
         pdf_path = original_pdf_path(file_id)
-        # 将文件的二进制写入到文件中，实现保存
-        pdf_path.write_bytes(upload_bytes)
+        os.replace(tmp_path, pdf_path)
         # 获取文件的页数
         with fitz.open(pdf_path) as doc:
             pages = doc.page_count
     except Exception as e:
-        logger.error(f"保存上传的PDF文件失败: {filename}, file_id: {file_id}, 错误: {e}")
+        logger.error(f"保存流式上传的PDF文件失败: {filename}, file_id: {file_id}, 错误: {e}")
         raise e
     logger.info(f"PDF保存成功，页数: {pages}")
-    return {"fileId": file_id, "name": filename, "pages": pages}
+    return {"fileId": file_id, "name": filename, "pages": pages, "contentHash": digest}
+
+# 解析时是否预先渲染全部原始页面；关闭时由 /pdf/page 首次访问时按需渲染
+EAGER_RENDER_PAGES = os.getenv("EAGER_RENDER_PAGES", "false").lower() in ("1", "true", "yes")
+# 少于该页数时不启动进程池，避免进程启动开销大于收益
+RENDER_PARALLEL_MIN_PAGES = int(os.getenv("RENDER_PARALLEL_MIN_PAGES", 8))
+
+# 页面图片金字塔：尺寸名 -> 渲染 DPI（screen 与原有 144 DPI 页面一致）
+PAGE_SIZES = {"thumb": 36, "screen": 144, "zoom": 288}
+PAGE_FORMATS = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+PAGE_WEBP_QUALITY = int(os.getenv("PAGE_WEBP_QUALITY", 80))
+PAGE_JPEG_QUALITY = int(os.getenv("PAGE_JPEG_QUALITY", 85))
 
-def render_original_pages(file_id: str, dpi: int = 144):
-    """把原始 PDF 渲染为 PNG，存到 pages/original/"""
-    logger.info(f"开始渲染原始PDF页面，file_id: {file_id}, dpi: {dpi}")
+def page_image_name(page_number: int, size: str = "screen", fmt: str = "png") -> str:
+    """页面图片文件名：screen/png 保持 page-XXXX.png，其余为 page-XXXX-<size>.<ext>"""
+    if size == "screen" and fmt == "png":
+        return f"page-{page_number:04d}.png"
+    return f"page-{page_number:04d}-{size}.{'jpg' if fmt == 'jpeg' else fmt}"
+
+def encode_page_image(img: Image.Image, fmt: str) -> bytes:
+    """把页面位图编码为 png / webp / jpeg"""
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, "WEBP", quality=PAGE_WEBP_QUALITY, method=4)
+    elif fmt == "jpeg":
+        img.save(buf, "JPEG", quality=PAGE_JPEG_QUALITY, optimize=True)
+    else:
+        img.save(buf, "PNG")
+    return buf.getvalue()
+
+def render_original_page(file_id: str, page_number: int, size: str = "screen", fmt: str = "png") -> bytes | None:
+    """
+    按需渲染单页原图（1 基页码）的指定尺寸与格式，写入 pages/original/ 并返回图片字节；
+    页码越界返回 None
+    """
+    pdf_path = original_pdf_path(file_id)
+    with fitz.open(pdf_path) as doc:
+        if page_number < 1 or page_number > doc.page_count:
+            return None
+        pix = _page_pixmap(doc.load_page(page_number - 1), PAGE_SIZES[size])
+        if fmt == "png":
+            data = pix.tobytes("png")
+        else:
+            data = encode_page_image(Image.frombytes("RGB", [pix.width, pix.height], pix.samples), fmt)
+    _write_atomic(dir_original_pages(file_id) / page_image_name(page_number, size, fmt), data)
+    logger.info(f"按需渲染原始页面完成，file_id: {file_id}, 页码: {page_number}, 尺寸: {size}, 格式: {fmt}")
+    return data
+
+def derive_parsed_page(file_id: str, page_number: int, size: str = "screen", fmt: str = "png") -> bytes | None:
+    """
+    由 screen 尺寸的叠框图缩放/转码得到其他尺寸与格式（zoom 不放大，保持 screen 分辨率），
+    叠框图缺失但已有该页的布局段时从布局段重新绘制，尚未解析时返回 None
+    """
+    out_dir = dir_parsed_pages(file_id)
+    src = out_dir / page_image_name(page_number)
+    if not src.exists() and not render_parsed_page_from_segments(file_id, page_number):
+        return None
+    if size == "screen" and fmt == "png":
+        return src.read_bytes()
+    with Image.open(src) as img:
+        img = img.convert("RGB")
+        scale = min(1.0, PAGE_SIZES[size] / PAGE_SIZES["screen"])
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        data = encode_page_image(img, fmt)
+    _write_atomic(out_dir / page_image_name(page_number, size, fmt), data)
+    return data
+
+def _split_page_ranges(page_count: int, parts: int) -> List[tuple]:
+    """把页码切分为 parts 个连续区间，返回 [(start, end), ...]"""
+    parts = max(1, min(parts, page_count))
+    size = math.ceil(page_count / parts)
+    return [(s, min(s + size, page_count)) for s in range(0, page_count, size)]
+
+def render_original_pages(file_id: str, dpi: int = 144, workers: int | None = None,
+                          page_numbers: List[int] | None = None):
+    """
+    把原始 PDF 渲染为 PNG，存到 pages/original/
+    page_numbers 为连续的页码区间（1 基）时只渲染这些页面，默认渲染全部页面；
+    workers > 1 时按页码区间拆分到共用的渲染进程池并行渲染，输出文件名与串行模式一致
+    """
+    workers = RENDER_WORKERS if workers is None else workers
+    logger.info(f"开始渲染原始PDF页面，file_id: {file_id}, dpi: {dpi}, workers: {workers}")
     try:
         # 获取原文档路径
-        pdf_path = original_pdf_path(file_id)
+        pdf_path = str(original_pdf_path(file_id))
         # 创建PNG的输出路径
-        out_dir = dir_original_pages(file_id)
-        # 读取原文档并进行遍历
+        out_dir = str(dir_original_pages(file_id))
         with fitz.open(pdf_path) as doc:
-            for idx, page in enumerate(doc, start=1):
-                try:
-                    # 比例缩放
-                    mat = fitz.Matrix(dpi/72, dpi/72)
-                    # 使用指定的变换矩阵将 PDF 页面渲染为像素图
-                    pix = page.get_pixmap(matrix=mat)
-                    
-                    # 处理颜色空间
-                    if pix.alpha and pix.n > 3:
-                        # 如果有alpha通道，先移除
-                        pix = fitz.Pixmap(pix, 0)
-                    # 确保转换为RGB
-                    if pix.colorspace.n != fitz.csRGB.n:
-                        pix = fitz.Pixmap(fitz.csRGB, pix)
-                    
-                    # 保存图片
-                    (out_dir / f"page-{idx:04d}.png").write_bytes(pix.tobytes("png"))
-                except Exception as e:
-                    logger.warning(f"渲染页面 {idx} 失败: {e}", exc_info=True)
+            first, last = (page_numbers[0], page_numbers[-1]) if page_numbers else (1, doc.page_count)
+        page_count = last - first + 1
+        if workers <= 1 or page_count < RENDER_PARALLEL_MIN_PAGES:
+            rendered = _render_page_range(pdf_path, out_dir, first - 1, last, dpi)
+        else:
+            ranges = [(start + first - 1, end + first - 1) for start, end in _split_page_ranges(page_count, workers)]
+            rendered = sum(render_pool.run_all(
+                _render_page_range, [(pdf_path, out_dir, start, end, dpi) for start, end in ranges]))
     except Exception as e:
         logger.error(f"渲染原始PDF页面失败: {file_id}, 错误: {e}")
         raise e
-    logger.info(f"原始PDF页面渲染完成，file_id: {file_id}")
+    logger.info(f"原始PDF页面渲染完成，file_id: {file_id}, 页数: {rendered}/{page_count}")
 
-def _plot_boxes_to_ax(ax, pix, segments):
+def _segment_meta(el: Any) -> Dict[str, Any]:
     """
-    在 matplotlib 轴上绘制解析后的文本区域边界框
+    统一布局元素的 metadata 为字典：兼容 partition_pdf 的 Element、
+    UnstructuredLoader 的 Document 以及普通 dict
     """
-    try:
-        # 根据不同的元素类型设置不同的框线颜色
-        category_to_color = {
-            "Title": "orchid",
-            "Image": "forestgreen",
-            "Table": "tomato",
-            # "List": "gold",
-            # "Header": "purple",
-            # "Footer": "blue",
-            # "Caption": "orange"
-        }
-        # 遍历所有文本区域并绘制边界框
-        categories = set()
-        for seg in segments:
-            # 原始坐标点
-            points = seg["coordinates"]["points"]
-            # 原始布局的宽度和高度
-            lw = seg["coordinates"]["layout_width"]
-            lh = seg["coordinates"]["layout_height"]
-            # 转换公式：x_image = x_original * (pix.width / layout_width)
-            scaled = [(x * pix.width / lw, y * pix.height / lh) for x, y in points]
-            # 获取颜色
-            category = seg.get("category", "Text")
-            color = category_to_color.get(category, "deepskyblue")
-            categories.add(category)
-            # 绘制多边形边界框
-            poly = patches.Polygon(scaled, linewidth=1, edgecolor=color, facecolor="none")
-            ax.add_patch(poly)
-            # 添加文本标签
-            ax.text(
-                scaled[0][0], scaled[0][1], category,
-                fontsize=8, color=color, transform=ax.transData
-            )
-    except Exception as e:
-        logger.error(f"绘制解析页面边界框失败，错误: {e}")
-        raise
-    # 创建图例，显示所有检测到的类别
-    legend_handles = []
-    # 先添加默认的 "Text" 类别（如果有）
-    if "Text" in categories:
-        legend_handles.append(patches.Patch(color="deepskyblue", label="Text"))
-    # 然后添加其他自定义类别的图例
-    for cat, color in category_to_color.items():
-        if cat in categories:
-            legend_handles.append(patches.Patch(color=color, label=cat))
-    # 只有当有图例时才添加
-    if legend_handles:
-        ax.legend(handles=legend_handles, loc="upper right", fontsize=8)
-
-def render_parsed_pages_with_boxes(file_id: str, docs_local: List[Dict[str, Any]], dpi: int = 144):
+    meta = el.metadata if hasattr(el, "metadata") else el["metadata"]
+    if not isinstance(meta, dict):
+        # unstructured 的 ElementMetadata，转换为与 UnstructuredLoader 一致的字典结构
+        meta = meta.to_dict()
+        category = getattr(el, "category", None)
+        if category:
+            meta["category"] = category
+    return meta
+
+def render_parsed_pages_with_boxes(file_id: str, docs_local: List[Any], dpi: int = 144, workers: int | None = None,
+                                   page_numbers: List[int] | None = None):
     """
-    根据 UnstructuredLoader 的 metadata（含坐标）在原图上叠框，输出到 pages/parsed/
+    根据布局元素的 metadata（含坐标）在原图上叠框，输出到 pages/parsed/
+    page_numbers 指定只渲染的页码（窗口化解析时使用），默认渲染全部页面；
+    workers > 1 时按页拆分到共用的渲染进程池并行绘制
     """
-    logger.info(f"开始渲染解析页面边界框，file_id: {file_id}, dpi: {dpi}")
+    workers = RENDER_WORKERS if workers is None else workers
+    logger.info(f"开始渲染解析页面边界框，file_id: {file_id}, dpi: {dpi}, workers: {workers}")
     try:
         # 获取原档路径
-        pdf_path = original_pdf_path(file_id)
-        # 叠框PDF输出路径
-        out_dir = dir_parsed_pages(file_id)
-        # 加载原文档
+        pdf_path = str(original_pdf_path(file_id))
+        # 原图目录与叠框图输出路径
+        original_dir = str(dir_original_pages(file_id))
+        out_dir = str(dir_parsed_pages(file_id))
         with fitz.open(pdf_path) as doc:
-            # 预聚合：按 page_number 分组 segments，按页码分组元数据
-            segments_by_page: Dict[int, List[Dict[str, Any]]] = {}
-            for d in docs_local:
-                meta = d.metadata if hasattr(d, "metadata") else d["metadata"]
-                pno = meta.get("page_number")
-                if pno is None: continue
-                segments_by_page.setdefault(pno, []).append(meta)
-
-            for page_number in range(1, doc.page_count + 1):
-                try:
-                    page = doc.load_page(page_number - 1)
-                    # 原文档缩放
-                    mat = fitz.Matrix(dpi/72, dpi/72)
-                    pix = page.get_pixmap(matrix=mat)
-                    
-                    # 处理颜色空间
-                    if pix.alpha and pix.n > 3:
-                        # 如果有alpha通道，先移除
-                        pix = fitz.Pixmap(pix, 0)
-                    # 确保转换为RGB
-                    if pix.colorspace.n != fitz.csRGB.n:
-                        pix = fitz.Pixmap(fitz.csRGB, pix)
-                    
-                    # 转换为 PIL Image 对象用于 matplotlib 显示
-                    pil = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    # 创建 matplotlib 图形并显示原始图像
-                    fig, ax = plt.subplots(1, figsize=(10, 10))
-                    ax.imshow(pil)
-                    ax.axis("off")
-                    # 绘制文本区域框
-                    _plot_boxes_to_ax(ax, pix, segments_by_page.get(page_number, []))
-                    fig.tight_layout()
-                    # 保存并清理fig
-                    fig.savefig(out_dir / f"page-{page_number:04d}.png", bbox_inches="tight", pad_inches=0)
-                    plt.close(fig)
-                    logger.info(f"解析页面 {page_number} 完成，file_id: {file_id}")
-                except Exception as e:
-                    logger.warning(f"渲染解析页面 {page_number} 失败: {e}", exc_info=True)
+            if page_numbers is None:
+                page_numbers = list(range(1, doc.page_count + 1))
+        page_count = len(page_numbers)
+        # 清理由旧叠框图派生的其他尺寸/格式，之后按需重新生成
+        for pno in page_numbers:
+            for stale in Path(out_dir).glob(f"page-{pno:04d}-*.*"):
+                stale.unlink(missing_ok=True)
+        # 预聚合：按 page_number 分组 segments，只保留绘制需要的字段
+        segments_by_page: Dict[int, List[Dict[str, Any]]] = {}
+        for d in docs_local:
+            meta = _segment_meta(d)
+            pno = meta.get("page_number")
+            coords = meta.get("coordinates")
+            if pno is None or not coords: continue
+            segments_by_page.setdefault(pno, []).append({
+                "category": meta.get("category", "Text"),
+                "coordinates": {
+                    "points": coords["points"],
+                    "layout_width": coords["layout_width"],
+                    "layout_height": coords["layout_height"],
+                },
+            })
+        pages = [(pno, segments_by_page.get(pno, [])) for pno in page_numbers]
+        if workers <= 1 or page_count < RENDER_PARALLEL_MIN_PAGES:
+            rendered = _render_overlay_pages(pdf_path, original_dir, out_dir, pages, dpi)
+        else:
+            ranges = _split_page_ranges(page_count, workers)
+            rendered = sum(render_pool.run_all(
+                _render_overlay_pages, [(pdf_path, original_dir, out_dir, pages[start:end], dpi) for start, end in ranges]))
     except Exception as e:
         logger.error(f"渲染解析页面整体失败，file_id: {file_id}, 错误: {e}")
         raise e
+    logger.info(f"解析页面渲染完成，file_id: {file_id}, 页数: {rendered}/{page_count}")
+
+def render_parsed_page_from_segments(file_id: str, page_number: int) -> bool:
+    """用已保存的布局段重新绘制单页叠框图（无需重新 OCR），该页没有布局段时返回 False"""
+    segments = segment_store.load_page(file_id, page_number)
+    if segments is None:
+        return False
+    original = dir_original_pages(file_id) / page_image_name(page_number)
+    if original.exists():
+        img = Image.open(original).convert("RGB")
+    else:
+        with fitz.open(original_pdf_path(file_id)) as doc:
+            pix = _page_pixmap(doc.load_page(page_number - 1), PAGE_SIZES["screen"])
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    slim = [{
+        "category": seg["category"],
+        "coordinates": {
+            "points": seg["points"],
+            "layout_width": seg["layoutWidth"],
+            "layout_height": seg["layoutHeight"],
+        },
+    } for seg in segments if seg["points"]]
+    _write_atomic(dir_parsed_pages(file_id) / page_image_name(page_number), encode_page_image(_draw_boxes(img, slim), "png"))
+    logger.info(f"由布局段重新绘制叠框页面，file_id: {file_id}, 页码: {page_number}")
+    return True
+
+# 窗口化解析：每次处理的页数，<=0 时整份文档作为一个窗口
+PARSE_WINDOW_PAGES = int(os.getenv("PARSE_WINDOW_PAGES", 50))
+
+# 按页选择解析策略：有可用文本层的页面走 fitz 快速提取，扫描页/表格页才走 hi_res OCR
+PAGE_ROUTING = os.getenv("PAGE_ROUTING", "true").lower() in ("1", "true", "yes")
+# 文本层至少包含的非空白字符数
+FAST_TEXT_MIN_CHARS = int(os.getenv("FAST_TEXT_MIN_CHARS", 50))
+# 图片覆盖页面面积超过该比例时视为扫描页
+FAST_TEXT_MAX_IMAGE_RATIO = float(os.getenv("FAST_TEXT_MAX_IMAGE_RATIO", 0.5))
+# 字体大小超过正文字号该倍数的短文本块视为标题
+FAST_TITLE_FONT_RATIO = float(os.getenv("FAST_TITLE_FONT_RATIO", 1.25))
+
+def _classify_page(page) -> str:
+    """判断页面类型：text（可直接提取文本层）| scanned（需 OCR）| table（含表格，需表格结构识别）"""
+    text = page.get_text("text")
+    chars = sum(1 for c in text if not c.isspace())
+    # 文本层过少，或大量乱码（无法映射的字形）时按扫描页处理
+    if chars < FAST_TEXT_MIN_CHARS or text.count("�") > chars * 0.1:
+        return "scanned"
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(img_info["bbox"]) & page.rect) for img_info in page.get_image_info())
+    if image_area / page_area > FAST_TEXT_MAX_IMAGE_RATIO:
+        return "scanned"
+    # 表格页交给 hi_res 以获得 text_as_html；旧版 PyMuPDF 没有 find_tables 时跳过检测
+    try:
+        if page.find_tables().tables:
+            return "table"
+    except AttributeError:
+        pass
+    return "text"
+
+def classify_pages(file_id: str, page_numbers: List[int] | None = None) -> Dict[int, str]:
+    """预扫描页面（默认全部页面），返回 {页码(1 基): 页面类型}"""
+    with fitz.open(original_pdf_path(file_id)) as doc:
+        if page_numbers is None:
+            page_numbers = list(range(1, doc.page_count + 1))
+        kinds = {pno: _classify_page(doc.load_page(pno - 1)) for pno in page_numbers}
+    stats = {k: sum(1 for v in kinds.values() if v == k) for k in ("text", "scanned", "table")}
+    logger.info(f"页面分类完成，file_id: {file_id}, 统计: {stats}")
+    return kinds
+
+def _text_layer_elements(page, page_number: int) -> List[Any]:
+    """
+    从 fitz 文本层直接构造 unstructured 元素（Title / NarrativeText / Image），
+    坐标与 hi_res 结果同样使用 PixelSpace，叠框渲染和 Markdown 导出无需区分来源
+    """
+    system = PixelSpace(width=page.rect.width, height=page.rect.height)
+    blocks = page.get_text("dict")["blocks"]
+    # 以字符数加权的众数字号作为正文字号
+    size_chars: Dict[float, int] = {}
+    for b in blocks:
+        for line in b.get("lines", []):
+            for span in line["spans"]:
+                size = round(span["size"], 1)
+                size_chars[size] = size_chars.get(size, 0) + len(span["text"].strip())
+    body_size = max(size_chars, key=size_chars.get) if size_chars else 0
+
+    out = []
+    for b in blocks:
+        x0, y0, x1, y1 = b["bbox"]
+        coordinates = ((x0, y0), (x0, y1), (x1, y1), (x1, y0))
+        metadata = ElementMetadata(page_number=page_number)
+        if b["type"] == 1:
+            out.append(us_elements.Image(text="", coordinates=coordinates, coordinate_system=system, metadata=metadata))
+            continue
+        lines = ["".join(span["text"] for span in line["spans"]).strip() for line in b.get("lines", [])]
+        text = "\n".join(l for l in lines if l)
+        if not text:
+            continue
+        max_size = max(span["size"] for line in b["lines"] for span in line["spans"])
+        is_title = body_size and max_size >= body_size * FAST_TITLE_FONT_RATIO and len(lines) <= 2 and len(text) < 100
+        cls = us_elements.Title if is_title else us_elements.NarrativeText
+        out.append(cls(text=text.replace("\n", " ") if is_title else text,
+                       coordinates=coordinates, coordinate_system=system, metadata=metadata))
+    return out
+
+def _page_span(page_numbers: List[int] | None) -> str:
+    """页码列表的简短描述，用于日志"""
+    if not page_numbers:
+        return "全部"
+    return f"{page_numbers[0]}-{page_numbers[-1]}"
+
+def _write_subset_pdf(pdf_path: str, pages: List[int]) -> str:
+    """把指定页面（1 基页码）抽取为与原文档同目录的临时 PDF，返回其路径"""
+    fd, subset_path = tempfile.mkstemp(suffix=".pdf", dir=Path(pdf_path).parent)
+    os.close(fd)
+    with fitz.open(pdf_path) as src, fitz.open() as subset:
+        for pno in pages:
+            subset.insert_pdf(src, from_page=pno - 1, to_page=pno - 1)
+        subset.save(subset_path)
+    return subset_path
 
-def unstructured_segments(file_id: str) -> List[Any]:
-    """用 UnstructuredLoader 产生高分辨率布局段"""
+def _remap_pages(out: List[Any], pages: List[int], pdf_path: str) -> List[Any]:
+    """把临时 PDF 的解析结果页码映射回原文档"""
+    for el in out:
+        if el.metadata.page_number is not None:
+            el.metadata.page_number = pages[el.metadata.page_number - 1]
+        el.metadata.filename = Path(pdf_path).name
+    return out
+
+def _partition_hi_res(pdf_path: str, pages: List[int] | None = None) -> List[Any]:
+    """
+    对指定页面（1 基页码，None 为整份文档）执行 hi_res 布局检测 + OCR。
+    启用常驻进程池时按 LAYOUT_BATCH_PAGES 分批抽取为临时 PDF 并行提交；
+    否则在当前进程内解析，只解析部分页面时同样先抽取为临时 PDF，再把页码映射回原文档。
+    TABLE_STRUCTURE_MODE=selective 时这一阶段只做布局检测，表格结构在之后只对 Table 区域单独识别
+    """
+    kwargs = dict(
+        infer_table_structure=TABLE_STRUCTURE_MODE == "full",
+        strategy="hi_res",
+        ocr_languages=OCR_LANGUAGES,
+        # OCR 引擎由 ocr_agent（或环境变量 OCR_AGENT）决定，默认 PaddleOCR；装不上时设置 OCR_AGENT 为 tesseract
+        ocr_agent=OCR_AGENT,
+    )
+    if pages is None and not layout_pool.enabled:
+        out = partition_pdf(filename=pdf_path, **kwargs)
+    else:
+        out = _partition_batches(pdf_path, pages, kwargs)
+    if TABLE_STRUCTURE_MODE == "selective":
+        out = apply_table_structure(pdf_path, out, layout_pool)
+    return out
+
+def _partition_batches(pdf_path: str, pages: List[int] | None, kwargs: Dict[str, Any]) -> List[Any]:
+    if pages is None:
+        with fitz.open(pdf_path) as doc:
+            pages = list(range(1, doc.page_count + 1))
+    if not pages:
+        return []
+    size = LAYOUT_BATCH_PAGES if layout_pool.enabled else len(pages)
+    batches = [pages[i:i + size] for i in range(0, len(pages), size)]
+    subset_paths = []
+    try:
+        for batch in batches:
+            subset_paths.append(_write_subset_pdf(pdf_path, batch))
+        if layout_pool.enabled:
+            results = layout_pool.partition(subset_paths, kwargs)
+        else:
+            results = [partition_pdf(filename=path, **kwargs) for path in subset_paths]
+    finally:
+        for path in subset_paths:
+            Path(path).unlink(missing_ok=True)
+    out = []
+    for batch, result in zip(batches, results):
+        out.extend(_remap_pages(result, batch, pdf_path))
+    return out
+
+def unstructured_segments(file_id: str, page_numbers: List[int] | None = None) -> List[Any]:
+    """
+    对整份文档（或 page_numbers 指定的页面）执行一次布局解析，返回按页排序的元素列表。
+    开启 PAGE_ROUTING 时先按页分类：文本层页面直接用 fitz 提取，只有扫描页/表格页走 hi_res OCR。
+    叠框渲染与 Markdown 导出共用同一份结果，避免重复解析
+    """
     try:
-        logger.info(f"开始使用UnstructuredLoader解析PDF，file_id: {file_id}")
+        logger.info(f"开始解析PDF布局，file_id: {file_id}, 按页路由: {PAGE_ROUTING}, 页面: {_page_span(page_numbers)}")
         # 获取原文档路径
         pdf_path = str(original_pdf_path(file_id))
-        # 使用paddleocr进行解析
-        loader = UnstructuredLoader(
-            file_path=pdf_path,
-            strategy="hi_res",
-            infer_table_structure=True,
-            ocr_languages="chi_sim+eng",    
-        ocr_engine="paddleocr",  # 如果装不上可换成 'auto' 或注释掉
-        )
-        out = []
-
-        for d in loader.lazy_load():
-            out.append(d)
-        logger.info(f"UnstructuredLoader解析完成，file_id: {file_id}, 生成段数: {len(out)}")
+        if not PAGE_ROUTING:
+            out = _partition_hi_res(pdf_path, page_numbers)
+        else:
+            kinds = classify_pages(file_id, page_numbers)
+            ocr_pages = [pno for pno, kind in kinds.items() if kind != "text"]
+            # 需要 OCR 的页面一次性交给 hi_res，其余页面走文本层快速通道
+            by_page: Dict[int, List[Any]] = {}
+            whole_doc = page_numbers is None and len(ocr_pages) == len(kinds)
+            for el in _partition_hi_res(pdf_path, None if whole_doc else ocr_pages):
+                by_page.setdefault(el.metadata.page_number, []).append(el)
+            with fitz.open(pdf_path) as doc:
+                for pno, kind in kinds.items():
+                    if kind == "text":
+                        by_page[pno] = _text_layer_elements(doc.load_page(pno - 1), pno)
+            out = [el for pno in sorted(by_page, key=lambda p: (p is None, p or 0)) for el in by_page[pno]]
+        logger.info(f"布局解析完成，file_id: {file_id}, 生成段数: {len(out)}")
     except Exception as e:
-        logger.error(f"UnstructuredLoader解析失败，file_id: {file_id}, 错误: {e}")
+        logger.error(f"布局解析失败，file_id: {file_id}, 错误: {e}")
         raise
     return out
 
-def pdf_to_markdown(file_id: str):
-    """将PDF文档转为MD"""
-    logger.info(f"开始PDF转Markdown，file_id: {file_id}")
-    # 获取源文件路径
+# 图片编码（PNG 压缩/写盘）的线程数；解码仍在调用线程中进行（PyMuPDF 非线程安全）
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 4))
+
+def _image_name(doc, xref: int, smask: int) -> str:
+    """按图片原始数据流（含软蒙版）的内容哈希命名，同一图片在所有页面、所有窗口共用一个文件"""
+    h = hashlib.sha256(doc.xref_stream_raw(xref) or b"")
+    if smask:
+        h.update(doc.xref_stream_raw(smask) or b"")
+    return f"img-{h.hexdigest()[:20]}"
+
+def _decode_image(doc, xref: int, smask: int, filter_name: str) -> Tuple[str, Any]:
+    """
+    解码图片：无蒙版的 RGB/灰度 JPEG 直接返回原始字节 ("jpg", bytes)，
+    其余转换为 PIL 位图 ("png", Image)，交给线程池编码
+    """
+    if filter_name == "DCTDecode" and not smask:
+        extracted = doc.extract_image(xref)
+        if extracted.get("ext") == "jpeg" and extracted.get("colorspace") in (1, 3):
+            return "jpg", extracted["image"]
+    pix = fitz.Pixmap(doc, xref)
+    if pix.n - pix.alpha not in (1, 3):
+        # CMYK 等颜色空间转换为 RGB（转换前先去掉 alpha 通道）
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if smask and not pix.alpha:
+        try:
+            pix = fitz.Pixmap(pix, fitz.Pixmap(doc, smask))
+        except Exception as e:
+            logger.warning(f"合成图片软蒙版失败，忽略蒙版，xref: {xref}, 错误: {e}")
+    mode = ("L" if pix.n - pix.alpha == 1 else "RGB") + ("A" if pix.alpha else "")
+    return "png", Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+def _write_image(path: Path, kind: str, payload: Any) -> None:
+    if kind == "png":
+        buf = io.BytesIO()
+        payload.save(buf, "PNG")
+        payload = buf.getvalue()
+    _write_atomic(path, payload)
+
+def extract_page_images(file_id: str, page_numbers: List[int] | None = None, save: bool = True,
+                        reuse_dir: Path | None = None) -> Dict[int, List[str]]:
+    """
+    提取页面中的图片到 images/，返回 {页码: [图片文件名, ...]}。
+    图片按内容哈希去重：同一 xref 只解码一次，已存在的文件不再写入，Markdown 引用共享文件；
+    reuse_dir 中已有同名文件时直接复制（修订版本复用基础版本的图片）；
+    save=False 时只返回文件名（图片已在之前的解析中提取）
+    """
     pdf_path = str(original_pdf_path(file_id))
-    # MD文件输出路径
-    out_md = markdown_path(file_id)
     # 文件中图片的保存路径
     img_dir = images_dir(file_id)
-    # 使用paddleocr内置方法进行转化
-    try:
-        elements = partition_pdf(
-            filename=pdf_path,
-            infer_table_structure=True,
-            strategy="hi_res",
-            ocr_languages="chi_sim+eng",
-            ocr_engine="paddleocr"  # 同上
-        )
-        logger.info(f"PDF解析完成，file_id: {file_id}, 元素数量: {len(elements)}")
-
-        # 提取图片
-        image_map = {}
-        # 加载原文档
-        with fitz.open(pdf_path) as doc:
-            # 遍历每一页
-            for page_num, page in enumerate(doc, start=1):
-                image_map[page_num] = []
-                # 遍历当前页的所有图片
-                for img_index, img in enumerate(page.get_images(full=True), start=1):
-                    xref = img[0]
-                    pix = fitz.Pixmap(doc, xref)
-                    img_path = img_dir / f"page{page_num}_img{img_index}.png"
-                    # 确保转换为支持的RGB颜色空间
-                    try:
-                        # 尝试直接保存
-                        pix.save(str(img_path))
-                    except ValueError:
-                        # 如果颜色空间不支持，则转换为RGB
-                        if pix.alpha and pix.n > 3:
-                            # 如果有alpha通道，先移除
-                            pix = fitz.Pixmap(pix, 0)
-                        # 转换为RGB
-                        pix = fitz.Pixmap(fitz.csRGB, pix)
-                        # 再次尝试保存
-                        pix.save(str(img_path))
-                    image_map[page_num].append(img_path.name)  # 只保存文件名
-
-        # 构建 Markdown 内容
-        md_lines: List[str] = []
-        inserted_images = set()
-        for el in elements:
-            cat = getattr(el, "category", None)
-            text = (getattr(el, "text", "") or "").strip()
-            meta = getattr(el, "metadata", None)
-            page_num = getattr(meta, "page_number", None) if meta else None
-
-            if not text and cat != "Image":
-                continue
+    image_map: Dict[int, List[str]] = {}
+    names: Dict[int, str] = {}
+    written = decoded = 0
+    # 加载原文档
+    with fitz.open(pdf_path) as doc, ThreadPoolExecutor(max_workers=max(1, IMAGE_WORKERS)) as pool:
+        futures = []
+        if page_numbers is None:
+            page_numbers = list(range(1, doc.page_count + 1))
+        # 遍历每一页
+        for page_num in page_numbers:
+            page = doc.load_page(page_num - 1)
+            image_map[page_num] = []
+            # 遍历当前页的所有图片
+            for img in page.get_images(full=True):
+                xref, smask, filter_name = img[0], img[1], img[8]
+                if xref in names:
+                    # 同一 xref（页眉 logo 等）在之前的页面已处理过
+                    if names[xref] not in image_map[page_num]:
+                        image_map[page_num].append(names[xref])
+                    continue
+                try:
+                    stem = _image_name(doc, xref, smask)
+                    existing = next(img_dir.glob(f"{stem}.*"), None)
+                    if existing is None and reuse_dir is not None:
+                        reused = next(reuse_dir.glob(f"{stem}.*"), None)
+                        if reused is not None and save:
+                            shutil.copyfile(reused, img_dir / reused.name)
+                        existing = reused
+                    if existing is not None:
+                        name = existing.name
+                    elif not save:
+                        # 图片应已在之前提取过但文件缺失，按转换规则推断扩展名
+                        name = f"{stem}.{_decode_image(doc, xref, smask, filter_name)[0]}"
+                    else:
+                        kind, payload = _decode_image(doc, xref, smask, filter_name)
+                        decoded += 1
+                        name = f"{stem}.{kind}"
+                        futures.append(pool.submit(_write_image, img_dir / name, kind, payload))
+                except Exception as e:
+                    logger.warning(f"提取图片失败，file_id: {file_id}, 页码: {page_num}, xref: {xref}, 错误: {e}")
+                    continue
+                names[xref] = name
+                image_map[page_num].append(name)  # 只保存文件名
+        for f in futures:
+            f.result()
+            written += 1
+    logger.info(f"图片提取完成，file_id: {file_id}, 图片引用: {sum(len(v) for v in image_map.values())}, "
+                f"去重后: {len(set(names.values()))}, 新解码: {decoded}, 写入: {written}")
+    return image_map
+
+def elements_to_markdown(elements: List[Any], image_map: Dict[int, List[str]]) -> str:
+    """把布局元素转换为 Markdown 文本"""
+    md_lines: List[str] = []
+    inserted_images = set()
+    for el in elements:
+        cat = getattr(el, "category", None)
+        text = (getattr(el, "text", "") or "").strip()
+        meta = getattr(el, "metadata", None)
+        page_num = getattr(meta, "page_number", None) if meta else None
 
-            # 标题：转换为 # 标题
-            if cat == "Title" and text.startswith("- "):
-                md_lines.append(text + "\n")
-            elif cat == "Title":
-                md_lines.append(f"# {text}\n")
-            # 头部：转换为 ## 子标题
-            elif cat in ["Header", "Subheader"]:
-                md_lines.append(f"## {text}\n")
-            # 表格：优先使用 HTML 表格，转换为 Markdown 表格
-            elif cat == "Table":
-                html = getattr(meta, "text_as_html", None) if meta else None
-                if html:
-                    md_lines.append(html2text(html) + "\n")
-                else:
-                    md_lines.append((text or "") + "\n")
-            # 图片：插入 Markdown 图片链接 ![Image](./images/filename.png)
-            elif cat == "Image" and page_num:
-                for name in image_map.get(page_num, []):
-                    if (page_num, name) not in inserted_images:
-                        md_lines.append(f"![Image](./images/{name})\n")
-                        inserted_images.add((page_num, name))
+        if not text and cat != "Image":
+            continue
+
+        # 标题：转换为 # 标题
+        if cat == "Title" and text.startswith("- "):
+            md_lines.append(text + "\n")
+        elif cat == "Title":
+            md_lines.append(f"# {text}\n")
+        # 头部：转换为 ## 子标题
+        elif cat in ["Header", "Subheader"]:
+            md_lines.append(f"## {text}\n")
+        # 表格：优先使用 HTML 表格，转换为 Markdown 表格
+        elif cat == "Table":
+            html = getattr(meta, "text_as_html", None) if meta else None
+            if html:
+                md_lines.append(html2text(html) + "\n")
             else:
-                # 普通文本：直接添加
-                md_lines.append(text + "\n")
+                md_lines.append((text or "") + "\n")
+        # 图片：插入 Markdown 图片链接 ![Image](./images/filename.png)
+        elif cat == "Image" and page_num:
+            for name in image_map.get(page_num, []):
+                if (page_num, name) not in inserted_images:
+                    md_lines.append(f"![Image](./images/{name})\n")
+                    inserted_images.add((page_num, name))
+        else:
+            # 普通文本：直接添加
+            md_lines.append(text + "\n")
+    return "\n".join(md_lines)
 
+def pdf_to_markdown(file_id: str, elements: List[Any] | None = None):
+    """将PDF文档转为MD；传入 elements 时复用已有的布局解析结果"""
+    logger.info(f"开始PDF转Markdown，file_id: {file_id}")
+    # MD文件输出路径
+    out_md = markdown_path(file_id)
+    try:
+        if elements is None:
+            elements = unstructured_segments(file_id)
+        logger.info(f"使用布局元素生成Markdown，file_id: {file_id}, 元素数量: {len(elements)}")
+        # 提取图片并构建 Markdown 内容
+        image_map = extract_page_images(file_id)
         # 保存MD文件
-        out_md.write_text("\n".join(md_lines), encoding="utf-8")
+        out_md.write_text(elements_to_markdown(elements, image_map), encoding="utf-8")
         logger.info(f"Markdown文件保存成功，file_id: {file_id}, 路径: {out_md}")
         return {"markdown": out_md.name, "images_dir": "images"}
     except Exception as e:
         logger.error(f"PDF转Markdown失败，file_id: {file_id}, 错误: {e}", exc_info=True)
         raise
 
-# def run_full_parse_pipeline(file_id: str) -> Dict[str, Any]:
-#     """
-#     完整流程：原始页图渲染 → Unstructured 布局段 → 叠框图 → 输出 Markdown
-#     返回用于 /status 的统计或元信息
-#     """
-#     logger.info(f"开始完整解析流程，file_id: {file_id}")
-#     try:
-#         # 将原始页面转化为PNG格式，用于前端展示原文档
-#         render_original_pages(file_id)
-#         # 使用paddleocr对文档布局进行解析
-#         docs = unstructured_segments(file_id)
-#         # 添加框线图，并保存为PNG格式，用于前端展示解析后的文档
-#         render_parsed_pages_with_boxes(file_id, docs)
-#         # PDF转MD
-#         md_info = pdf_to_markdown(file_id)
-#         logger.info(f"完整解析流程完成，file_id: {file_id}")
-#         return {"md": md_info["markdown"]}
-#     except Exception as e:
-#         error('pdf_service', f"完整解析流程失败", e)
-#         raise
+def _no_report(stage: str, progress: int) -> None:
+    pass
+
+def _contiguous_runs(pages: List[int]) -> List[List[int]]:
+    """把有序页码拆成连续区间：[1, 2, 5, 6, 7] -> [[1, 2], [5, 6, 7]]"""
+    runs: List[List[int]] = []
+    for p in pages:
+        if runs and runs[-1][-1] == p - 1:
+            runs[-1].append(p)
+        else:
+            runs.append([p])
+    return runs
+
+def _concat_markdown_parts(file_id: str, count: int) -> Path:
+    """按窗口顺序把 Markdown 分片拼接为 output.md（逐个分片流式写入）"""
+    out_md = markdown_path(file_id)
+    parts = markdown_parts_dir(file_id)
+    with out_md.open("w", encoding="utf-8") as out:
+        for index in range(1, count + 1):
+            part = (parts / f"part-{index:04d}.md").read_text(encoding="utf-8")
+            if index > 1 and part:
+                out.write("\n")
+            out.write(part)
+    return out_md
+
+def run_full_parse_pipeline(file_id: str, report: Callable[[str, int], None] = _no_report) -> Dict[str, Any]:
+    """
+    完整流程：按页窗口循环（原始页图 → 布局段 → 叠框图 → 图片 → Markdown 分片）→ 拼接 Markdown
+    每个窗口（PARSE_WINDOW_PAGES 页）的结果写盘后即释放，内存占用只与窗口大小有关。
+    每个阶段完成的页面记录在检查点中，进程重启或任务重试后从最后完成的单元继续。
+    修订版本（revision.json）中内容未变化的页面复用基础版本的产物，只有变化的页面重新解析。
+    report(stage, progress) 在每个阶段开始时回调，用于更新任务进度；
+    回调抛出的异常（如任务被取消）会中断流程
+    """
+    logger.info(f"开始完整解析流程，file_id: {file_id}")
+    try:
+        time_start = time.time()
+        with fitz.open(original_pdf_path(file_id)) as doc:
+            page_count = doc.page_count
+        size = PARSE_WINDOW_PAGES if PARSE_WINDOW_PAGES > 0 else max(page_count, 1)
+        checkpoint = ParseCheckpoint(file_id, page_count, size)
+        if checkpoint.resumed:
+            logger.info(f"从检查点恢复解析，file_id: {file_id}, 已完成页数: {checkpoint.summary()}")
+        else:
+            # 清理上一次解析遗留的窗口结果（窗口数可能不同）
+            segment_store.clear(file_id)
+            for stale in markdown_parts_dir(file_id).glob("part-*.md"):
+                stale.unlink(missing_ok=True)
+        # 修订版本：未变化的页面直接复用基础版本的页图、布局段与图片，只解析变化的页面
+        revision = load_revision(file_id)
+        windows = [list(range(s, min(s + size, page_count + 1))) for s in range(1, page_count + 1, size)]
+        for index, pages in enumerate(windows, start=1):
+            # 10 → 95 之间按窗口推进进度
+            base = 10 + 85 * (index - 1) // len(windows)
+            step = 85 // len(windows)
+            tag = f"[{index}/{len(windows)}]"
+            reused = revision.reusable(pages) if revision else {}
+            fresh = [p for p in pages if p not in reused]
+            # 将原始页面转化为PNG格式，用于前端展示原文档（关闭预渲染时由 /pdf/page 按需渲染）
+            report(f"render_original{tag}", base)
+            if not checkpoint.completed("render_original", pages):
+                if reused:
+                    revision.copy_page_files(reused)
+                if EAGER_RENDER_PAGES:
+                    for run in _contiguous_runs(fresh):
+                        render_original_pages(file_id, page_numbers=run)
+                checkpoint.mark("render_original", pages)
+            if all(checkpoint.completed(stage, pages) for stage in ("layout", "overlay", "images", "markdown")):
+                continue
+            # 使用paddleocr对窗口内页面进行布局解析（叠框图与 Markdown 共用同一份结果）
+            report(f"layout{tag}", base + step // 10)
+            if checkpoint.completed("layout", pages):
+                docs = [segment_store.to_element(seg) for seg in segment_store.load_window(file_id, index)]
+            else:
+                docs = revision.elements(reused) if reused else []
+                if fresh:
+                    docs += unstructured_segments(file_id, fresh)
+                docs.sort(key=lambda el: el.metadata.page_number or 0)
+                segment_store.write_window(file_id, index, pages, docs)
+                checkpoint.mark("layout", pages)
+            # 添加框线图，并保存为PNG格式，用于前端展示解析后的文档
+            report(f"overlay{tag}", base + step * 2 // 3)
+            if not checkpoint.completed("overlay", pages):
+                if fresh:
+                    render_parsed_pages_with_boxes(file_id, docs, page_numbers=fresh)
+                checkpoint.mark("overlay", pages)
+            # 提取图片并生成该窗口的 Markdown 分片
+            report(f"images{tag}", base + step * 3 // 4)
+            images_done = checkpoint.completed("images", pages)
+            image_map = extract_page_images(file_id, pages, save=not images_done,
+                                            reuse_dir=revision.base_images_dir() if reused else None)
+            if not images_done:
+                checkpoint.mark("images", pages)
+            report(f"markdown{tag}", base + step * 5 // 6)
+            if not checkpoint.completed("markdown", pages):
+                part = elements_to_markdown(docs, image_map)
+                (markdown_parts_dir(file_id) / f"part-{index:04d}.md").write_text(part, encoding="utf-8")
+                checkpoint.mark("markdown", pages)
+            # 释放窗口结果后再进入下一个窗口
+            del docs, image_map
+            gc.collect()
+        report("markdown", 95)
+        md_file = _concat_markdown_parts(file_id, len(windows))
+        checkpoint.finish()
+        logger.info(f"完整解析流程完成，file_id: {file_id}, 窗口数: {len(windows)}, 耗时: {time.time() - time_start} 秒")
+        return {"md": md_file.name}
+    except Exception as e:
+        logger.error(f"完整解析流程失败，file_id: {file_id}, 错误: {e}")
+        raise
@@ -0,0 +1,159 @@
+# services/query_embedding_cache.py
+from __future__ import annotations
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+
+from .log_service import get_logger
+
+logger = get_logger('query_embedding_cache')
+
+# 查询向量内存缓存的字节预算
+QUERY_EMBED_CACHE_MB = int(os.getenv("QUERY_EMBED_CACHE_MB", 64))
+# 缓存有效期（秒），0 为不过期
+QUERY_EMBED_CACHE_TTL = float(os.getenv("QUERY_EMBED_CACHE_TTL", 3600))
+# 磁盘缓存（SQLite）路径，留空则只用内存缓存
+QUERY_EMBED_CACHE_DB = os.getenv("QUERY_EMBED_CACHE_DB", "")
+# 磁盘缓存最多保留的条目数，超出时删除最早写入的条目，0 为不限
+QUERY_EMBED_CACHE_MAX_ROWS = int(os.getenv("QUERY_EMBED_CACHE_MAX_ROWS", 100000))
+# 每写入多少条清理一次磁盘缓存（删除过期条目与超出上限的条目）
+_PURGE_EVERY = 1000
+
+def normalize_query(text: str) -> str:
+    """NFKC 归一化（全角/半角统一）、合并空白、忽略大小写"""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+class QueryEmbeddingCache:
+    """
+    查询向量缓存：按 (嵌入模型, 归一化查询) 缓存，内存 LRU 按字节预算淘汰，条目超过 TTL 失效；
+    配置了 db_path 时内存未命中再查 SQLite，多进程/重启后仍可复用（线程安全）
+    """
+    def __init__(self, max_bytes: int, ttl: float, db_path: str = "", max_rows: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self._items: OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "diskHits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._puts_since_purge = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # 调用方已持有 _db_lock；首次使用时才建库并清理一次，导入本模块不产生文件
+        if self._db is None:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS query_embeddings ("
+                             "key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_query_embeddings_created ON query_embeddings (created)")
+            self._db.commit()
+            self._purge(self._db)
+        return self._db
+
+    def _purge(self, db: sqlite3.Connection) -> None:
+        """删除超过 TTL 的条目，以及超出 max_rows 的最早写入的条目（调用方已持有 _db_lock）"""
+        removed = 0
+        if self.ttl > 0:
+            removed += db.execute("DELETE FROM query_embeddings WHERE created < ?", (time.time() - self.ttl,)).rowcount
+        if self.max_rows > 0:
+            excess = db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0] - self.max_rows
+            if excess > 0:
+                removed += db.execute("DELETE FROM query_embeddings WHERE key IN ("
+                                      "SELECT key FROM query_embeddings ORDER BY created LIMIT ?)", (excess,)).rowcount
+        db.commit()
+        self._puts_since_purge = 0
+        if removed:
+            logger.info(f"清理查询向量磁盘缓存，删除 {removed} 条")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    @staticmethod
+    def _disk_key(key: Tuple[str, str]) -> str:
+        return hashlib.sha256(f"{key[0]}\0{key[1]}".encode("utf-8")).hexdigest()
+
+    def _put_memory(self, key: Tuple[str, str], created: float, vector: np.ndarray) -> None:
+        if vector.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1].nbytes
+            self._items[key] = (created, vector)
+            self._bytes += vector.nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+    def get(self, model: str, text: str) -> List[float] | None:
+        key = (model, normalize_query(text))
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if not self._expired(item[0]):
+                    self._items.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return item[1].tolist()
+                self._items.pop(key)
+                self._bytes -= item[1].nbytes
+                self.stats["expired"] += 1
+        if self.db_path:
+            try:
+                with self._db_lock:
+                    row = self._conn().execute("SELECT created, vector FROM query_embeddings WHERE key = ?",
+                                               (self._disk_key(key),)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"读取查询向量磁盘缓存失败: {e}")
+                row = None
+            if row is not None and not self._expired(row[0]):
+                vector = np.frombuffer(row[1], dtype=np.float64)
+                self._put_memory(key, row[0], vector)
+                with self._lock:
+                    self.stats["diskHits"] += 1
+                return vector.tolist()
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, model: str, text: str, embedding: List[float]) -> None:
+        key = (model, normalize_query(text))
+        created = time.time()
+        vector = np.asarray(embedding, dtype=np.float64)
+        self._put_memory(key, created, vector)
+        if self.db_path:
+            try:
+                with self._db_lock:
+                    db = self._conn()
+                    db.execute("INSERT OR REPLACE INTO query_embeddings (key, created, vector) VALUES (?, ?, ?)",
+                               (self._disk_key(key), created, vector.tobytes()))
+                    db.commit()
+                    self._puts_since_purge += 1
+                    if self._puts_since_purge >= _PURGE_EVERY:
+                        self._purge(db)
+            except sqlite3.Error as e:
+                logger.warning(f"写入查询向量磁盘缓存失败: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s.update(items=len(self._items), bytes=self._bytes, maxBytes=self.max_bytes,
+                     ttlSeconds=self.ttl, diskTier=bool(self.db_path), diskMaxRows=self.max_rows)
+        lookups = s["hits"] + s["diskHits"] + s["misses"]
+        s["hitRate"] = round((s["hits"] + s["diskHits"]) / lookups, 4) if lookups else 0.0
+        return s
+
+query_cache = QueryEmbeddingCache(QUERY_EMBED_CACHE_MB * 1024 * 1024, QUERY_EMBED_CACHE_TTL, QUERY_EMBED_CACHE_DB,
+                                  QUERY_EMBED_CACHE_MAX_ROWS)
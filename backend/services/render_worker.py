@@ -0,0 +1,212 @@
+# services/render_worker.py
+from __future__ import annotations
+import io
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import fitz
+from PIL import Image, ImageDraw, ImageFont
+
+from .log_service import get_logger
+
+logger = get_logger('render_worker')
+
+# 原始页面并行渲染的进程数，<=1 时退化为串行；同时也是本进程渲染进程池的大小，所有解析任务共用
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+
+def _page_pixmap(page, dpi: int):
+    """按指定 DPI 渲染页面，返回 RGB 像素图"""
+    # 比例缩放
+    mat = fitz.Matrix(dpi/72, dpi/72)
+    # 使用指定的变换矩阵将 PDF 页面渲染为像素图
+    pix = page.get_pixmap(matrix=mat)
+    # 处理颜色空间
+    if pix.alpha and pix.n > 3:
+        # 如果有alpha通道，先移除
+        pix = fitz.Pixmap(pix, 0)
+    # 确保转换为RGB
+    if pix.colorspace.n != fitz.csRGB.n:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """先写同目录下唯一命名的临时文件再替换，避免并发请求读到半截图片或互相覆盖临时文件"""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False) as tmp:
+        tmp.write(data)
+    try:
+        os.replace(tmp.name, path)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+def _render_page_range(pdf_path: str, out_dir: str, start: int, end: int, dpi: int) -> int:
+    """
+    渲染 [start, end) 范围内的页面（0 基页码），输出文件名为 page-XXXX.png（1 基）。
+    作为进程池任务运行，每个进程独立打开 fitz 文档
+    """
+    rendered = 0
+    with fitz.open(pdf_path) as doc:
+        for idx in range(start, end):
+            try:
+                pix = _page_pixmap(doc.load_page(idx), dpi)
+                # 保存图片
+                _write_atomic(Path(out_dir) / f"page-{idx + 1:04d}.png", pix.tobytes("png"))
+                rendered += 1
+            except Exception as e:
+                logger.warning(f"渲染页面 {idx + 1} 失败: {e}", exc_info=True)
+    return rendered
+
+# 根据不同的元素类型设置不同的框线颜色
+CATEGORY_TO_COLOR = {
+    "Title": "orchid",
+    "Image": "forestgreen",
+    "Table": "tomato",
+    # "List": "gold",
+    # "Header": "purple",
+    # "Footer": "blue",
+    # "Caption": "orange"
+}
+DEFAULT_BOX_COLOR = "deepskyblue"
+
+def _label_font(size: int):
+    """获取标签字体，旧版本 Pillow 不支持指定字号时退回默认位图字体"""
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+def _draw_boxes(img: Image.Image, segments: List[Dict[str, Any]]) -> Image.Image:
+    """
+    直接在页面位图上绘制解析后的文本区域边界框、类别标签和图例
+    """
+    draw = ImageDraw.Draw(img)
+    # 线宽与字号随页面尺寸缩放，保证不同 DPI 下观感一致
+    scale = max(img.width, img.height) / 1000
+    line_width = max(1, round(scale))
+    font = _label_font(max(10, round(11 * scale)))
+    # 遍历所有文本区域并绘制边界框
+    categories = set()
+    try:
+        for seg in segments:
+            # 原始坐标点
+            points = seg["coordinates"]["points"]
+            # 原始布局的宽度和高度
+            lw = seg["coordinates"]["layout_width"]
+            lh = seg["coordinates"]["layout_height"]
+            # 转换公式：x_image = x_original * (img.width / layout_width)
+            scaled = [(x * img.width / lw, y * img.height / lh) for x, y in points]
+            # 获取颜色
+            category = seg.get("category", "Text")
+            color = CATEGORY_TO_COLOR.get(category, DEFAULT_BOX_COLOR)
+            categories.add(category)
+            # 绘制闭合多边形边界框
+            draw.line(scaled + [scaled[0]], fill=color, width=line_width)
+            # 添加文本标签（标注在框左上角上方）
+            draw.text((scaled[0][0], scaled[0][1]), category, fill=color, font=font, anchor="ld")
+    except Exception as e:
+        logger.error(f"绘制解析页面边界框失败，错误: {e}")
+        raise
+    # 创建图例，显示所有检测到的类别：先默认的 "Text"，再其他自定义类别
+    legend = [("Text", DEFAULT_BOX_COLOR)] if "Text" in categories else []
+    legend += [(cat, color) for cat, color in CATEGORY_TO_COLOR.items() if cat in categories]
+    # 只有当有图例时才添加（右上角）
+    if legend:
+        pad = round(6 * scale) or 1
+        swatch = font.getbbox("Hg")[3]
+        width = max(draw.textlength(cat, font=font) for cat, _ in legend) + swatch + pad * 3
+        height = len(legend) * (swatch + pad) + pad
+        x0, y0 = img.width - width - pad, pad
+        draw.rectangle([x0, y0, x0 + width, y0 + height], fill="white", outline="lightgray")
+        for i, (cat, color) in enumerate(legend):
+            y = y0 + pad + i * (swatch + pad)
+            draw.rectangle([x0 + pad, y, x0 + pad + swatch, y + swatch], fill=color)
+            draw.text((x0 + pad * 2 + swatch, y), cat, fill="black", font=font)
+    return img
+
+def _render_overlay_pages(pdf_path: str, original_dir: str, out_dir: str, pages: List[tuple], dpi: int) -> int:
+    """
+    渲染一批叠框页面：[(page_number, segments), ...]。
+    优先复用 pages/original 下已渲染的原图，缺失时才用 fitz 重新光栅化。
+    作为进程池任务运行，每个进程独立打开 fitz 文档
+    """
+    rendered = 0
+    with fitz.open(pdf_path) as doc:
+        for page_number, segments in pages:
+            try:
+                original = Path(original_dir) / f"page-{page_number:04d}.png"
+                if original.exists():
+                    img = Image.open(original).convert("RGB")
+                else:
+                    pix = _page_pixmap(doc.load_page(page_number - 1), dpi)
+                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                buf = io.BytesIO()
+                _draw_boxes(img, segments).save(buf, "PNG", optimize=False)
+                _write_atomic(Path(out_dir) / f"page-{page_number:04d}.png", buf.getvalue())
+                rendered += 1
+            except Exception as e:
+                logger.warning(f"渲染解析页面 {page_number} 失败: {e}", exc_info=True)
+    return rendered
+
+def _shutdown_now(pool: ProcessPoolExecutor) -> None:
+    """不等待进程池退出；cancel_futures 需 Python 3.9+，更早的版本只能让已排队的任务执行完"""
+    if sys.version_info >= (3, 9):
+        pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        pool.shutdown(wait=False)
+
+class RenderWorkerPool:
+    """
+    常驻的页面渲染进程池：每个服务进程一个，所有解析任务、所有窗口共用，进程总数不超过 workers。
+    spawn：服务进程里有 torch、重排序批处理线程与数据库连接，fork 带锁的多线程进程可能死锁；
+    worker 只导入本模块（fitz + Pillow）
+    """
+    def __init__(self, workers: int = RENDER_WORKERS):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=max(1, self.workers), mp_context=get_context("spawn"))
+                logger.info(f"页面渲染进程池已启动，进程数: {self.workers}")
+            return self._pool
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        # 只丢弃出错的那个进程池，其他线程可能已经换上了新的
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        _shutdown_now(pool)
+
+    def run_all(self, fn: Callable, calls: List[tuple]) -> List[Any]:
+        """
+        把每组参数提交给 fn 并按顺序返回结果。
+        worker 异常退出（如 OOM）时进程池整体损坏，重建后重跑一次（渲染任务可重复执行）
+        """
+        for attempt in (1, 2):
+            pool = self._get_pool()
+            try:
+                futures = [pool.submit(fn, *args) for args in calls]
+                return [f.result() for f in futures]
+            except BrokenProcessPool:
+                self._discard(pool)
+                if attempt == 2:
+                    raise
+                logger.warning("页面渲染进程池已损坏，重新创建后重试")
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            _shutdown_now(pool)
+            logger.info("页面渲染进程池已关闭")
+
+render_pool = RenderWorkerPool()
@@ -0,0 +1,280 @@
+# services/reranker_service.py
+from __future__ import annotations
+import os
+import time
+import queue
+import shutil
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from .log_service import get_logger
+
+logger = get_logger('reranker_service')
+
+# 启动时是否预加载重排序模型
+RERANKER_PRELOAD = os.getenv("RERANKER_PRELOAD", "true").lower() in ("1", "true", "yes")
+# torch 算子内并行线程数，0 为使用 torch 默认值（通常等于物理核数）
+RERANKER_THREADS = int(os.getenv("RERANKER_THREADS", 0))
+# 推理后端：torch（fp32）/ int8（torch 动态量化，仅 CPU）/ onnx（ONNX Runtime，需安装 onnxruntime）
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "torch").lower()
+# 导出的 ONNX 模型存放目录，每个模型一个子目录，首次使用 onnx 后端时导出
+RERANKER_ONNX_DIR = os.getenv("RERANKER_ONNX_DIR", "models/onnx")
+RERANKER_BACKENDS = ("torch", "int8", "onnx")
+# 是否把并发请求的 (query, 文档) 对合并成批次推理
+RERANK_BATCHING = os.getenv("RERANK_BATCHING", "true").lower() in ("1", "true", "yes")
+# 收到第一个请求后最多等待多少毫秒以凑批
+RERANK_BATCH_WAIT_MS = float(os.getenv("RERANK_BATCH_WAIT_MS", 5))
+# 单次前向的最大 pair 数
+RERANK_MAX_BATCH = int(os.getenv("RERANK_MAX_BATCH", 32))
+
+def _onnx_model_dir(model_path: str) -> Path:
+    return Path(RERANKER_ONNX_DIR) / model_path.strip("/").replace("/", "--")
+
+def _export_onnx(model_path: str, tokenizer, out_dir: Path) -> None:
+    """把 fp32 模型导出为 ONNX（batch 与序列长度为动态维度）；超过 2GB 的权重由 torch 写为外部数据文件"""
+    logger.info(f"正在导出重排序模型为ONNX: {model_path} -> {out_dir}")
+    model = AutoModelForSequenceClassification.from_pretrained(model_path)
+    model.eval()
+    sample = tokenizer([["query", "document"]], padding=True, truncation=True, return_tensors="pt", max_length=512)
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[n] for n in names), str(tmp_dir / "model.onnx"),
+            input_names=names, output_names=["logits"],
+            dynamic_axes={**{n: {0: "batch", 1: "sequence"} for n in names}, "logits": {0: "batch"}},
+            opset_version=14,
+        )
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+
+def _onnx_session(model_path: str, tokenizer):
+    import onnxruntime as ort
+
+    out_dir = _onnx_model_dir(model_path)
+    if not (out_dir / "model.onnx").exists():
+        _export_onnx(model_path, tokenizer, out_dir)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if RERANKER_THREADS > 0:
+        options.intra_op_num_threads = RERANKER_THREADS
+    return ort.InferenceSession(str(out_dir / "model.onnx"), options, providers=["CPUExecutionProvider"])
+
+class BGEReranker:
+    """BGE重排序器实现，支持从本地路径加载模型；backend 选择 fp32 / int8 动态量化 / ONNX Runtime 推理"""
+    def __init__(self, model_path: str = None, device: str = "cpu", backend: str | None = None):
+        # 默认使用本地路径，如果未提供则使用Hugging Face模型名称
+        self.model_path = model_path or os.getenv("RERANKER_PATH", "BAAI/bge-reranker-v2-m3")
+        self.device = device
+        self.backend = (backend or RERANKER_BACKEND).lower()
+        self.model = None
+        self.tokenizer = None
+        self._onnx_inputs: List[str] = []
+        self.error: str | None = None
+        self.load_seconds: float | None = None
+        self._load_lock = threading.Lock()
+        self._batcher: RerankBatcher | None = None
+
+    def load_model(self):
+        """加载BGE重排序模型（支持本地路径或Hugging Face模型）；并发调用只加载一次"""
+        with self._load_lock:
+            if self.model is not None:
+                return True
+            try:
+                logger.info(f"正在从路径加载重排序模型: {self.model_path}")
+                start = time.perf_counter()
+                if RERANKER_THREADS > 0:
+                    torch.set_num_threads(RERANKER_THREADS)
+                if self.backend not in RERANKER_BACKENDS:
+                    raise ValueError(f"未知的重排序推理后端: {self.backend}，可选: {', '.join(RERANKER_BACKENDS)}")
+                if self.backend != "torch" and self.device != "cpu":
+                    raise ValueError(f"{self.backend} 后端只支持 CPU 推理")
+                # 尝试从本地路径或Hugging Face加载模型
+                tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+                if self.backend == "onnx":
+                    # ONNX Runtime 会话同样按 model 保存，rerank 与就绪状态的判断不变
+                    model = _onnx_session(self.model_path, tokenizer)
+                    self._onnx_inputs = [i.name for i in model.get_inputs()]
+                else:
+                    model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+                    model.to(self.device)
+                    model.eval()
+                    if self.backend == "int8":
+                        # 线性层权重量化为 int8，激活在推理时动态量化
+                        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                self.tokenizer, self.model = tokenizer, model
+                self.load_seconds = round(time.perf_counter() - start, 2)
+                self.error = None
+                logger.info(f"重排序模型加载成功，后端: {self.backend}，耗时: {self.load_seconds}秒，"
+                            f"torch线程数: {torch.get_num_threads()}")
+                return True
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"加载BGE重排序模型失败: {e}", exc_info=True)
+                return False
+
+    def rerank(self, query: str, docs: List[Dict[str, Any]], top_k: int = 5) -> List[Dict[str, Any]]:
+        """对检索结果进行重排序"""
+        if self.model is None or self.tokenizer is None:
+            if not self.load_model():
+                # 如果无法加载模型，返回原始排序结果
+                logger.warning("无法加载重排序模型，返回原始排序结果")
+                return docs[:top_k]
+
+        try:
+            # 准备模型输入；开启批处理时与并发请求合并推理
+            pairs = [[query, doc["text"]] for doc in docs]
+            scores = self.batcher().submit(pairs).result() if RERANK_BATCHING else self.score_pairs(pairs)
+
+            # 为文档添加重排序分数
+            for i, doc in enumerate(docs):
+                doc["rerank_score"] = scores[i]
+
+            # 按重排序分数降序排序
+            reranked_docs = sorted(docs, key=lambda x: x.get("rerank_score", 0), reverse=True)
+            logger.info(f"重排序完成，返回前 {top_k} 个文档，总文档数: {len(docs)}")
+            return reranked_docs[:top_k]
+        except Exception as e:
+            logger.error(f"重排序失败: {e}", exc_info=True)
+            return docs[:top_k]
+
+    def score_pairs(self, pairs: List[List[str]]) -> List[float]:
+        """对 (query, 文档) 对打分：按长度排序后分批前向，同一批内长度相近，减少 padding"""
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(order), RERANK_MAX_BATCH):
+            idx = order[start:start + RERANK_MAX_BATCH]
+            batch = [pairs[i] for i in idx]
+            if self.backend == "onnx":
+                inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors='np', max_length=512)
+                feeds = {name: inputs[name].astype(np.int64) for name in self._onnx_inputs}
+                logits = self.model.run(None, feeds)[0].reshape(-1).tolist()
+            else:
+                inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors='pt', max_length=512)
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                with torch.no_grad():
+                    logits = self.model(**inputs).logits.view(-1).float().tolist()
+            for i, score in zip(idx, logits):
+                scores[i] = score
+        return scores
+
+    def batcher(self) -> "RerankBatcher":
+        with self._load_lock:
+            if self._batcher is None:
+                self._batcher = RerankBatcher(self)
+            return self._batcher
+
+class _Request:
+    __slots__ = ("pairs", "future")
+
+    def __init__(self, pairs: List[List[str]]):
+        self.pairs = pairs
+        self.future: Future = Future()
+
+class RerankBatcher:
+    """
+    重排序微批调度：后台线程收集 RERANK_BATCH_WAIT_MS 内到达的请求，
+    凑满 RERANK_MAX_BATCH 个 pair 或超时后合并推理，再把分数按请求拆回
+    """
+    def __init__(self, reranker: BGEReranker, max_wait_ms: float = RERANK_BATCH_WAIT_MS,
+                 max_batch: int = RERANK_MAX_BATCH):
+        self.reranker = reranker
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "pairs": 0, "batches": 0}
+        threading.Thread(target=self._run, name="rerank-batcher", daemon=True).start()
+
+    def submit(self, pairs: List[List[str]]) -> Future:
+        """提交一个请求的全部 pair，返回 Future[List[float]]"""
+        request = _Request(pairs)
+        if not pairs:
+            request.future.set_result([])
+        else:
+            self._queue.put(request)
+        return request.future
+
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        count = len(batch[0].pairs)
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            count += len(request.pairs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            pairs = [pair for request in batch for pair in request.pairs]
+            try:
+                scores = self.reranker.score_pairs(pairs)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            offset = 0
+            for request in batch:
+                request.future.set_result(scores[offset:offset + len(request.pairs)])
+                offset += len(request.pairs)
+            with self._stats_lock:
+                self.stats["requests"] += len(batch)
+                self.stats["pairs"] += len(pairs)
+                self.stats["batches"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            s = dict(self.stats)
+        s["avgRequestsPerBatch"] = round(s["requests"] / s["batches"], 2) if s["batches"] else 0.0
+        return s
+
+# (模型路径, 设备, 推理后端) -> BGEReranker，进程内共享，模型只加载一次
+_rerankers: Dict[Tuple[str, str, str], BGEReranker] = {}
+_rerankers_lock = threading.Lock()
+
+def get_reranker(model_path: str | None = None, device: str | None = None,
+                 backend: str | None = None) -> BGEReranker:
+    """返回共享的重排序器；模型在首次 rerank（或 preload_reranker）时加载"""
+    model_path = model_path or os.getenv("RERANKER_PATH", "BAAI/bge-reranker-v2-m3")
+    device = device or os.getenv("RERANKER_DEVICE", "cpu")
+    backend = (backend or RERANKER_BACKEND).lower()
+    key = (model_path, device, backend)
+    with _rerankers_lock:
+        reranker = _rerankers.get(key)
+        if reranker is None:
+            reranker = _rerankers[key] = BGEReranker(model_path=model_path, device=device, backend=backend)
+        return reranker
+
+def preload_reranker() -> bool:
+    """加载默认配置的重排序模型（应用启动时在后台线程调用）"""
+    return get_reranker().load_model()
+
+def reranker_status() -> Dict[str, Any]:
+    """默认重排序器的就绪状态"""
+    reranker = get_reranker()
+    return {
+        "ready": reranker.model is not None,
+        "loading": reranker._load_lock.locked(),
+        "modelPath": reranker.model_path,
+        "device": reranker.device,
+        "backend": reranker.backend,
+        "loadSeconds": reranker.load_seconds,
+        "error": reranker.error,
+        "batching": reranker._batcher.snapshot() if reranker._batcher else None,
+    }
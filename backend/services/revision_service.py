@@ -0,0 +1,114 @@
+# services/revision_service.py
+from __future__ import annotations
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from typing import Dict, Any, List
+
+import fitz
+
+from .log_service import get_logger
+from . import segment_store
+from .ultis import workdir, original_pdf_path, dir_original_pages, dir_parsed_pages, has_parse_artifacts
+
+logger = get_logger('revision_service')
+
+def _page_hash(doc, page) -> str:
+    """
+    单页内容指纹：页面尺寸/旋转 + 解压后的内容流 + 引用的图片与表单 XObject 的原始数据流。
+    只改动了其他页面的新版本中，这一页的指纹保持不变
+    """
+    h = hashlib.sha256()
+    h.update(f"{tuple(page.rect)}|{page.rotation}".encode())
+    h.update(page.read_contents())
+    xrefs = [img[0] for img in page.get_images(full=True)] + [x[0] for x in page.get_xobjects()]
+    for xref in xrefs:
+        try:
+            h.update(doc.xref_stream_raw(xref) or b"")
+        except Exception:
+            h.update(f"xref:{xref}".encode())
+    return h.hexdigest()
+
+def page_hashes(file_id: str) -> List[str]:
+    """返回每页的内容指纹（按页顺序），结果缓存在 <fileId>/page_hashes.json"""
+    path = workdir(file_id) / "page_hashes.json"
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    with fitz.open(original_pdf_path(file_id)) as doc:
+        hashes = [_page_hash(doc, page) for page in doc]
+    path.write_text(json.dumps(hashes), encoding="utf-8")
+    return hashes
+
+def plan_revision(file_id: str, base_id: str) -> Dict[str, Any]:
+    """
+    对比新版本与基础版本的页面指纹，记录新页码 -> 基础版本页码的映射到 <fileId>/revision.json。
+    相同位置的页面优先对应，其次匹配基础版本中任意一个指纹相同的页面（页面插入/删除后的平移）
+    """
+    new_hashes = page_hashes(file_id)
+    base_hashes = page_hashes(base_id)
+    by_hash: Dict[str, List[int]] = {}
+    for pno, h in enumerate(base_hashes, start=1):
+        by_hash.setdefault(h, []).append(pno)
+    page_map: Dict[int, int] = {}
+    for pno, h in enumerate(new_hashes, start=1):
+        candidates = by_hash.get(h)
+        if not candidates:
+            continue
+        page_map[pno] = pno if pno in candidates else candidates[0]
+    revision = {
+        "baseFileId": base_id,
+        "pageMap": {str(k): v for k, v in page_map.items()},
+        "changedPages": [p for p in range(1, len(new_hashes) + 1) if p not in page_map],
+    }
+    (workdir(file_id) / "revision.json").write_text(json.dumps(revision), encoding="utf-8")
+    logger.info(f"生成修订版本页面映射，file_id: {file_id}, 基础版本: {base_id}, "
+                f"未变化页数: {len(page_map)}, 变化页数: {len(revision['changedPages'])}")
+    return revision
+
+class PageRevision:
+    """一个修订版本相对基础版本的页面映射，解析时据此复用未变化页面的产物"""
+    def __init__(self, file_id: str, base_id: str, page_map: Dict[int, int]):
+        self.file_id = file_id
+        self.base_id = base_id
+        self.page_map = page_map
+
+    def reusable(self, pages: List[int]) -> Dict[int, int]:
+        """窗口内可复用的页面 {新页码: 基础版本页码}；基础版本尚未解析出该页布局段时不复用"""
+        return {p: self.page_map[p] for p in pages
+                if p in self.page_map and segment_store.has_page(self.base_id, self.page_map[p])}
+
+    def elements(self, reused: Dict[int, int]) -> List[Any]:
+        """从基础版本的段存储读取布局段，并改写为新版本的页码"""
+        out = []
+        for pno, base_pno in reused.items():
+            for seg in segment_store.load_page(self.base_id, base_pno) or []:
+                out.append(segment_store.to_element({**seg, "page": pno}))
+        return out
+
+    def copy_page_files(self, reused: Dict[int, int]) -> None:
+        """复制基础版本中这些页面的原图与叠框图（含各尺寸/格式）"""
+        pairs = [(dir_original_pages(self.base_id), dir_original_pages(self.file_id)),
+                 (dir_parsed_pages(self.base_id), dir_parsed_pages(self.file_id))]
+        for pno, base_pno in reused.items():
+            for src_dir, dst_dir in pairs:
+                prefix = f"page-{base_pno:04d}"
+                for src in src_dir.glob(f"{prefix}*.*"):
+                    shutil.copyfile(src, dst_dir / f"page-{pno:04d}{src.name[len(prefix):]}")
+
+    def base_images_dir(self) -> Path:
+        """基础版本提取的图片目录（图片按内容哈希命名，可直接按文件名复用）"""
+        return workdir(self.base_id) / "images"
+
+
+def load_revision(file_id: str) -> PageRevision | None:
+    """读取 revision.json；不是修订版本或基础版本已不存在时返回 None"""
+    path = workdir(file_id) / "revision.json"
+    if not path.exists():
+        return None
+    data = json.loads(path.read_text(encoding="utf-8"))
+    base_id = data["baseFileId"]
+    if not has_parse_artifacts(base_id):
+        logger.warning(f"修订版本的基础版本不存在，完整解析，file_id: {file_id}, 基础版本: {base_id}")
+        return None
+    return PageRevision(file_id, base_id, {int(k): v for k, v in data["pageMap"].items()})
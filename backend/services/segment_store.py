@@ -0,0 +1,212 @@
+# services/segment_store.py
+from __future__ import annotations
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List
+
+import numpy as np
+from unstructured.documents import elements as us_elements
+from unstructured.documents.elements import ElementMetadata
+from unstructured.documents.coordinates import PixelSpace
+
+from .log_service import get_logger
+from .ultis import workdir
+
+logger = get_logger('segment_store')
+
+# 布局段的列式存储，每个窗口一个目录 segments/window-XXXX/：
+#     page.npy          int32   [n]        页码（1 基，按页排序）
+#     category.npy      uint8   [n]        类别编号，对应 meta.json 的 categories
+#     layout.npy        float32 [n, 2]     坐标系宽高（layout_width, layout_height）
+#     point_offsets.npy int64   [n + 1]    每个段的多边形顶点在 points.npy 中的区间
+#     points.npy        float32 [m, 2]     多边形顶点
+#     text_offsets.npy  int64   [n + 1]    text.bin 中的字节区间（UTF-8）
+#     html_offsets.npy  int64   [n + 1]    html.bin 中的字节区间（表格 text_as_html）
+#     page_rows.npy     int64   [p + 1]    窗口内第 i 页的段位于 [page_rows[i], page_rows[i+1])
+#     meta.json                            categories / firstPage / lastPage / count
+# segments/index.json 记录各窗口覆盖的页码区间；读取时 np.load(mmap_mode="r")，只解码所需的页
+
+# 保持打开的窗口映射数上限（每个窗口占用若干文件句柄）
+SEGMENT_OPEN_WINDOWS = int(os.getenv("SEGMENT_OPEN_WINDOWS", 64))
+
+ARRAYS = ("page", "category", "layout", "point_offsets", "points", "text_offsets", "html_offsets", "page_rows")
+
+def segments_dir(file_id: str) -> Path:
+    p = workdir(file_id) / "segments"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+def _window_dir(file_id: str, index: int) -> Path:
+    return segments_dir(file_id) / f"window-{index:04d}"
+
+def _blob(parts: List[bytes]) -> tuple:
+    offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in parts], out=offsets[1:])
+    return offsets, b"".join(parts)
+
+def write_window(file_id: str, index: int, pages: List[int], elements: List[Any]) -> Path:
+    """把一个窗口的布局元素写为列式文件，并更新 index.json"""
+    elements = sorted(elements, key=lambda el: el.metadata.page_number or 0)
+    categories: List[str] = []
+    category_codes: Dict[str, int] = {}
+    page, category, layout, point_counts, points, texts, htmls = [], [], [], [], [], [], []
+    for el in elements:
+        name = el.category
+        if name not in category_codes:
+            category_codes[name] = len(categories)
+            categories.append(name)
+        coords = el.metadata.coordinates
+        pts = list(coords.points) if coords and coords.points else []
+        system = coords.system if coords else None
+        page.append(el.metadata.page_number or 0)
+        category.append(category_codes[name])
+        layout.append((getattr(system, "width", 0) or 0, getattr(system, "height", 0) or 0))
+        point_counts.append(len(pts))
+        points.extend(pts)
+        texts.append((el.text or "").encode("utf-8"))
+        htmls.append((el.metadata.text_as_html or "").encode("utf-8"))
+
+    first, last = pages[0], pages[-1]
+    page_arr = np.asarray(page, dtype=np.int32)
+    point_offsets = np.zeros(len(elements) + 1, dtype=np.int64)
+    np.cumsum(point_counts, out=point_offsets[1:])
+    text_offsets, text_blob = _blob(texts)
+    html_offsets, html_blob = _blob(htmls)
+    arrays = {
+        "page": page_arr,
+        "category": np.asarray(category, dtype=np.uint8),
+        "layout": np.asarray(layout, dtype=np.float32).reshape(-1, 2),
+        "point_offsets": point_offsets,
+        "points": np.asarray(points, dtype=np.float32).reshape(-1, 2),
+        "text_offsets": text_offsets,
+        "html_offsets": html_offsets,
+        "page_rows": np.searchsorted(page_arr, np.arange(first, last + 2)).astype(np.int64),
+    }
+
+    # 先写到临时目录再整体替换，读取方不会看到写了一半的窗口
+    out_dir = _window_dir(file_id, index)
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, arr in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", arr)
+    (tmp_dir / "text.bin").write_bytes(text_blob)
+    (tmp_dir / "html.bin").write_bytes(html_blob)
+    meta = {"categories": categories, "firstPage": first, "lastPage": last, "count": len(elements)}
+    (tmp_dir / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    _update_index(file_id, index, first, last)
+    with _open_lock:
+        _open_windows.pop((file_id, index), None)
+    return out_dir
+
+def _update_index(file_id: str, index: int, first: int, last: int) -> None:
+    path = segments_dir(file_id) / "index.json"
+    windows = json.loads(path.read_text(encoding="utf-8")).get("windows", []) if path.exists() else []
+    windows = [w for w in windows if w["index"] != index]
+    windows.append({"index": index, "firstPage": first, "lastPage": last})
+    windows.sort(key=lambda w: w["index"])
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"windows": windows}), encoding="utf-8")
+    os.replace(tmp, path)
+
+def clear(file_id: str) -> None:
+    """删除文件的全部布局段（重新解析前调用）"""
+    shutil.rmtree(workdir(file_id) / "segments", ignore_errors=True)
+    with _open_lock:
+        for key in [k for k in _open_windows if k[0] == file_id]:
+            _open_windows.pop(key, None)
+
+class _Window:
+    """一个窗口的内存映射视图"""
+    def __init__(self, path: Path):
+        self.meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        self.arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        self.text = self._bytes(path / "text.bin")
+        self.html = self._bytes(path / "html.bin")
+
+    @staticmethod
+    def _bytes(path: Path):
+        # 空文件无法 mmap
+        return np.memmap(path, dtype=np.uint8, mode="r") if path.stat().st_size else np.zeros(0, dtype=np.uint8)
+
+    def rows(self, page_number: int) -> range:
+        i = page_number - self.meta["firstPage"]
+        if i < 0 or page_number > self.meta["lastPage"]:
+            return range(0)
+        page_rows = self.arrays["page_rows"]
+        return range(int(page_rows[i]), int(page_rows[i + 1]))
+
+    def segment(self, row: int) -> Dict[str, Any]:
+        a = self.arrays
+        p0, p1 = int(a["point_offsets"][row]), int(a["point_offsets"][row + 1])
+        t0, t1 = int(a["text_offsets"][row]), int(a["text_offsets"][row + 1])
+        h0, h1 = int(a["html_offsets"][row]), int(a["html_offsets"][row + 1])
+        width, height = (float(v) for v in a["layout"][row])
+        return {
+            "page": int(a["page"][row]),
+            "category": self.meta["categories"][int(a["category"][row])],
+            "text": self.text[t0:t1].tobytes().decode("utf-8"),
+            "html": self.html[h0:h1].tobytes().decode("utf-8") or None,
+            "points": a["points"][p0:p1].tolist(),
+            "layoutWidth": width,
+            "layoutHeight": height,
+        }
+
+# (file_id, 窗口序号) -> _Window 的 LRU，映射只占虚拟内存，按需换入
+_open_windows: "OrderedDict[tuple, _Window]" = OrderedDict()
+_open_lock = threading.Lock()
+
+def _window(file_id: str, index: int) -> _Window:
+    key = (file_id, index)
+    with _open_lock:
+        window = _open_windows.get(key)
+        if window is not None:
+            _open_windows.move_to_end(key)
+            return window
+    window = _Window(_window_dir(file_id, index))
+    with _open_lock:
+        _open_windows[key] = window
+        while len(_open_windows) > SEGMENT_OPEN_WINDOWS:
+            _open_windows.popitem(last=False)
+    return window
+
+def _window_index_for_page(file_id: str, page_number: int) -> int | None:
+    path = workdir(file_id) / "segments" / "index.json"
+    if not path.exists():
+        return None
+    for w in json.loads(path.read_text(encoding="utf-8"))["windows"]:
+        if w["firstPage"] <= page_number <= w["lastPage"]:
+            return w["index"]
+    return None
+
+def has_page(file_id: str, page_number: int) -> bool:
+    return _window_index_for_page(file_id, page_number) is not None
+
+def load_page(file_id: str, page_number: int) -> List[Dict[str, Any]] | None:
+    """读取单页的布局段（字典列表）；该页尚未解析时返回 None"""
+    index = _window_index_for_page(file_id, page_number)
+    if index is None:
+        return None
+    window = _window(file_id, index)
+    return [window.segment(row) for row in window.rows(page_number)]
+
+def load_window(file_id: str, index: int) -> List[Dict[str, Any]]:
+    """读取一个窗口的全部布局段"""
+    window = _window(file_id, index)
+    return [window.segment(row) for row in range(window.meta["count"])]
+
+def to_element(seg: Dict[str, Any]) -> Any:
+    """把存储的布局段还原为 unstructured 元素，供叠框渲染与 Markdown 导出复用"""
+    cls = us_elements.TYPE_TO_TEXT_ELEMENT_MAP.get(seg["category"], us_elements.Text)
+    metadata = ElementMetadata(page_number=seg["page"], text_as_html=seg["html"])
+    kwargs: Dict[str, Any] = {}
+    if seg["points"]:
+        kwargs["coordinates"] = tuple(tuple(p) for p in seg["points"])
+        kwargs["coordinate_system"] = PixelSpace(width=seg["layoutWidth"], height=seg["layoutHeight"])
+    return cls(text=seg["text"], metadata=metadata, **kwargs)
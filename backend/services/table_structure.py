@@ -0,0 +1,111 @@
+# services/table_structure.py
+from __future__ import annotations
+import os
+from typing import Dict, Any, List, Tuple
+
+import fitz
+from PIL import Image
+
+from .log_service import get_logger
+
+logger = get_logger('table_structure')
+
+# 表格结构识别模式：
+#   selective（默认）两阶段：hi_res 只做布局检测，之后只对识别为 Table 的区域运行表格结构模型
+#   full      由 partition_pdf 在版面解析时一并识别（infer_table_structure=True）
+#   off       不识别表格结构，表格按纯文本导出
+TABLE_STRUCTURE_MODE = os.getenv("TABLE_STRUCTURE_MODE", "selective").lower()
+# 裁剪表格区域时四周额外保留的像素
+TABLE_IMAGE_CROP_PAD = int(os.getenv("TABLE_IMAGE_CROP_PAD", 12))
+# 表格区域的最小宽/高（像素），更小的区域多为误检，不值得跑表格模型
+TABLE_MIN_SIZE = int(os.getenv("TABLE_MIN_SIZE", 40))
+
+# (元素下标, 页码, (x0, y0, x1, y1), 坐标系宽, 坐标系高)
+Region = Tuple[int, int, Tuple[float, float, float, float], float, float]
+
+def table_regions(elements: List[Any]) -> List[Region]:
+    """找出布局结果中的 Table 元素及其外接矩形（PixelSpace 坐标）"""
+    regions: List[Region] = []
+    for i, el in enumerate(elements):
+        if getattr(el, "category", None) != "Table":
+            continue
+        coords = el.metadata.coordinates
+        if not coords or not coords.points or not el.metadata.page_number:
+            continue
+        xs = [p[0] for p in coords.points]
+        ys = [p[1] for p in coords.points]
+        if max(xs) - min(xs) < TABLE_MIN_SIZE or max(ys) - min(ys) < TABLE_MIN_SIZE:
+            continue
+        regions.append((i, el.metadata.page_number, (min(xs), min(ys), max(xs), max(ys)),
+                        coords.system.width, coords.system.height))
+    return regions
+
+def _text_layer_tokens(page, bbox_pt: fitz.Rect, scale: float, origin: Tuple[float, float]) -> List[Dict[str, Any]]:
+    """从 PDF 文本层取表格区域内的词作为表格模型的 token，坐标换算到裁剪图上"""
+    tokens = []
+    for x0, y0, x1, y1, word, *_ in page.get_text("words", clip=bbox_pt):
+        tokens.append({
+            "bbox": [x0 * scale - origin[0], y0 * scale - origin[1], x1 * scale - origin[0], y1 * scale - origin[1]],
+            "text": word,
+            "span_num": len(tokens),
+            "line_num": 0,
+            "block_num": 0,
+        })
+    return tokens
+
+def infer_table_html(pdf_path: str, regions: List[Region]) -> List[str]:
+    """
+    对每个表格区域裁剪页面图像并运行表格结构模型，返回对应的 HTML（未识别出表格为空串）。
+    有文本层的页面直接用文本层的词作为 token，扫描页才对裁剪图做 OCR。
+    在布局进程池的 worker 中执行时，表格模型与 OCR 模型按进程只加载一次
+    """
+    from unstructured_inference.models import tables
+    from unstructured_inference.models.tables import cells_to_html
+    from unstructured.partition.pdf_image.ocr import get_table_tokens
+    from unstructured.partition.utils.ocr_models.ocr_interface import OCRAgent
+    from unstructured.partition.utils.constants import OCR_AGENT_PADDLE
+
+    tables.load_agent()
+    if tables.tables_agent is None:
+        raise RuntimeError("无法加载表格结构模型")
+    ocr_agent = None
+    out: List[str] = []
+    with fitz.open(pdf_path) as doc:
+        for _, page_number, (x0, y0, x1, y1), layout_w, _layout_h in regions:
+            page = doc.load_page(page_number - 1)
+            # 按布局坐标系的分辨率渲染，使裁剪框与检测结果对齐
+            scale = layout_w / page.rect.width
+            pad = TABLE_IMAGE_CROP_PAD
+            crop = fitz.Rect(x0 - pad, y0 - pad, x1 + pad, y1 + pad) / scale & page.rect
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=crop, colorspace=fitz.csRGB, alpha=False)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            tokens = _text_layer_tokens(page, crop, scale, (crop.x0 * scale, crop.y0 * scale))
+            if not tokens:
+                if ocr_agent is None:
+                    ocr_agent = OCRAgent.get_instance(ocr_agent_module=OCR_AGENT_PADDLE, language="ch")
+                tokens = get_table_tokens(table_element_image=image, ocr_agent=ocr_agent)
+            try:
+                cells = tables.tables_agent.predict(image, ocr_tokens=tokens, result_format="cells")
+                out.append("" if cells == "" else cells_to_html(cells))
+            except Exception as e:
+                logger.warning(f"表格结构识别失败，页码: {page_number}, 错误: {e}")
+                out.append("")
+    return out
+
+def apply_table_structure(pdf_path: str, elements: List[Any], pool=None) -> List[Any]:
+    """
+    第二阶段：只对 Table 区域运行表格结构模型，结果写入 metadata.text_as_html（供 Markdown 导出转换为表格）。
+    pool 为启用的布局进程池时提交到 worker，否则在当前进程执行
+    """
+    regions = table_regions(elements)
+    if not regions:
+        return elements
+    logger.info(f"开始识别表格结构，表格区域数: {len(regions)}")
+    if pool is not None and pool.enabled:
+        htmls = pool.table_html(pdf_path, regions)
+    else:
+        htmls = infer_table_html(pdf_path, regions)
+    for (index, *_), html in zip(regions, htmls):
+        if html:
+            elements[index].metadata.text_as_html = html
+    return elements
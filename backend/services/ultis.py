@@ -1,13 +1,13 @@
-import requests
 import time
 import os
 from pathlib import Path
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
 from dotenv import load_dotenv
 from typing import Dict, Any
 import random
 import string
 from services.log_service import get_logger
+from services.embedding_client import get_embeddings
 logger = get_logger('ultis')
 load_dotenv(override=True)
 
@@ -32,6 +32,10 @@ def err(code: str, message: str) -> Dict[str, Any]:
     logger.error(f"生成错误响应: {code} - {message}")
     return {"error": {"code": code, "message": message}, "requestId": rid("req"), "ts": now_ts()}
 
+def has_parse_artifacts(file_id: str) -> bool:
+    """判断 fileId 对应的工作目录与原始PDF是否仍然存在（不创建目录）"""
+    return (DATA_ROOT / file_id / "original.pdf").exists()
+
 def workdir(file_id: str) -> Path:
     """获取工作目录路径"""
     p = DATA_ROOT / file_id
@@ -40,12 +44,28 @@ def workdir(file_id: str) -> Path:
         logger.info(f"创建工作目录 {p}")
     return p
 
+def incoming_dir() -> Path:
+    """获取上传暂存目录路径（流式写入完成、校验通过后再移动到工作目录）"""
+    p = DATA_ROOT / "_incoming"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
 def markdown_path(file_id: str) -> Path:
     """获取Markdown文件路径"""
     p = workdir(file_id) / "output.md"
     logger.info(f"创建Markdown文件路径: {p}")
     return p
 
+def markdown_parts_dir(file_id: str) -> Path:
+    """获取窗口化解析的 Markdown 分片目录路径"""
+    p = workdir(file_id) / "markdown_parts"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+def checkpoint_path(file_id: str) -> Path:
+    """获取解析检查点文件路径"""
+    return workdir(file_id) / "checkpoint.json"
+
 def index_dir(file_id: str) -> Path:
     """获取索引目录路径"""
     p = workdir(file_id) / "index_chroma"
@@ -73,12 +93,12 @@ def original_pdf_path(file_id: str) -> Path:
     logger.info(f"获取原始PDF路径 {p}")
     return p
 
-def load_local_embeddings(model_name: str = "bge-m3:latest") -> OllamaEmbeddings: 
+def load_local_embeddings(model_name: str = "bge-m3:latest") -> Embeddings: 
     """
     加载本地Ollama嵌入模型
     
     Returns:
-        OllamaEmbeddings: 嵌入模型实例
+        Embeddings: 嵌入模型实例（PooledOllamaEmbeddings）
     
     Raises:
         Exception: 当模型加载失败时抛出异常
@@ -88,16 +108,9 @@ def load_local_embeddings(model_name: str = "bge-m3:latest") -> OllamaEmbeddings
     embed_model_url = os.getenv("EMBED_MODEL_URL", "http://127.0.0.1:11434")
     
     try:
-        # 检查Ollama服务是否可用
-        response = requests.get(embed_model_url + "/api/tags", timeout=10)
-        if response.status_code != 200:
-            logger.error(f"Ollama服务返回状态码 {response.status_code}，响应内容: {response.text}")
-            raise Exception("Ollama服务不可用，请确保Ollama已启动")
-        
-        # 正常加载bge-m3模型
-        logger.info(f"正在加载嵌入模型 {model_name}，请确保模型已加载到Ollama服务中")
-        return OllamaEmbeddings(model=model_name, base_url=embed_model_url)
+        # 按 (模型, 地址) 复用进程内的客户端与长连接，健康检查结果在 EMBED_HEALTH_TTL 内有效
+        return get_embeddings(model_name, embed_model_url)
 
     except Exception as e:
         logger.error(f"加载嵌入模型 {model_name} 失败: {str(e)}")
-        raise Exception(f"加载嵌入模型失败: {str(e)}")
\ No newline at end of file
+        raise Exception(f"加载嵌入模型失败: {str(e)}")
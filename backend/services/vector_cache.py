@@ -0,0 +1,222 @@
+# services/vector_cache.py
+from __future__ import annotations
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Tuple
+
+from langchain_community.vectorstores import Chroma
+
+from .log_service import get_logger
+from .ultis import workdir, index_dir
+
+logger = get_logger('vector_cache')
+
+# 打开的 Chroma 索引占用内存的预算（按 分块数 x 向量维度 估算 HNSW 常驻内存）
+CHROMA_CACHE_MB = int(os.getenv("CHROMA_CACHE_MB", 512))
+# 同时保持打开的索引数上限
+CHROMA_CACHE_MAX = int(os.getenv("CHROMA_CACHE_MAX", 32))
+# HNSW 每个向量除 float32 数据外的常驻开销：第 0 层 2*M 个 int32 邻接（M 默认 16）+ 标签与索引结构
+HNSW_OVERHEAD_BYTES = 2 * 16 * 4 + 64
+
+def _version_path(file_id: str) -> Path:
+    # 放在索引目录之外，不影响“索引目录非空”的判断
+    return workdir(file_id) / "index_version"
+
+# fileId -> ((inode, mtime_ns), 版本号)：版本文件未变化时不再读取内容
+_versions: Dict[str, Tuple[Tuple[int, int], str]] = {}
+_versions_lock = threading.Lock()
+
+def index_version(file_id: str) -> str:
+    """当前索引版本；旧索引没有版本文件时按 "0" 处理。按 stat 结果缓存，每次查询只做一次 stat"""
+    path = _version_path(file_id)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return "0"
+    # bump_index_version 用 os.replace 换入新文件，inode 与 mtime 随之变化
+    stamp = (st.st_ino, st.st_mtime_ns)
+    with _versions_lock:
+        cached = _versions.get(file_id)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        version = path.read_text(encoding="utf-8").strip() or "0"
+    except FileNotFoundError:
+        return "0"
+    with _versions_lock:
+        _versions[file_id] = (stamp, version)
+    return version
+
+def bump_index_version(file_id: str) -> str:
+    """索引构建完成后写入新版本号，其他进程中缓存的旧版本句柄随之失效"""
+    version = str(time.time_ns())
+    path = _version_path(file_id)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, path)
+    return version
+
+# 已提示过 chromadb 内部结构不兼容（只提示一次）
+_systems_warned = False
+
+def _shared_systems() -> Dict[str, Any] | None:
+    """
+    chromadb 按持久化路径在进程内共享 System（含 HNSW 段），同一路径的客户端拿到的是同一个 System。
+    这是 chromadb 的内部结构（requirements.txt 固定了验证过的版本范围）；找不到时返回 None，
+    缓存退化为只丢弃句柄，System 由 chromadb 自行管理
+    """
+    global _systems_warned
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+    except ImportError:
+        try:
+            from chromadb.api.client import SharedSystemClient
+        except ImportError:
+            SharedSystemClient = None
+    systems = getattr(SharedSystemClient, "_identifier_to_system", None)
+    if isinstance(systems, dict):
+        return systems
+    if not _systems_warned:
+        _systems_warned = True
+        logger.warning("当前 chromadb 版本没有 SharedSystemClient._identifier_to_system，淘汰索引句柄时不再释放其 System")
+    return None
+
+def _estimate_bytes(db: Chroma) -> int:
+    """按 分块数 x (向量字节 + HNSW 开销) 估算常驻内存；文档与 metadata 留在 SQLite 中，不计入"""
+    got = db.get(limit=1, include=["embeddings"])
+    embeddings = got.get("embeddings")
+    dim = len(embeddings[0]) if embeddings is not None and len(embeddings) else 0
+    count = len(db.get(include=[])["ids"])
+    return count * (dim * 4 + HNSW_OVERHEAD_BYTES)
+
+class _Entry:
+    """
+    一个打开的索引：Chroma 句柄、其底层的 chromadb System 与估算大小。
+    被淘汰后从 chromadb 的进程级缓存中摘除（之后打开同一路径会新建 System 并从磁盘重新加载），
+    正在使用它的查询结束后再停止 System，释放 HNSW 段占用的内存
+    """
+    def __init__(self, db: Chroma):
+        self.db = db
+        self.identifier = getattr(getattr(db, "_client", None), "_identifier", None)
+        systems = _shared_systems()
+        self.system = systems.get(self.identifier) if systems is not None and self.identifier is not None else None
+        self.size = _estimate_bytes(db)
+        self.users = 0
+        self.evicted = False
+
+    def detach(self) -> None:
+        if self.system is None:
+            return
+        systems = _shared_systems()
+        if systems is not None and systems.get(self.identifier) is self.system:
+            systems.pop(self.identifier, None)
+
+    def stop(self) -> None:
+        if self.system is None:
+            return
+        try:
+            self.system.stop()
+        except Exception as e:
+            logger.warning(f"停止Chroma System失败: {e}")
+        self.system = None
+
+class ChromaHandleCache:
+    """按 (fileId, 索引版本) 缓存打开的 Chroma 句柄，按估算内存与数量 LRU 淘汰（线程安全）"""
+    def __init__(self, max_bytes: int, max_items: int):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._items: OrderedDict[Tuple[str, str], _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._open_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _pop(self, key: Tuple[str, str]) -> None:
+        # 调用方已持有锁；没有查询在用时立即停止 System，否则由最后一个查询停止
+        entry = self._items.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        entry.evicted = True
+        entry.detach()
+        if entry.users == 0:
+            entry.stop()
+
+    def _hit(self, key: Tuple[str, str]) -> _Entry | None:
+        # 调用方已持有锁
+        entry = self._items.get(key)
+        if entry is not None:
+            self._items.move_to_end(key)
+            entry.users += 1
+            self.hits += 1
+        return entry
+
+    def _acquire(self, file_id: str, embeddings) -> _Entry:
+        """返回打开的索引（使用计数 +1），未命中时从磁盘加载；同一索引的并发首次请求只加载一次"""
+        key = (file_id, index_version(file_id))
+        with self._lock:
+            entry = self._hit(key)
+            if entry is not None:
+                return entry
+            open_lock = self._open_locks.setdefault(key, threading.Lock())
+        with open_lock:
+            with self._lock:
+                entry = self._hit(key)
+                if entry is not None:
+                    return entry
+                self.misses += 1
+                # 同一文件的旧版本（例如其他进程重建了索引）先从 chromadb 缓存摘除，否则新句柄会复用旧的 HNSW 数据
+                for old in [k for k in self._items if k[0] == file_id]:
+                    self._pop(old)
+            try:
+                entry = _Entry(Chroma(persist_directory=str(index_dir(file_id)), embedding_function=embeddings))
+            except Exception:
+                with self._lock:
+                    self._open_locks.pop(key, None)
+                raise
+            with self._lock:
+                entry.users += 1
+                self._items[key] = entry
+                self._bytes += entry.size
+                while len(self._items) > 1 and (self._bytes > self.max_bytes or len(self._items) > self.max_items):
+                    evicted = next(iter(self._items))
+                    self._pop(evicted)
+                    self.evictions += 1
+                    logger.info(f"淘汰Chroma索引句柄，文件ID: {evicted[0]}")
+                self._open_locks.pop(key, None)
+            logger.info(f"加载Chroma索引，文件ID: {file_id}，版本: {key[1]}，估算大小: {entry.size} 字节")
+            return entry
+
+    def _release(self, entry: _Entry) -> None:
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and entry.users == 0:
+                entry.stop()
+
+    @contextmanager
+    def lease(self, file_id: str, embeddings):
+        """在 with 块内使用打开的 Chroma 句柄；块结束前句柄不会被停止"""
+        entry = self._acquire(file_id, embeddings)
+        try:
+            yield entry.db
+        finally:
+            self._release(entry)
+
+    def invalidate(self, file_id: str) -> None:
+        """删除某个文件的全部句柄并释放其 System（重建索引后调用）"""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == file_id]:
+                self._pop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"items": len(self._items), "bytes": self._bytes, "maxBytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+chroma_cache = ChromaHandleCache(CHROMA_CACHE_MB * 1024 * 1024, CHROMA_CACHE_MAX)
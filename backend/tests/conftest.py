@@ -0,0 +1,6 @@
+# tests/conftest.py
+import sys
+from pathlib import Path
+
+# 以 backend 目录为根导入 services 包（与 run.py 启动时一致）
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,178 @@
+# tests/test_embedding_client.py
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from services import embedding_client as ec
+from services.query_embedding_cache import QueryEmbeddingCache
+
+
+class FakeOllama:
+    """本地假 Ollama：实现 /api/tags 与 /api/embed，记录请求路径与客户端连接"""
+    def __init__(self):
+        self.fail = False
+        self.requests = []
+        self.ports = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 + Content-Length 才能保持长连接
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                fake.requests.append(self.path)
+                fake.ports.add(self.client_address[1])
+                if fake.fail:
+                    self._reply(500, {"error": "down"})
+                else:
+                    self._reply(200, {"models": [{"name": "fake"}]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                fake.requests.append(self.path)
+                fake.ports.add(self.client_address[1])
+                if fake.fail:
+                    self._reply(500, {"error": "down"})
+                    return
+                self._reply(200, {"model": body["model"],
+                                  "embeddings": [[float(len(t)), 1.0] for t in body["input"]]})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def count(self, path):
+        return sum(1 for p in self.requests if p == path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def ollama(monkeypatch):
+    fake = FakeOllama()
+    # 每个用例使用独立的客户端与连接池
+    monkeypatch.setattr(ec, "_clients", {})
+    monkeypatch.setattr(ec, "_sessions", {})
+    monkeypatch.setattr(ec, "EMBED_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(ec, "EMBED_BREAKER_COOLDOWN", 0.2)
+    yield fake
+    for session in ec._sessions.values():
+        session.close()
+    fake.close()
+
+
+def test_embed_documents_batches_requests(ollama, monkeypatch):
+    monkeypatch.setattr(ec, "EMBED_BATCH_SIZE", 2)
+    emb = ec.get_embeddings("fake", ollama.url)
+    vectors = emb.embed_documents(["a", "bb", "ccc", "dddd", "eeeee"])
+    assert [v[0] for v in vectors] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert ollama.count("/api/embed") == 3
+
+
+def test_embed_query_uses_query_cache(ollama, monkeypatch, tmp_path):
+    # 不读写进程级的查询缓存（其磁盘层可能指向开发者本机的缓存文件）
+    cache = QueryEmbeddingCache(1 << 20, 3600, str(tmp_path / "query_embeddings.db"))
+    monkeypatch.setattr(ec, "query_cache", cache)
+    emb = ec.get_embeddings("fake", ollama.url)
+    text = "查询向量缓存 test_embed_query_uses_query_cache"
+    first = emb.embed_query(text)
+    second = emb.embed_query("  " + text.upper() + " ")
+    assert first == second
+    assert ollama.count("/api/embed") == 1
+    assert cache.snapshot()["hits"] == 1
+
+
+def test_health_check_cached_within_ttl(ollama, monkeypatch):
+    monkeypatch.setattr(ec, "EMBED_HEALTH_TTL", 60)
+    for _ in range(3):
+        ec.get_embeddings("fake", ollama.url)
+    assert ollama.count("/api/tags") == 1
+    snap = ec.embedding_metrics()[0]
+    assert snap["healthChecks"] == 1 and snap["healthCacheHits"] == 2
+
+
+def test_health_check_repeated_after_ttl(ollama, monkeypatch):
+    monkeypatch.setattr(ec, "EMBED_HEALTH_TTL", 0)
+    ec.get_embeddings("fake", ollama.url)
+    ec.get_embeddings("fake", ollama.url)
+    assert ollama.count("/api/tags") == 2
+
+
+def test_breaker_opens_after_consecutive_failures(ollama):
+    emb = ec.get_embeddings("fake", ollama.url)
+    ollama.fail = True
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            emb.embed_documents(["x"])
+    sent = ollama.count("/api/embed")
+    with pytest.raises(ec.EmbeddingUnavailable):
+        emb.embed_documents(["x"])
+    with pytest.raises(ec.EmbeddingUnavailable):
+        ec.get_embeddings("fake", ollama.url)
+    # 熔断期内不再请求 Ollama
+    assert ollama.count("/api/embed") == sent
+    snap = ec.embedding_metrics()[0]
+    assert snap["breakerOpen"] and snap["breakerTrips"] == 1 and snap["breakerRejections"] == 2
+
+
+def test_breaker_half_open_probe_recovers(ollama):
+    emb = ec.get_embeddings("fake", ollama.url)
+    client = emb.client
+    ollama.fail = True
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            emb.embed_documents(["x"])
+    ollama.fail = False
+    time.sleep(0.25)
+    # 冷却结束后只放行一个探测请求，探测期间其余请求仍被拒绝
+    client.reject_if_open()
+    with pytest.raises(ec.EmbeddingUnavailable):
+        client.reject_if_open()
+    client.record_success(0.0)
+    assert emb.embed_documents(["ok"]) == [[2.0, 1.0]]
+    assert not ec.embedding_metrics()[0]["breakerOpen"]
+
+
+def test_breaker_half_open_probe_failure_reopens(ollama):
+    emb = ec.get_embeddings("fake", ollama.url)
+    ollama.fail = True
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            emb.embed_documents(["x"])
+    time.sleep(0.25)
+    sent = ollama.count("/api/embed")
+    with pytest.raises(ValueError):
+        emb.embed_documents(["probe"])
+    assert ollama.count("/api/embed") == sent + 1
+    with pytest.raises(ec.EmbeddingUnavailable):
+        emb.embed_documents(["x"])
+    assert ec.embedding_metrics()[0]["breakerTrips"] == 2
+
+
+def test_requests_reuse_pooled_connection(ollama):
+    emb = ec.get_embeddings("fake", ollama.url)
+    other = ec.get_embeddings("other-model", ollama.url)
+    for i in range(5):
+        emb.embed_documents([f"doc {i}"])
+        other.embed_documents([f"doc {i}"])
+    # 同一地址的所有模型共用一个 Session，顺序请求复用同一条长连接
+    assert ec._session(ollama.url) is ec._sessions[ollama.url]
+    assert len(ec._sessions) == 1
+    assert len(ollama.ports) == 1